@@ -1,58 +1,321 @@
+import io
 import os
 import json
+import time
+import random
+import sqlite3
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from archive_reader import ArchiveReader
+
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.gif')
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_LOADER_WORKERS = min(8, os.cpu_count() or 1)
+DEFAULT_PREFETCH = 4 # decoded batches kept ready ahead of the consumer
+# directories modified less than this many seconds before a scan are listed
+# again on the next scan, a change in the same mtime tick would go unnoticed
+RACY_SECONDS = 2
+
+
+def default_index_path(data_dir):
+    # the index sits next to the tree, not inside it
+    return f'{os.path.normpath(data_dir)}-tag-index.sqlite'
+
 
 class TaggedDataLoader:
-    def __init__(self, data_dir, tag=None):
+    # lists the images of a tree by tag, where the tags of a file are the
+    # directory names on its path below data_dir. The listing is kept in a
+    # sqlite index with the size and mtime of every file. A directory is only
+    # listed again when its own mtime changed (a file was added, removed or
+    # renamed in it), so a refresh of an unchanged tree costs one stat per
+    # directory. Queries are answered from a tag -> files table in memory.
+    #
+    #   loader = TaggedDataLoader('/path/to/data/dir', 'pos-pixel-art')
+    #   file_data = loader.load_data()
+    #   both = loader.load_data(['pos-pixel-art', 'characters'])
+    def __init__(self, data_dir, tag=None, index_path=None, extensions=IMAGE_EXTENSIONS):
         self.data_dir = data_dir
         self.tag = tag
+        self.index_path = index_path or default_index_path(data_dir)
+        self.extensions = tuple(extensions)
+        # {relative directory: (mtime, [(name, size, mtime)])}
+        self.directories = None
+        self.files = []
+        self.tag_files = {}
+
+    def _connect(self):
+        connection = sqlite3.connect(self.index_path, timeout=60)
+        connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime INTEGER NOT NULL)')
+        connection.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                PRIMARY KEY (directory, name)
+            )''')
+        return connection
+
+    def _load_index(self):
+        directories = {}
+        if not os.path.exists(self.index_path):
+            return directories
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'extensions'").fetchone()
+            if row is None or json.loads(row[0]) != list(self.extensions):
+                return directories
+            for path, mtime in connection.execute('SELECT path, mtime FROM directories'):
+                directories[path] = (mtime, [])
+            for directory, name, size, mtime in connection.execute('SELECT directory, name, size, mtime FROM files'):
+                if directory in directories:
+                    directories[directory][1].append((name, size, mtime))
+        finally:
+            connection.close()
+        return directories
+
+    def _save_index(self, directories, changed, removed, rebuild=False):
+        connection = self._connect()
+        try:
+            with connection:
+                if rebuild:
+                    connection.execute('DELETE FROM directories')
+                    connection.execute('DELETE FROM files')
+                connection.execute("INSERT OR REPLACE INTO meta VALUES ('extensions', ?)", [json.dumps(list(self.extensions))])
+                for path in list(changed) + list(removed):
+                    connection.execute('DELETE FROM directories WHERE path = ?', [path])
+                    connection.execute('DELETE FROM files WHERE directory = ?', [path])
+                for path in changed:
+                    mtime, files = directories[path]
+                    connection.execute('INSERT INTO directories VALUES (?, ?)', [path, mtime])
+                    connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', [(path, *file) for file in files])
+        finally:
+            connection.close()
 
-    def load_data(self):
-        file_data = []
-        for root, dirs, files in os.walk(self.data_dir):
-            if self.tag and self.tag not in dirs:
+    def _scan(self, stored):
+        # walks the tree, listing only the directories whose mtime changed;
+        # returns the new {directory: (mtime, files)} and the changed paths
+        children = {}
+        for path in stored:
+            if path:
+                children.setdefault(os.path.dirname(path), []).append(path)
+        racy = time.time_ns() - RACY_SECONDS * 1000000000
+
+        directories = {}
+        changed = []
+        stack = ['']
+        while stack:
+            relative_dir = stack.pop()
+            full_dir = os.path.join(self.data_dir, relative_dir)
+            try:
+                mtime = os.stat(full_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if relative_dir in stored and stored[relative_dir][0] == mtime:
+                directories[relative_dir] = stored[relative_dir]
+                stack.extend(children.get(relative_dir, []))
                 continue
-            for file in files:
-                if file.endswith('.jpg') or file.endswith('.png') or file.endswith('.gif'):
-                    file_path = os.path.join(root, file)
-                    if not self.tag or self.tag in file_path:
-                        file_data.append({'file_path': file_path})
-        return file_data
-    
-'''
-    loader = TaggedDataLoader('/path/to/data/dir', 'pos-pixel-art')
-    file_data = loader.load_data()
-
-    # Example usage: Print the number of tagged image files found
-    print(f"Found {len(file_data)} tagged image files.")
-    '''
+
+            files = []
+            with os.scandir(full_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(os.path.join(relative_dir, entry.name))
+                    elif entry.name.endswith(self.extensions) and entry.is_file():
+                        stat = entry.stat()
+                        files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+            # -1 never matches, so a directory that may still be changing is
+            # listed again next time
+            directories[relative_dir] = (mtime if mtime < racy else -1, files)
+            changed.append(relative_dir)
+        return directories, changed
+
+    def refresh(self):
+        # brings the index up to date with the tree and rebuilds the tag table
+        stored = self.directories if self.directories is not None else self._load_index()
+        directories, changed = self._scan(stored)
+        removed = [path for path in stored if path not in directories]
+        if changed or removed or not os.path.exists(self.index_path):
+            try:
+                self._save_index(directories, changed, removed, rebuild=not stored)
+            except sqlite3.Error as e:
+                print(f'Could not save the tag index {self.index_path}: {e}')
+        self.directories = directories
+
+        self.files = []
+        self.tag_files = {}
+        for relative_dir in sorted(directories):
+            tags = set(relative_dir.split(os.sep)) if relative_dir else set()
+            for name, size, mtime in sorted(directories[relative_dir][1]):
+                position = len(self.files)
+                self.files.append({'file_path': os.path.join(self.data_dir, relative_dir, name), 'size': size, 'mtime': mtime})
+                for tag in tags:
+                    self.tag_files.setdefault(tag, []).append(position)
+
+    def tags(self):
+        # {tag: number of files}
+        if self.directories is None:
+            self.refresh()
+        return {tag: len(positions) for tag, positions in sorted(self.tag_files.items())}
+
+    def load_data(self, tag=None, refresh=False):
+        # files that carry tag, or every tag of a list of tags; all files when
+        # no tag is given. The tree is only scanned on the first call or when
+        # refresh is set
+        if self.directories is None or refresh:
+            self.refresh()
+        tag = tag if tag is not None else self.tag
+        if not tag:
+            return list(self.files)
+        tags = [tag] if isinstance(tag, str) else list(tag)
+        matches = sorted((self.tag_files.get(tag, []) for tag in tags), key=len)
+        positions = set(matches[0])
+        for other in matches[1:]:
+            positions.intersection_update(other)
+        return [self.files[position] for position in sorted(positions)]
+
+
+# archive reader, size and transform of the current loader process, set once
+# by _init_loader instead of being pickled with every batch
+_reader = None
+_size = None
+_transform = None
+
+
+def _init_loader(reader, size, transform):
+    global _reader, _size, _transform
+    _reader = reader
+    _size = size
+    _transform = transform
+
+
+def _load_batch(keys):
+    return load_batch(_reader, keys, _size, _transform)
+
+
+def load_batch(reader, keys, size=None, transform=None):
+    # reads and decodes one batch; reader is an ArchiveReader, or None for
+    # plain files. Images that fail to decode are reported in 'errors'
+    images = []
+    metadata = []
+    errors = []
+    for key in keys:
+        try:
+            if reader is not None:
+                data = reader.read(key)
+            else:
+                with open(key, 'rb') as f:
+                    data = f.read()
+            image = Image.open(io.BytesIO(data)).convert('RGB')
+            original_size = image.size
+            if size:
+                image = image.resize(size, Image.BICUBIC)
+            images.append(transform(image) if transform else np.asarray(image))
+            metadata.append({'file_path': key, 'size': original_size, 'bytes': len(data)})
+        except Exception as e:
+            errors.append((key, str(e)))
+    if size and not transform and images:
+        # resized images all have the same shape, hand them out as one array
+        images = np.stack(images)
+    return {'images': images, 'metadata': metadata, 'errors': errors}
 
 
 class GeneralDataLoader:
-    def __init__(self, data_dir):
-        self.data_dir = data_dir 
+    # iterates over the images of a directory tree or of a directory of zip
+    # shards in batches of decoded RGB images:
+    #   {'images': [h x w x 3 uint8 arrays] (one n x h x w x 3 array when
+    #    resized, transform outputs when a transform is given),
+    #    'metadata': [{'file_path', 'size', 'bytes'}], 'errors': [(path, error)]}
+    # Batches are decoded by a pool of threads (or processes) and at most
+    # prefetch batches are decoded ahead of the consumer.
+    #
+    # source='auto' reads zip files when data_dir is a zip file or has zip
+    # files at its top level; pass source='zip' for zip files further down.
+    # tag selects files of a directory tree, zip members have no tags.
+    #
+    # shard/num_shards split the files deterministically between workers or
+    # nodes: every loader sees the same sorted (and, with shuffle, the same
+    # seeded) order and takes every num_shards-th file from position shard.
+    #
+    #   loader = GeneralDataLoader('images-zipped', batch_size=64, size=(224, 224), shard=rank, num_shards=world_size)
+    #   for batch in loader:
+    #       ...
+    def __init__(self, data_dir, batch_size=DEFAULT_BATCH_SIZE, size=None, transform=None, tag=None, source='auto',
+                 workers=DEFAULT_LOADER_WORKERS, prefetch=DEFAULT_PREFETCH, processes=False,
+                 shard=0, num_shards=1, shuffle=False, seed=0):
+        if not 0 <= shard < num_shards:
+            raise ValueError(f'shard must be in [0, {num_shards}), got {shard}')
+        self.data_dir = data_dir
+        self.batch_size = batch_size
+        self.size = (size, size) if isinstance(size, int) else size
+        self.transform = transform
+        self.workers = workers
+        self.prefetch = max(1, prefetch)
+        self.processes = processes
+        self.shard = shard
+        self.num_shards = num_shards
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
 
+        if source == 'auto':
+            # only the top level is listed, a large tree of images is not
+            # walked just to find out it has no zip files
+            has_zip = data_dir.endswith('.zip') or any(name.endswith('.zip') for name in os.listdir(data_dir))
+            source = 'zip' if has_zip else 'files'
+        # files are listed through the tag index, zip members through the
+        # archive indexes
+        if source == 'zip':
+            if tag:
+                raise ValueError('tag selects files of a directory tree, it cannot be used with zip files')
+            self.reader = ArchiveReader(data_dir)
+            self.keys = sorted(self.reader.names)
+        else:
+            self.reader = None
+            self.keys = [item['file_path'] for item in TaggedDataLoader(data_dir, tag).load_data()]
 
+    def set_epoch(self, epoch):
+        # a different shuffle for every epoch, the same on every shard
+        self.epoch = epoch
 
-import json
-import torch
-from torch.utils.data import Dataset
-
-class ImageDataset(Dataset):
-    def __init__(self, json_file):
-        with open(json_file, "r") as f:
-            data = json.load(f)
-        self.images = []
-        for item in data:
-            image_path = item["path/filename"]
-            image_hash = item["file_hash"]
-            clip_vector = torch.tensor(item["clip_vector"])
-            self.images.append((image_path, image_hash, clip_vector))
+    def shard_keys(self):
+        keys = list(self.keys)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(keys)
+        return keys[self.shard::self.num_shards]
 
     def __len__(self):
-        return len(self.images)
-
-    def __getitem__(self, index):
-        image_path, image_hash, clip_vector = self.images[index]
-        return image_path, image_hash, clip_vector
+        return (len(self.shard_keys()) + self.batch_size - 1) // self.batch_size
 
+    def __iter__(self):
+        keys = self.shard_keys()
+        batches = [keys[start:start + self.batch_size] for start in range(0, len(keys), self.batch_size)]
+        if self.workers <= 0:
+            for batch in batches:
+                yield load_batch(self.reader, batch, self.size, self.transform)
+            return
 
+        # worker processes get the reader once, when they start; threads
+        # share it
+        if self.processes:
+            executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_loader, initargs=(self.reader, self.size, self.transform))
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.workers)
+        with executor:
+            pending = collections.deque()
+            batches = iter(batches)
+            while True:
+                while len(pending) < self.prefetch:
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    if self.processes:
+                        pending.append(executor.submit(_load_batch, batch))
+                    else:
+                        pending.append(executor.submit(load_batch, self.reader, batch, self.size, self.transform))
+                if not pending:
+                    break
+                yield pending.popleft().result()
@@ -0,0 +1,243 @@
+import os
+import time
+from tqdm import tqdm
+from embedding_store import save_records, split_image_data, output_exists, DTYPES, OUTPUT_FORMATS
+from embedding_journal import EmbeddingJournal, JOURNAL_SUFFIX
+from clip_pipeline import EncodePipeline, DEFAULT_WORKERS, DEFAULT_BATCH_SIZE
+from zip_stream import ZipStream, DEFAULT_READ_AHEAD
+from embedding_cache import EmbeddingCache, CACHE_FILE_NAME
+from dedup import load_skip_set
+from clip_backend import load_backend, load_sample, ensure_parity, cache_tag, BACKENDS, PARITY_IMAGES
+from metrics import metrics, DEFAULT_INTERVAL
+from work_queue import WorkQueue, LeaseLost, default_worker_id, DEFAULT_LEASE_SECONDS
+from async_io import AsyncIO
+
+# the driver the image-clip-tool generators share: it streams the zip files
+# of a directory through the EncodePipeline, journals every encoded batch and
+# writes one output per zip file, alone or leasing the zip files from a
+# WorkQueue. The generators only differ in the records they build from a
+# batch: build_records(file_names, prepared, clip_vectors, zip_file_path)
+# returns (image_data, images processed, conversion errors).
+
+
+def start_archive(zip_file_path, output_directory):
+    output_name = os.path.splitext(os.path.basename(zip_file_path))[0]
+    # every encoded batch is committed to the journal, so a crash only
+    # loses the batches that were in flight
+    journal = EmbeddingJournal(os.path.join(output_directory, output_name + JOURNAL_SUFFIX))
+    journal.recover()
+    # the pipeline reads and encodes across zip files, so the numbers of a
+    # zip file are counted from its own batches, not from the pipeline stats
+    return {'path': zip_file_path, 'name': output_name, 'journal': journal, 'processed': 0, 'bytes': 0, 'start': time.time()}
+
+
+def write_archive(journal, output_directory, output_name, output_format, dtype):
+    # merge everything committed, including batches of earlier runs, into
+    # the final output; the journal is only removed once that is in place
+    records, errors, vectors = journal.recover()
+    save_records(output_directory, output_name, records, vectors, output_format, dtype)
+    if errors:
+        error_file = os.path.join(output_directory, f"{output_name}_errors.txt")
+        with open(error_file, 'w') as f:
+            for error in errors:
+                f.write(f"{error[1]}: {error[2]}\n")
+    journal.remove()
+
+
+def finish_archive(archive, pipeline, file_io, output_directory, output_format, dtype):
+    # calculate zip file size in MB
+    zip_file_size = os.path.getsize(archive['path']) / (1024 * 1024)
+    processed_images = archive['processed']
+    total_time = max(time.time() - archive['start'], 1e-9)
+    img_s = processed_images / total_time
+    mb_s = archive['bytes'] / (total_time * 1024 * 1024)
+    ms = zip_file_size / total_time
+    total_gb = archive['bytes'] / (1024 * 1024 * 1024)
+
+    print(f"Processed {processed_images} images of {archive['path']} in {total_time:.2f} seconds. ({img_s:.2f} images/s, {mb_s:.2f} MB/s)")
+    print(f"Total GB processed: {total_gb:.2f} GB")
+    print(f"Zip file processed at {ms:.2f} MB/s")
+    print(f"Encode batch size: {pipeline.sizer.size}")
+
+    # the output is written in the background while the next zip file is
+    # encoded
+    file_io.submit(write_archive, archive['journal'], output_directory, archive['name'], output_format, dtype)
+
+
+def pending_archives(zip_files, output_directory, output_format):
+    # the zip files without an output yet, and the images of each that a
+    # journal of an interrupted run already holds
+    pending_zip_files = []
+    skip = {}
+    for file in zip_files:
+        output_name = os.path.splitext(os.path.basename(file))[0]
+        if output_exists(output_directory, output_name, output_format):
+            print(f"Output already exists for {file}. Skipping processing...")
+            continue
+        pending_zip_files.append(file)
+        # images committed to the journal by an interrupted run are not read again
+        journal = EmbeddingJournal(os.path.join(output_directory, output_name + JOURNAL_SUFFIX))
+        if journal.exists():
+            skip[file] = journal.done()
+            print(f"Resuming {file} after {len(skip[file])} journaled images")
+    return pending_zip_files, skip
+
+
+def encode_archives(pending_zip_files, skip, pipeline, build_records, file_io, output_directory, output_format, dtype, batch_size, read_ahead, lease=None):
+    # zip members are streamed in batches with a bounded read-ahead, which
+    # also keeps reading into the next zip file while this one is encoded.
+    # The encoder batches images across zip files, so the last images of a
+    # zip file are encoded together with the first ones of the next.
+    # With a lease, nothing is journaled once it is lost
+    stream = ZipStream(pending_zip_files, batch_size or DEFAULT_BATCH_SIZE, read_ahead, skip=skip)
+    results = pipeline.run(stream.batches())
+    archives = iter(pending_zip_files)
+    archive = None
+    failed = []
+
+    # a zip file the reader could not read to its end gets no output, its
+    # journal is kept so the next run or lease reads the rest of it
+    def finish(archive):
+        error = stream.errors.get(archive['path'])
+        if error is None:
+            finish_archive(archive, pipeline, file_io, output_directory, output_format, dtype)
+            return
+        print(f"Error: {archive['path']} could not be read: {error}. No output is written for it")
+        metrics.count('failed_archives')
+        failed.append(archive['path'])
+
+    try:
+        for (zip_file_path, file_names), prepared, clip_vectors in tqdm(results, desc="Processing batches"):
+            # the zip files before this one are complete, including those whose
+            # images were all journaled by an earlier run
+            while archive is None or archive['path'] != zip_file_path:
+                if archive is not None:
+                    finish(archive)
+                archive = start_archive(next(archives), output_directory)
+            batch_image_data, processed, conversion_errors = build_records(file_names, prepared, clip_vectors, zip_file_path)
+            records, vectors = split_image_data(batch_image_data)
+            if lease is not None:
+                lease.check()
+            archive['journal'].append(records, vectors, conversion_errors)
+            archive['processed'] += processed
+            archive['bytes'] += prepared['bytes']
+    finally:
+        results.close()
+        stream.close()
+
+    if lease is not None:
+        lease.check()
+    if archive is not None:
+        finish(archive)
+    for zip_file_path in archives:
+        finish(start_archive(zip_file_path, output_directory))
+    # the other zip files are written first; with a lease, the zip file is
+    # released instead of completed
+    if failed:
+        raise IOError(f"{len(failed)} zip files could not be read: {', '.join(failed)}")
+
+
+def lease_archives(queue, worker_id, lease_seconds, input_directory, pipeline, build_records, file_io, output_directory, output_format, dtype, batch_size, read_ahead):
+    # encodes one leased zip file at a time until the queue is drained. The
+    # output of a zip file is only written by the worker holding its lease,
+    # from its journal, so it is the same whichever worker ends up writing it;
+    # a worker that took over a lease resumes from the journal left behind
+    for lease in queue.leases(worker_id, lease_seconds):
+        zip_file_path = os.path.join(input_directory, lease.key)
+        print(f"{worker_id} leased {lease.key}")
+        metrics.count('leased_archives')
+        try:
+            pending_zip_files, skip = pending_archives([zip_file_path], output_directory, output_format)
+            encode_archives(pending_zip_files, skip, pipeline, build_records, file_io, output_directory, output_format, dtype, batch_size, read_ahead, lease)
+            # the zip file is only done once its output is on disk
+            file_io.flush()
+        except LeaseLost as e:
+            print(f"Error: {e}, leaving it to the worker that holds it now")
+            metrics.count('lost_leases')
+            continue
+        except Exception as e:
+            # the zip file goes back to the queue and this worker moves on
+            print(f"Error processing {lease.key}: {e}")
+            lease.release(f'{type(e).__name__}: {e}')
+            metrics.count('released_leases')
+            continue
+        lease.complete()
+
+
+def encode_directory(input_directory, output_directory, build_records, model_name, pretrained, batch_size=None, output_format='npy', dtype='float16', workers=DEFAULT_WORKERS, queue_depth=None, read_ahead=DEFAULT_READ_AHEAD, cache_path=None, use_cache=True, skip_duplicates=None, backend='eager', threads=None, interop_threads=None, parity_check=0, queue_path=None, worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+    # torch and the model are only loaded once there is something to encode
+    import torch
+    import clip
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model, preprocess = clip.load(model_name, device=device)
+    # the image encoder may run on a faster CPU backend than eager fp32
+    encoder = load_backend(model, backend, device, threads, interop_threads)
+
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    # vectors are cached by file hash, so re-runs and duplicate images only
+    # cost a lookup
+    cache = None
+    if use_cache:
+        cache = EmbeddingCache(cache_path or os.path.join(output_directory, CACHE_FILE_NAME), model_name, cache_tag(pretrained, backend))
+    # duplicates listed in a dedup report are neither decoded nor encoded
+    skip = set()
+    if skip_duplicates:
+        skip, _ = load_skip_set(skip_duplicates)
+        print(f"Skipping {len(skip)} duplicate images listed in {skip_duplicates}")
+    pipeline = EncodePipeline(encoder, preprocess, device, workers, queue_depth, cache, skip, batch_size)
+
+    zip_files = [os.path.join(root, file) for root, _, files in os.walk(input_directory) for file in files if file.endswith('.zip')]
+    total_zip_files = len(zip_files)
+    print(f"Processing {total_zip_files} zip files...")
+
+    if queue_path is None:
+        pending_zip_files, skip = pending_archives(zip_files, output_directory, output_format)
+    else:
+        # every worker adds the zip files it finds, the queue keeps one item
+        # per path relative to the input directory
+        queue = WorkQueue(queue_path)
+        added = queue.add(sorted(os.path.relpath(file, input_directory) for file in zip_files))
+        print(f"{added} zip files added to {queue_path}: {queue.counts()}")
+        pending_zip_files = sorted(zip_files)
+
+    # compare the backend with the eager model before encoding anything with it
+    if parity_check and backend != 'eager' and pending_zip_files:
+        ensure_parity(model, encoder, load_sample(pending_zip_files[0], preprocess, parity_check))
+
+    # the outputs of the zip files finished before an error are still written
+    with AsyncIO() as file_io:
+        if queue_path is None:
+            encode_archives(pending_zip_files, skip, pipeline, build_records, file_io, output_directory, output_format, dtype, batch_size, read_ahead)
+        else:
+            lease_archives(queue, worker_id or default_worker_id(), lease_seconds, input_directory, pipeline, build_records, file_io, output_directory, output_format, dtype, batch_size, read_ahead)
+            queue.close()
+    pipeline.close()
+    # the stage timings over the whole run, every zip file included
+    print(pipeline.stats.report())
+    print("Finish process")
+
+
+def add_arguments(parser):
+    parser.add_argument('input_directory', type=str, help='Path to directory containing zip files')
+    parser.add_argument('output_directory', type=str, help='Path to directory where output files will be saved')
+    parser.add_argument('batch_size', type=int, nargs='?', default=None, help='Images per encode_image call (tuned from the measured throughput and free memory when omitted)')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='npy', help='npy writes a vector matrix plus a metadata table per zip file, json the legacy JSON file, both writes both')
+    parser.add_argument('--dtype', choices=DTYPES, default='float16', help='Storage precision of the npy vector matrix')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Worker processes that decode, hash and preprocess images (0 runs everything in the main process)')
+    parser.add_argument('--queue-depth', type=int, default=None, help='Number of ready batches buffered in front of the encoder (defaults to twice the workers)')
+    parser.add_argument('--read-ahead', type=int, default=DEFAULT_READ_AHEAD, help='Number of batches read from the zip files ahead of the decoders')
+    parser.add_argument('--cache', type=str, default=None, help=f'Path of the embedding cache (defaults to {CACHE_FILE_NAME} in the output directory)')
+    parser.add_argument('--no-cache', action='store_true', help='Encode every image without reading or writing the embedding cache')
+    parser.add_argument('--skip-duplicates', type=str, default=None, help='Duplicate report written by dedup.py, the duplicates it lists are not encoded')
+    parser.add_argument('--backend', choices=BACKENDS, default='eager', help='CPU backend of the image encoder')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads of the encoder')
+    parser.add_argument('--interop-threads', type=int, default=None, help='Inter-op threads of the encoder')
+    parser.add_argument('--parity-check', type=int, nargs='?', const=PARITY_IMAGES, default=0, help=f'Compare the backend with the eager model on this many images (defaults to {PARITY_IMAGES}) and stop if their vectors differ')
+    parser.add_argument('--metrics', type=str, default=None, help='Append JSON-lines snapshots of the stage timings and counters to this file, and the latest one in Prometheus format to <file>.prom')
+    parser.add_argument('--metrics-interval', type=float, default=DEFAULT_INTERVAL, help='Seconds between metric snapshots')
+    parser.add_argument('--profile', type=str, default=None, help='Run under cProfile and save the stats to this file')
+    parser.add_argument('--queue', type=str, default=None, help='Work queue shared with other workers on shared storage; the zip files are leased from it one at a time')
+    parser.add_argument('--worker-id', type=str, default=None, help='Name of this worker in the queue (defaults to host-pid)')
+    parser.add_argument('--lease-seconds', type=float, default=DEFAULT_LEASE_SECONDS, help='Seconds after which the lease of a worker that stopped renewing it is handed to another worker')
@@ -0,0 +1,159 @@
+import io
+import os
+import mmap
+import zlib
+import zipfile
+import threading
+import collections
+from zip_builder import read_index, write_index, member_index, index_path
+from zip_stream import IMAGE_EXTENSIONS
+
+DEFAULT_MAX_OPEN = 64 # archives kept open (and mapped) at the same time
+
+
+def load_index(zip_path, write=True):
+    # members of an archive from its <name>.index.json; when the index is
+    # missing or belongs to an older version of the archive it is rebuilt from
+    # the central directory and, if possible, saved for the next time
+    if os.path.exists(index_path(zip_path)):
+        index = read_index(zip_path)
+        if index.get('archive_size') == os.path.getsize(zip_path):
+            return index['members']
+    members = member_index(zip_path, {})
+    if write:
+        try:
+            write_index(zip_path, members)
+        except OSError:
+            pass
+    return members
+
+
+class ArchiveReader:
+    # random access to the members of a set of zip files without extracting
+    # them. Every member is found through the archive index, stored members
+    # are sliced straight out of a memory map of the archive and deflated
+    # members are inflated from the same map. Open archives are kept in a
+    # pool of at most max_open handles.
+    #
+    # Usable as a map-style dataset: len(reader) and reader[i] return
+    # (name, bytes), or (name, transform(image)) when a transform is given.
+    # Handles are not shared across processes, every DataLoader worker opens
+    # its own.
+    #
+    #   reader = ArchiveReader('images-zipped')
+    #   data = reader.read('1234.jpg')
+    def __init__(self, path, extensions=IMAGE_EXTENSIONS, max_open=DEFAULT_MAX_OPEN, transform=None, verify=False):
+        if os.path.isdir(path):
+            self.zip_paths = sorted(os.path.join(root, file) for root, _, files in os.walk(path) for file in files if file.endswith('.zip'))
+        else:
+            self.zip_paths = [path]
+        self.max_open = max(1, max_open)
+        self.transform = transform
+        self.verify = verify
+
+        # (archive position, member) of every member, in archive order; a
+        # name that appears in more than one archive is served from the first
+        self.members = []
+        self.names = {}
+        self.duplicates = 0
+        for archive, zip_path in enumerate(self.zip_paths):
+            for member in load_index(zip_path):
+                if extensions and not member['name'].lower().endswith(extensions):
+                    continue
+                if member['name'] in self.names:
+                    self.duplicates += 1
+                    continue
+                self.names[member['name']] = len(self.members)
+                self.members.append((archive, member))
+
+        self._handles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_handles'] = collections.OrderedDict()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __getitem__(self, index):
+        archive, member = self.members[index]
+        data = self._read(archive, member)
+        if self.transform is None:
+            return member['name'], data
+        from PIL import Image
+        image = Image.open(io.BytesIO(data)).convert('RGB')
+        return member['name'], self.transform(image)
+
+    def _map(self, archive):
+        # memory map of an archive from the pool, least recently used
+        # archives are closed once more than max_open are open
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked copy must not use the maps of its parent
+                self._handles = collections.OrderedDict()
+                self._pid = os.getpid()
+            if archive in self._handles:
+                self._handles.move_to_end(archive)
+                return self._handles[archive][1]
+            f = open(self.zip_paths[archive], 'rb')
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._handles[archive] = (f, mapped)
+            while len(self._handles) > self.max_open:
+                _, (old_file, old_map) = self._handles.popitem(last=False)
+                old_map.close()
+                old_file.close()
+            return mapped
+
+    def _read(self, archive, member):
+        mapped = self._map(archive)
+        start = member['offset']
+        raw = mapped[start:start + member['compressed_size']]
+        if member['compress_type'] == zipfile.ZIP_STORED:
+            data = raw
+        elif member['compress_type'] == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(raw, -zlib.MAX_WBITS)
+        else:
+            with zipfile.ZipFile(self.zip_paths[archive]) as zip_file:
+                data = zip_file.read(member['name'])
+        if self.verify and zlib.crc32(data) != member['crc32']:
+            raise IOError(f"CRC mismatch for {member['name']} in {self.zip_paths[archive]}")
+        return data
+
+    def read(self, name):
+        return self._read(*self.members[self.names[name]])
+
+    def read_batch(self, names):
+        # reads the members of every archive in offset order, so a batch
+        # touches each archive sequentially; results are in the order of names
+        members = [self.members[self.names[name]] for name in names]
+        order = sorted(range(len(members)), key=lambda i: (members[i][0], members[i][1]['offset']))
+        results = [None] * len(members)
+        for i in order:
+            results[i] = self._read(*members[i])
+        return results
+
+    def close(self):
+        if self._lock is None:
+            return
+        with self._lock:
+            for f, mapped in self._handles.values():
+                mapped.close()
+                f.close()
+            self._handles.clear()
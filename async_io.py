@@ -0,0 +1,151 @@
+import os
+import time
+import asyncio
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+
+# an asyncio event loop on a background thread that the stages hand their
+# file reads and writes to, so reading the next files, computing on the
+# current batch and writing finished outputs run at the same time:
+#   reads   read_files() reads up to read_ahead files ahead of the consumer,
+#           at most readers of them at once
+#   writes  submit() runs a write in the background and makes the caller
+#           wait while max_pending writes are unfinished, at most writers of
+#           them at once
+# The blocking calls run on a thread pool, the loop schedules them and its
+# semaphores bound how many run at once. File I/O, zlib and numpy release
+# the GIL, so they run next to the encoder.
+#
+#   with AsyncIO() as io:
+#       for path, data in io.read_files(paths):
+#           io.submit(write_file, output_path, compute(data))
+#
+# Writes that must happen in order (the journal appends) stay synchronous.
+DEFAULT_READERS = 8 # files read at once
+DEFAULT_WRITERS = 2 # writes run at once
+DEFAULT_READ_AHEAD = 32 # files read ahead of the consumer
+DEFAULT_MAX_PENDING = 4 # unfinished writes before submit() waits
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def write_file(path, data):
+    # replaced in one step, a crash never leaves half a file behind
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(f'{path}.tmp', path)
+
+
+class AsyncIO:
+    def __init__(self, readers=DEFAULT_READERS, writers=DEFAULT_WRITERS, read_ahead=DEFAULT_READ_AHEAD, max_pending=DEFAULT_MAX_PENDING):
+        self.read_ahead = max(1, read_ahead)
+        self.loop = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max(1, readers) + max(1, writers), thread_name_prefix='async-io')
+        self.loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+        # backpressure on the threads that submit writes
+        self._pending = threading.BoundedSemaphore(max(1, max_pending))
+        self._writes = []
+
+        async def semaphores():
+            return asyncio.Semaphore(max(1, readers)), asyncio.Semaphore(max(1, writers))
+        self._read_slots, self._write_slots = self._schedule(semaphores()).result()
+
+    def _schedule(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def _run(self, slots, name, function, args):
+        async with slots:
+            start = time.perf_counter()
+            try:
+                return await self.loop.run_in_executor(None, function, *args)
+            finally:
+                metrics.observe(name, time.perf_counter() - start)
+
+    async def read(self, path, read=read_file):
+        # for coroutines running on the loop
+        return await self._run(self._read_slots, 'io_read_seconds', read, (path,))
+
+    async def write(self, function, *args):
+        return await self._run(self._write_slots, 'io_write_seconds', function, args)
+
+    def read_files(self, paths, read=read_file):
+        # yields (path, data) in the order of paths; read(path) runs on the
+        # pool. Reads the consumer did not get to are cancelled
+        futures = collections.deque()
+        try:
+            for path in paths:
+                futures.append((path, self._schedule(self.read(path, read))))
+                if len(futures) >= self.read_ahead:
+                    yield self._result(*futures.popleft())
+            while futures:
+                yield self._result(*futures.popleft())
+        finally:
+            for _, future in futures:
+                future.cancel()
+
+    def _result(self, path, future):
+        # io_wait_seconds is the time the consumer waited on a read
+        start = time.perf_counter()
+        data = future.result()
+        metrics.observe('io_wait_seconds', time.perf_counter() - start)
+        metrics.count('io_read_files')
+        return path, data
+
+    def submit(self, function, *args):
+        # runs function(*args) in the background and returns its future. An
+        # error of an earlier write is raised here or by flush()
+        self._check()
+        start = time.perf_counter()
+        self._pending.acquire()
+        metrics.observe('io_blocked_seconds', time.perf_counter() - start)
+        future = self._schedule(self.write(function, *args))
+        future.add_done_callback(lambda _: self._pending.release())
+        self._writes.append(future)
+        return future
+
+    def _check(self, wait=False):
+        writes = self._writes
+        self._writes = []
+        error = None
+        for future in writes:
+            if wait or future.done():
+                exception = future.exception()
+                if exception is not None and error is None:
+                    error = exception
+            else:
+                self._writes.append(future)
+        if error is not None:
+            raise error
+
+    def flush(self):
+        # waits for every submitted write
+        self._check(wait=True)
+
+    def close(self, raise_errors=True):
+        # waits for the writes and stops the loop. With raise_errors=False an
+        # error of a write is dropped, so it does not replace one that is
+        # already propagating
+        try:
+            try:
+                self.flush()
+            except Exception:
+                if raise_errors:
+                    raise
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self.loop.close()
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(raise_errors=exc_type is None)
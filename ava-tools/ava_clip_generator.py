@@ -1,10 +1,21 @@
+import io
 import os
-import torch
-import open_clip
-import pandas as pd
+import sys
+import contextlib
 from PIL import Image, ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# make the shared modules in the repository root importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from embedding_cache import EmbeddingCache, CACHE_FILE_NAME
+from embedding_journal import EmbeddingJournal, JOURNAL_SUFFIX
+from dedup import load_skip_set
+from clip_backend import load_backend, load_sample, ensure_parity, cache_tag
+from clip_pipeline import EncodePipeline, DEFAULT_WORKERS, DEFAULT_BATCH_SIZE
+from manifest import ensure_manifest, group_by_directory, changed_directories, load_snapshot, write_manifest
+from metrics import metrics, recording, DEFAULT_INTERVAL
+from async_io import AsyncIO, read_file
+
 MODEL_NAME = 'ViT-L-14'
 PRETRAINED = 'laion2b_s32b_b82k'
 ALLOWED_EXTENSIONS = ['jpg', 'png']
@@ -15,97 +26,329 @@ IMAGES_DIR = 'images-sorted' # directory that contains the sorted images
 # SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__)) # use the dataset is in the same directory as the script
 SCRIPT_DIR = os.getcwd() # use this if dataset is in the current working directory
 
-IMAGE_DIR = os.path.join(SCRIPT_DIR, IMAGES_DIR)
 INDENT = 1 # indent level for the JSON file
+USE_CACHE = True # reuse vectors of images whose FileHash was already encoded
+CACHE_PATH = os.path.join(SCRIPT_DIR, CACHE_FILE_NAME)
+RESUME = True # continue an interrupted run from its journals and finished directories
+JOURNAL_EVERY = 64 # number of images committed to the journal at once
+INCREMENTAL = True # only embed the directories whose images changed since the last run
+# manifest of the sorted images as they were when the vectors were last generated
+STATE_PATH = os.path.join(SCRIPT_DIR, 'AVA-clip-manifest.csv')
+# duplicate report written by dedup.py, the duplicates it lists are not embedded
+DUPLICATES_REPORT = None
+# CPU backend of the image encoder: eager, bf16, int8, torchscript, compile or onnx
+BACKEND = 'eager'
+THREADS = None # intra-op threads of the encoder, None keeps the torch default
+INTEROP_THREADS = None # inter-op threads of the encoder
+PARITY_IMAGES = 32 # images the backend is compared with the eager model on, 0 skips the check
+BATCH_SIZE = None # images per encode_image call, None tunes it from the measured throughput and free memory
+READ_BATCH = DEFAULT_BATCH_SIZE # images read and decoded together
+DECODE_WORKERS = DEFAULT_WORKERS # processes that decode and preprocess the images, 0 does it in this process
+# JSON-lines snapshots of the stage timings and counters, the latest one is also
+# written in Prometheus format to METRICS_PATH + '.prom'; None records nothing
+METRICS_PATH = None
+METRICS_INTERVAL = DEFAULT_INTERVAL # seconds between snapshots
+PROFILE_PATH = None # run under cProfile and save the stats here
 
 # path for ava.json
 AVA_PATH = os.path.join(SCRIPT_DIR, 'AVA.json')
-# read AVA.json into a dataframe
-df = pd.read_json(AVA_PATH, orient='records')
-df['ClipModel'] = MODEL_NAME
-df['ClipPretrained'] = PRETRAINED
-df['ClipVectorSize'] = None
-df['ClipVector'] = None
-# set the index to the ImageId
-df.set_index('ImageId', inplace=True, drop=False)
-# sort the dataframe by the index
-df.sort_index(inplace=True)
-
-
-model, _, preprocess = open_clip.create_model_and_transforms(model_name=MODEL_NAME, pretrained=PRETRAINED)
-tokenizer = open_clip.get_tokenizer(MODEL_NAME)
-
-if torch.cuda.is_available():
-    device = 'cuda'
-else:
-    device = 'cpu'
-    print('CUDA is not available. Using CPU instead.')
-
-model = model.to(device)
-
-# function to generate the embeddings
-def generate_embeddings(file_name,dir_name):
-    with torch.no_grad():
-        image = preprocess(Image.open(os.path.join(IMAGE_DIR, dir_name, file_name))).unsqueeze(0).to(device)
-        emb = model.encode_image(image).cpu().detach().numpy()
-    return emb
-
-# iterate through the directories
-directories = os.listdir(IMAGES_DIR)
-directories = sorted(directories)
-print(f'Total number of directories: {len(directories)}')
-end = '\n' if DEBUG else '\r'
-for directory in directories:
-    print(f'Processing directory: {directory}')
-    # iterate through the files in the directory
-    files = os.listdir(os.path.join(IMAGES_DIR, directory))
-    total_files = len(files)
-    # remove json files
-    files = [file for file in files if file.split('.')[-1] in ALLOWED_EXTENSIONS]
-    # sort the files by name
-    files = sorted(files, key=lambda x: int(x.split('.')[0]))
-    # create an empty dataframe
-    df_new = pd.DataFrame(columns=df.columns)
-
-    for index, file in enumerate(files):
-        # check file extension
-        ext = file.split('.')[-1]
-        if ext not in ALLOWED_EXTENSIONS:
-            continue
-
-        # print the progress
-        print(f"Processing {file} {index+1}/{total_files}", end=end)
-
-        # try to open the image
-        try:
-            # check if the image is corrupt
-            img = Image.open(os.path.join(IMAGE_DIR, directory, file))
-            img.verify()
-        except:
-            # skip the image if it is corrupt
-            print(f"Error: {file} is corrupt. Skipping...")
-            continue
-        
-        # generate the embeddings
-        emb = generate_embeddings(file, directory)
-
-        # get the image id
-        image_id = int(file.split('.')[0])
-
-        # insert clip vector into the dataframe
-        df.at[image_id, 'ClipVectorSize'] = emb.shape
-        df.at[image_id, 'ClipVector'] = emb.tolist()
-
-        # append the row to the new dataframe
-        df_new = pd.concat([df_new, df.loc[[image_id]]])
-
-    # save the dataframe to a json file
-    path = os.path.join(IMAGES_DIR, directory, directory)
-    df_new.to_json(f'{path}-clip.json', orient='records', indent=INDENT)
-
-# remove the existing clip.json file
-if os.path.exists('AVA-clip.json'):
-    os.remove('AVA-clip.json')
-
-# save the dataframe to a json file
-df.to_json('AVA-clip.json', orient='records', indent=INDENT)
+
+
+# adds the clip vectors to the JSON files of every directory of images_dir and
+# writes AVA-clip.json; the defaults are the settings above
+def main(images_dir=IMAGES_DIR, backend=BACKEND, threads=THREADS, interop_threads=INTEROP_THREADS, parity_images=PARITY_IMAGES, batch_size=BATCH_SIZE, decode_workers=DECODE_WORKERS, use_cache=USE_CACHE, resume=RESUME, incremental=INCREMENTAL, duplicates_report=DUPLICATES_REPORT, metrics_path=METRICS_PATH, profile_path=PROFILE_PATH):
+    import torch
+    import open_clip
+    import pandas as pd
+
+    image_dir = os.path.join(SCRIPT_DIR, images_dir)
+
+    # read AVA.json into a dataframe; ids and counts are null for the images
+    # without a row in AVA.txt
+    df = pd.read_json(AVA_PATH, orient='records', dtype={'Index': 'Int64', 'ScoreCount': 'Int64'})
+    df['ClipModel'] = MODEL_NAME
+    df['ClipPretrained'] = PRETRAINED
+    df['ClipVectorSize'] = None
+    df['ClipVector'] = None
+    # set the index to the ImageId
+    df.set_index('ImageId', inplace=True, drop=False)
+    # sort the dataframe by the index
+    df.sort_index(inplace=True)
+
+    # metric snapshots and the profile cover everything from loading the model
+    # on; the cache and the decode workers are closed on the way out, also
+    # after an error
+    with recording(metrics_path, METRICS_INTERVAL, profile_path), contextlib.ExitStack() as resources:
+        model, _, preprocess = open_clip.create_model_and_transforms(model_name=MODEL_NAME, pretrained=PRETRAINED)
+
+        if torch.cuda.is_available():
+            device = 'cuda'
+        else:
+            device = 'cpu'
+            print('CUDA is not available. Using CPU instead.')
+
+        model = model.to(device)
+        model.eval()
+        # the model that encodes the images, the eager model itself unless backend says otherwise
+        encoder = load_backend(model, backend, device, threads, interop_threads)
+        if backend != 'eager' and parity_images:
+            ensure_parity(model, encoder, load_sample(image_dir, preprocess, parity_images))
+
+        cache = EmbeddingCache(CACHE_PATH, MODEL_NAME, cache_tag(PRETRAINED, backend)) if use_cache else None
+        if cache is not None:
+            resources.callback(cache.close)
+
+        duplicates = set()
+        if duplicates_report:
+            _, duplicates = load_skip_set(duplicates_report)
+            print(f'Skipping {len(duplicates)} duplicate images listed in {duplicates_report}')
+
+        # set the clip vectors of a group of images with one assignment per column
+        # instead of a row update per image
+        def set_clip_vectors(image_ids, sizes, vectors):
+            df.loc[image_ids, 'ClipVectorSize'] = pd.Series(sizes, index=image_ids, dtype=object)
+            df.loc[image_ids, 'ClipVector'] = pd.Series(vectors, index=image_ids, dtype=object)
+
+        # list the directories and files through the manifest of the sorted tree
+        image_entries = ensure_manifest(image_dir, extensions=ALLOWED_EXTENSIONS)
+        manifest = group_by_directory(image_entries)
+
+        # sorted images without a row in AVA.json (added after it was written)
+        # still get their vectors, in a row of their own
+        df_files = pd.DataFrame([{'ImageId': int(os.path.basename(entry['path']).split('.')[0]), 'FileHash': entry['sha256'], 'FileName': os.path.basename(entry['path'])}
+                                 for directory, entries in manifest.items() if directory for entry in entries],
+                                columns=['ImageId', 'FileHash', 'FileName'])
+        df_missing = df_files[~df_files['ImageId'].isin(df.index)].drop_duplicates('ImageId')
+        if len(df_missing):
+            df_missing = df_missing.assign(ClipModel=MODEL_NAME, ClipPretrained=PRETRAINED, ClipVectorSize=None, ClipVector=None)
+            df = pd.concat([df, df_missing.set_index('ImageId', drop=False)]).sort_index()
+
+        # directories with an added, changed or removed image are embedded again
+        # even when their clip JSON exists; unchanged images still come from the cache
+        changed = None
+        if incremental and os.path.exists(STATE_PATH):
+            changed = changed_directories(load_snapshot(STATE_PATH), image_entries)
+
+        # reads an image and checks if it is corrupt, on the threads of file_io
+        def read_image(item):
+            job, file = item
+            image_data = read_file(os.path.join(image_dir, job['directory'], file))
+            try:
+                Image.open(io.BytesIO(image_data)).verify()
+            except Exception:
+                return image_data, False
+            return image_data, True
+
+        # read the images that still need a vector, READ_BATCH at a time and
+        # across directory boundaries, so the encoder always gets full batches.
+        # The next images are read while the current batches are encoded.
+        # Corrupt images are journaled here and never reach the encoder
+        def read_batches(jobs):
+            job = None
+            names = []
+            batch_data = []
+            items = ((job, file) for job in jobs for file in job['todo'])
+            for (item_job, file), (image_data, valid) in file_io.read_files(items, read_image):
+                if item_job is not job:
+                    if names:
+                        yield (job, names), batch_data
+                    job = item_job
+                    names = []
+                    batch_data = []
+                if not valid:
+                    # skip the image if it is corrupt
+                    print(f"Error: {file} is corrupt. Skipping...")
+                    job['corrupt'].add(file)
+                    job['pending_errors'].append((job['positions'][file], file, 'corrupt'))
+                    continue
+                names.append(file)
+                batch_data.append(image_data)
+                if len(names) == READ_BATCH:
+                    yield (job, names), batch_data
+                    names = []
+                    batch_data = []
+            if names:
+                yield (job, names), batch_data
+
+        # commit the vectors and corrupt files of a directory waiting in memory to its journal
+        def commit(job):
+            job['journal'].append(job['pending_records'], job['pending_vectors'], job['pending_errors'])
+            if cache is not None:
+                cache.put_many(job['new_vectors'])
+            job['pending_records'].clear()
+            job['pending_vectors'].clear()
+            job['pending_errors'].clear()
+            job['new_vectors'].clear()
+
+        # write the clip JSON of a directory once all its images have a vector
+        def finish(job):
+            if job['pending_records'] or job['pending_errors']:
+                commit(job)
+
+            # ids and vectors of the directory in file order
+            image_ids = []
+            embeddings = []
+            for file in job['files']:
+                if file in job['corrupt'] or file in duplicates:
+                    continue
+                image_id = int(file.split('.')[0])
+                if image_id in job['journaled']:
+                    emb = job['journaled'][image_id].reshape(1, -1)
+                elif file in job['encoded']:
+                    emb = job['encoded'][file]
+                else:
+                    emb = job['cached'][job['hashes'][file]].reshape(1, -1)
+                image_ids.append(image_id)
+                embeddings.append(emb)
+
+            # insert the clip vectors into the dataframe and select the rows of the
+            # directory in one go
+            set_clip_vectors(image_ids, [emb.shape for emb in embeddings], [emb.tolist() for emb in embeddings])
+            df_new = df.loc[image_ids]
+            if cache is not None:
+                print(f"{len(job['cached'])} vectors of {job['directory']} served from the embedding cache")
+
+            # save the dataframe to a json file in the background, while the next
+            # directory is encoded
+            file_io.submit(write_clip_json, df_new, job['clip_json_path'], job['journal'])
+
+        # the clip JSON is renamed into place before the journal is removed so a
+        # crash in between still resumes correctly
+        def write_clip_json(df_new, clip_json_path, journal):
+            df_new.to_json(f'{clip_json_path}.tmp', orient='records', indent=INDENT)
+            os.replace(f'{clip_json_path}.tmp', clip_json_path)
+            journal.remove()
+
+        # iterate through the directories
+        directories = [directory for directory in manifest if directory]
+        directories = sorted(directories)
+        print(f'Total number of directories: {len(directories)}')
+        end = '\n' if DEBUG else '\r'
+        # directories that still need vectors, in order, with the vectors that are
+        # already known from their journal and the cache
+        jobs = []
+        for directory in directories:
+            print(f'Processing directory: {directory}')
+            # iterate through the files in the directory
+            files = [os.path.basename(entry['path']) for entry in manifest[directory]]
+            # the hashes of the files, from the manifest
+            hashes = {os.path.basename(entry['path']): entry['sha256'] for entry in manifest[directory]}
+            # remove json files
+            files = [file for file in files if file.split('.')[-1] in ALLOWED_EXTENSIONS]
+            # sort the files by name
+            files = sorted(files, key=lambda x: int(x.split('.')[0]))
+            path = os.path.join(images_dir, directory, directory)
+            clip_json_path = f'{path}-clip.json'
+            journal = EmbeddingJournal(f'{path}-clip{JOURNAL_SUFFIX}')
+            if not resume:
+                journal.remove()
+
+            # a directory whose clip JSON exists without a journal was finished by an
+            # earlier run, only its vectors are needed for AVA-clip.json.
+            # A full run embeds every directory again. An incremental run keeps the
+            # unchanged ones, and all of them before there is a manifest of a
+            # completed run, so an interrupted first run resumes where it stopped
+            finished = incremental and (changed is None or directory not in changed)
+            if resume and finished and os.path.exists(clip_json_path) and not journal.exists():
+                df_done = pd.read_json(clip_json_path, orient='records')
+                set_clip_vectors(df_done['ImageId'].tolist(), [tuple(size) for size in df_done['ClipVectorSize']], df_done['ClipVector'].tolist())
+                print(f'{directory} already has {len(df_done)} vectors. Skipping...')
+                continue
+
+            # images committed to the journal by an interrupted run are not encoded again
+            records, errors, vectors = journal.recover()
+            journaled = {record['ImageId']: vector for record, vector in zip(records, vectors)}
+            corrupt = {error[1] for error in errors}
+            if journaled or corrupt:
+                print(f'Resuming {directory} after {len(journaled) + len(corrupt)} journaled images')
+
+            # look up the vectors of this directory by the hashes of the manifest
+            cached = {}
+            if cache is not None:
+                cached = cache.get_many([hashes[file] for file in files])
+
+            todo = []
+            for file in files:
+                image_id = int(file.split('.')[0])
+                if file in corrupt or file in duplicates or image_id in journaled:
+                    continue
+                if cache is not None and hashes[file] in cached:
+                    continue
+                todo.append(file)
+
+            jobs.append({
+                'directory': directory,
+                'files': files,
+                'positions': {file: index for index, file in enumerate(files)},
+                'hashes': hashes,
+                'todo': todo,
+                'clip_json_path': clip_json_path,
+                'journal': journal,
+                'journaled': journaled,
+                'corrupt': corrupt,
+                'cached': cached,
+                'encoded': {},
+                # vectors and corrupt files waiting to be committed to the journal
+                'pending_records': [],
+                'pending_vectors': [],
+                'pending_errors': [],
+                'new_vectors': [],
+            })
+
+        # decode and preprocess in worker processes and encode in batches that run
+        # across directories; a directory is written as soon as its last image is back
+        total_images = sum(len(job['todo']) for job in jobs)
+        encoded_images = 0
+        remaining = iter(jobs)
+        job = None
+        pipeline = EncodePipeline(encoder, preprocess, device, decode_workers, batch_size=batch_size)
+        resources.callback(pipeline.close)
+        with AsyncIO() as file_io:
+            for (batch_job, names), prepared, vectors in pipeline.run(read_batches(jobs)):
+                # the directories before this one are complete, including those whose
+                # images all came from the journal or the cache
+                while job is not batch_job:
+                    if job is not None:
+                        finish(job)
+                    job = next(remaining)
+
+                for idx, vector in zip(prepared['ok'], vectors):
+                    file = names[idx]
+                    image_id = int(file.split('.')[0])
+                    emb = vector.reshape(1, -1)
+                    job['encoded'][file] = emb
+                    job['pending_records'].append({'ImageId': image_id, 'FileName': file})
+                    job['pending_vectors'].append(vector)
+                    file_hash = job['hashes'][file] if cache is not None else None
+                    if file_hash:
+                        job['new_vectors'].append((file_hash, emb))
+                for idx, error in prepared['errors']:
+                    print(f"Error: {names[idx]} is corrupt. Skipping...")
+                    job['corrupt'].add(names[idx])
+                    job['pending_errors'].append((job['positions'][names[idx]], names[idx], error))
+                if len(job['pending_records']) >= JOURNAL_EVERY:
+                    commit(job)
+
+                # print the progress
+                encoded_images += len(names)
+                print(f"Processing {job['directory']} {encoded_images}/{total_images} (batch size {pipeline.sizer.size})", end=end)
+
+            pipeline.close()
+            if job is not None:
+                finish(job)
+            for job in remaining:
+                finish(job)
+        if total_images:
+            print(pipeline.stats.report())
+
+        # save the dataframe to a json file, replacing the existing AVA-clip.json
+        with metrics.timer('write_seconds', format='json'):
+            df.to_json('AVA-clip.json.tmp', orient='records', indent=INDENT)
+            os.replace('AVA-clip.json.tmp', 'AVA-clip.json')
+
+        # remember which images the vectors were generated from
+        write_manifest(STATE_PATH, image_entries)
+
+
+if __name__ == "__main__":
+    main()
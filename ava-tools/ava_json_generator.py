@@ -1,7 +1,10 @@
 import os
-import json
-import hashlib
-import pandas as pd
+import sys
+
+# make the shared modules in the repository root importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from async_io import AsyncIO
+from manifest import ensure_manifest, group_by_directory, changed_directories, load_snapshot, write_manifest
 
 # set the directory paths
 IMAGES_DIR = 'images-sorted'
@@ -10,114 +13,155 @@ SCRIPT_DIR = os.getcwd() # use this if dataset is in the current working directo
 ALLOWED_EXTENSIONS = ['jpg', 'png']
 # set INDENT to None to create a single line JSON file
 INDENT = 1
+# only rewrite the JSON files of directories whose images changed since the last run
+INCREMENTAL = True
 
 # ava txt path
 AVA_TXT_PATH = os.path.join(SCRIPT_DIR, 'AVA.txt')
-# Read in the data
-df = pd.read_csv(AVA_TXT_PATH, sep=' ',header=None)
-
-# list of column names
-COL_NAMES = ['Index', 'ImageId', '1', '2', '3', '4', '5', '6', '7','8','9','10','SemanticTag_1','SemanticTag_2','ChallengeId']
-
-# set the column names
-df.columns = COL_NAMES
-
-# add an empty column for the image hash
-df['FileHash'] = ''
-# add an empty column for the image file name
-df['FileName'] = ''
-# add ScoreCount column
-df['ScoreCount'] = df.loc[:, '1':'10'].sum(axis=1)
-# add a dictionary column for the for image ratings
-df['ScoreDictionary'] = df.loc[:, '1':'10'].to_dict(orient='records')
-# drop the columns for the image ratings
-df.drop(df.loc[:, '1':'10'], axis=1, inplace=True)
-# drop the columns for the semantic tags and challenge id
-df.drop(df.loc[:, 'SemanticTag_1':'ChallengeId'], axis=1, inplace=True)
-
-# set the index to the ImageId
-df.set_index('ImageId', inplace=True, drop=False)
-
-# sort the dataframe by the index
-df.sort_index(inplace=True)
-
-naming_convention = 'dataset-ava'
-
-# create an empty dataframe
-df_new = pd.DataFrame(columns=df.columns)
-
-# iterate through the directories
-directories = os.listdir(IMAGES_DIR)
-# sort the directories
-directories = sorted(directories)
-print(f'Total number of directories: {len(directories)}')
-
-for directory in directories:
-    print(f'Processing directory: {directory}')
-    # iterate through the files in the directory
-    files = os.listdir(os.path.join(IMAGES_DIR, directory))
-    # remove files other than images
-    files = [file for file in files if file.split('.')[-1] in ALLOWED_EXTENSIONS]
-    # sort the files
-    files = sorted(files, key=lambda x: int(x.split('.')[0]))
-    total_files = len(files)
-
-    # create an empty dataframe
-    df_new = pd.DataFrame(columns=df.columns)
-
-    for index, file in enumerate(files):
-
-        # check the file type
-        if file.lower().endswith('json'):
-            # remove the json file
-            os.remove(os.path.join(IMAGES_DIR, directory, file))
-            continue
-
-        # print the progress
-        print(f"Processing {file} {index+1}/{total_files}", end='\r')
-
-        # read in the file
-        path = os.path.join(IMAGES_DIR, directory, file)
-        with open(path, 'rb') as f:
-            img = f.read()
-
-        # calculate the hash
-        hash = hashlib.sha256(img).hexdigest()
-
-        # get the image id
-        image_id = int(file.split('.')[0])
-
-        # insert the hash and file name into the dataframe
-        df.loc[image_id, 'FileHash'] = hash
-        df.loc[image_id, 'FileName'] = file
-
-        # append the row to the new dataframe
-        df_new = pd.concat([df_new, df.loc[[image_id]]])
+# manifest of the sorted images as they were when the JSON files were last written
+STATE_PATH = os.path.join(SCRIPT_DIR, 'AVA-json-manifest.csv')
+
+
+# writes the JSON file of every directory of images_dir and AVA.json from the
+# AVA table; the defaults are the settings above
+def main(images_dir=IMAGES_DIR, ava_txt_path=AVA_TXT_PATH, incremental=INCREMENTAL):
+    import pandas as pd
+
+    # Read in the data
+    df = pd.read_csv(ava_txt_path, sep=' ',header=None)
+
+    # list of column names
+    COL_NAMES = ['Index', 'ImageId', '1', '2', '3', '4', '5', '6', '7','8','9','10','SemanticTag_1','SemanticTag_2','ChallengeId']
+
+    # set the column names
+    df.columns = COL_NAMES
+
+    # add an empty column for the image hash
+    df['FileHash'] = ''
+    # add an empty column for the image file name
+    df['FileName'] = ''
+    # add ScoreCount column
+    df['ScoreCount'] = df.loc[:, '1':'10'].sum(axis=1)
+    # nullable integers, so the images without a row in AVA.txt get null
+    # fields while the AVA rows keep integer ids and counts
+    df['Index'] = df['Index'].astype('Int64')
+    df['ScoreCount'] = df['ScoreCount'].astype('Int64')
+    # add a dictionary column for the for image ratings
+    df['ScoreDictionary'] = df.loc[:, '1':'10'].to_dict(orient='records')
+    # drop the columns for the image ratings
+    df.drop(df.loc[:, '1':'10'], axis=1, inplace=True)
+    # drop the columns for the semantic tags and challenge id
+    df.drop(df.loc[:, 'SemanticTag_1':'ChallengeId'], axis=1, inplace=True)
 
     # set the index to the ImageId
-    df_new.set_index('ImageId', inplace=True, drop=False)
-
-    # save the dataframe to a json file
-    path = os.path.join(SCRIPT_DIR, IMAGES_DIR, directory, directory)
-    df_new.to_json(f'{path}.json', orient='records', indent=INDENT)
-
-# write the AVA dataframe to a json file with the image hashes
-df_found = df[df['FileHash'] != '']
-
-# if JSON file already exists, remove it
-path = os.path.join(SCRIPT_DIR, 'AVA.json')
-if os.path.exists(path):
-    os.remove(path)
-
-df_found.to_json(path, orient='records', indent=INDENT)
-# write error.txt
-df_not_found = df[df['FileHash'] == '']
-
-# if error.txt already exists, remove it
-path = os.path.join(SCRIPT_DIR, 'errors.txt')
-if os.path.exists(path):
-    os.remove(path)
-
-print(f'{len(df_not_found)} images not found and written to errors.txt')
-with open(path, 'w') as f:
-    f.write(df_not_found.loc[:, ['Index', 'ImageId']].to_string(header=True, index=False))
+    df.set_index('ImageId', inplace=True, drop=False)
+
+    # sort the dataframe by the index
+    df.sort_index(inplace=True)
+
+    # (ImageId, FileName, FileHash) rows of every directory, joined with the AVA
+    # table once at the end instead of updating it row by row
+    found_frames = []
+    # AVA columns without the ones filled in from the files
+    df_ava = df.drop(columns=['FileHash', 'FileName']).reset_index(drop=True)
+
+    # list and hash the images through the manifest of the sorted tree; files
+    # are only read again when their size or mtime changed
+    print('Updating the image manifest...')
+    image_entries = ensure_manifest(images_dir, extensions=ALLOWED_EXTENSIONS)
+    manifest = group_by_directory(image_entries)
+
+    # the JSON files of a directory are kept when none of its images changed;
+    # a new AVA.txt changes every directory
+    changed = None
+    if incremental and os.path.exists(STATE_PATH) and os.path.getmtime(STATE_PATH) >= os.path.getmtime(ava_txt_path):
+        changed = changed_directories(load_snapshot(STATE_PATH), image_entries)
+
+    # iterate through the directories
+    directories = [directory for directory in manifest if directory]
+    # sort the directories
+    directories = sorted(directories)
+    print(f'Total number of directories: {len(directories)}')
+
+    # the JSON files are written in the background while the next directories
+    # are joined
+    def write_json(df_new, path):
+        df_new.to_json(path, orient='records', indent=INDENT)
+
+    with AsyncIO() as file_io:
+        for directory in directories:
+            print(f'Processing directory: {directory}')
+            # the files in the directory with their hashes
+            entries = {os.path.basename(entry['path']): entry['sha256'] for entry in manifest[directory]}
+            # remove files other than images
+            files = [file for file in entries if file.split('.')[-1] in ALLOWED_EXTENSIONS]
+            # sort the files
+            files = sorted(files, key=lambda x: int(x.split('.')[0]))
+
+            # collect the file listing and hashes into columns first
+            hashes = [entries[file] for file in files]
+
+            df_files = pd.DataFrame({
+                'ImageId': [int(file.split('.')[0]) for file in files],
+                'FileHash': hashes,
+                'FileName': files,
+            })
+            found_frames.append(df_files)
+
+            path = os.path.join(SCRIPT_DIR, images_dir, directory, directory)
+            if changed is not None and directory not in changed and os.path.exists(f'{path}.json'):
+                print(f'{directory} is unchanged. Skipping...')
+                continue
+
+            # a single join of the directory against the AVA table, in file
+            # order; images without a row in AVA.txt get empty AVA fields
+            df_new = df_files.merge(df_ava, on='ImageId', how='left')
+            df_new = df_new[df.columns]
+
+            # set the index to the ImageId
+            df_new.set_index('ImageId', inplace=True, drop=False)
+
+            # save the dataframe to a json file
+            file_io.submit(write_json, df_new, f'{path}.json')
+
+    # insert the hashes and file names of all directories into the AVA dataframe
+    if found_frames:
+        df_found_files = pd.concat(found_frames, ignore_index=True).drop_duplicates('ImageId', keep='last').set_index('ImageId')
+        df['FileHash'] = df['ImageId'].map(df_found_files['FileHash']).fillna('')
+        df['FileName'] = df['ImageId'].map(df_found_files['FileName']).fillna('')
+        # the images without a row in AVA.txt go after the AVA rows, in the
+        # order they were found
+        found_ids = pd.concat(found_frames, ignore_index=True)['ImageId']
+        unknown_ids = found_ids[~found_ids.isin(df.index)].drop_duplicates()
+        if len(unknown_ids):
+            df_unknown = df_found_files.loc[unknown_ids, ['FileHash', 'FileName']].reset_index()
+            df_unknown.set_index('ImageId', inplace=True, drop=False)
+            df = pd.concat([df, df_unknown])
+
+    # write the AVA dataframe to a json file with the image hashes
+    df_found = df[df['FileHash'] != '']
+
+    # if JSON file already exists, remove it
+    path = os.path.join(SCRIPT_DIR, 'AVA.json')
+    if os.path.exists(path):
+        os.remove(path)
+
+    df_found.to_json(path, orient='records', indent=INDENT)
+    # write error.txt
+    df_not_found = df[df['FileHash'] == '']
+
+    # if error.txt already exists, remove it
+    path = os.path.join(SCRIPT_DIR, 'errors.txt')
+    if os.path.exists(path):
+        os.remove(path)
+
+    print(f'{len(df_not_found)} images not found and written to errors.txt')
+    with open(path, 'w') as f:
+        f.write(df_not_found.loc[:, ['Index', 'ImageId']].to_string(header=True, index=False))
+
+    # remember which images the JSON files were written from
+    write_manifest(STATE_PATH, image_entries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import io
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageFile
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# metadata is removed from the file bytes, the compressed image data is
+# copied as it is, so pixels and quality stay the same and nothing is decoded
+JPEG_SIGNATURE = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# APP1 (EXIF, XMP), APP12 (Ducky), APP13 (Photoshop IPTC) and comments;
+# APP0 (JFIF), APP2 (ICC profile) and APP14 (Adobe colour transform) are
+# needed to show the image correctly and are kept
+JPEG_DROP_MARKERS = {0xE1, 0xEC, 0xED, 0xFE}
+# markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xD8)}
+PNG_DROP_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'eXIf', b'tIME'}
+DEFAULT_WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 64 # files handed to a worker at once
+
+
+def strip_jpeg(data):
+    # returns data without the metadata segments, raises ValueError when the
+    # segment structure before the image data is broken
+    if not data.startswith(JPEG_SIGNATURE):
+        raise ValueError('not a JPEG file')
+    output = [JPEG_SIGNATURE]
+    pos = 2
+    while True:
+        if pos + 2 > len(data) or data[pos] != 0xFF:
+            raise ValueError(f'invalid JPEG marker at byte {pos}')
+        # markers may be padded with any number of 0xFF bytes
+        while pos + 1 < len(data) and data[pos + 1] == 0xFF:
+            pos += 1
+        if pos + 2 > len(data):
+            raise ValueError('JPEG ends inside a marker')
+        marker = data[pos + 1]
+        if marker == 0xD9:
+            output.append(data[pos:])
+            break
+        if marker in JPEG_STANDALONE_MARKERS:
+            output.append(data[pos:pos + 2])
+            pos += 2
+            continue
+        if pos + 4 > len(data):
+            raise ValueError('JPEG ends inside a segment header')
+        length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        end = pos + 2 + length
+        if length < 2 or end > len(data):
+            raise ValueError(f'invalid JPEG segment length at byte {pos}')
+        if marker not in JPEG_DROP_MARKERS:
+            output.append(data[pos:end])
+        if marker == 0xDA:
+            # start of scan: the compressed data and everything after it is
+            # copied unchanged
+            output.append(data[end:])
+            break
+        pos = end
+    return b''.join(output)
+
+
+def strip_png(data):
+    # returns data without the text, EXIF and time chunks, raises ValueError
+    # when the chunk structure is broken
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError('not a PNG file')
+    output = [PNG_SIGNATURE]
+    pos = len(PNG_SIGNATURE)
+    while True:
+        if pos + 12 > len(data):
+            raise ValueError('PNG ends before IEND')
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        end = pos + 12 + length
+        if end > len(data):
+            raise ValueError(f'invalid PNG chunk length at byte {pos}')
+        if chunk_type not in PNG_DROP_CHUNKS:
+            output.append(data[pos:end])
+        pos = end
+        if chunk_type == b'IEND':
+            break
+    return b''.join(output)
+
+
+def strip_metadata(data):
+    # the format is taken from the file signature, not the extension
+    if data.startswith(JPEG_SIGNATURE):
+        return strip_jpeg(data)
+    if data.startswith(PNG_SIGNATURE):
+        return strip_png(data)
+    raise ValueError('unsupported image format')
+
+
+def remove_all_exif_data(image_path):
+    # fallback for files whose structure can't be parsed: decode and save the
+    # pixels into a new image, which drops every kind of metadata
+    with Image.open(image_path) as img:
+        # Remove all Exif data
+        img_without_exif = Image.new(img.mode, img.size)
+        img_without_exif.putdata(list(img.getdata()))
+
+        # Save the image without Exif data
+        img_without_exif.save(image_path)
+
+
+def strip_file(path):
+    # strips one file in place and returns (status, error); status is
+    # 'stripped', 'clean' (nothing to remove), 'reencoded' or 'corrupt'
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        stripped = strip_metadata(data)
+        # the header has to parse, a broken image is not worth keeping
+        Image.open(io.BytesIO(stripped)).verify()
+    except Exception:
+        try:
+            remove_all_exif_data(path)
+            return 'reencoded', None
+        except Exception as e:
+            return 'corrupt', str(e)
+
+    if len(stripped) == len(data):
+        # leave the file alone so its mtime and hash don't change
+        return 'clean', None
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(stripped)
+    os.replace(f'{path}.tmp', path)
+    return 'stripped', None
+
+
+def strip_files(paths, workers=DEFAULT_WORKERS):
+    # yields (path, status, error) in the order of paths
+    paths = list(paths)
+    if workers <= 1:
+        for path in paths:
+            yield (path, *strip_file(path))
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, result in zip(paths, executor.map(strip_file, paths, chunksize=CHUNK_SIZE)):
+            yield (path, *result)
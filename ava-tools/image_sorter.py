@@ -1,12 +1,28 @@
 import os
+import sys
 import shutil
-from PIL import Image, ImageFile
-ImageFile.LOAD_TRUNCATED_IMAGES = True
+from manifest import scan_tree, diff_manifest, load_snapshot, write_manifest
+from exif_strip import strip_files, DEFAULT_WORKERS
+from shard_planner import plan_shards, write_plan, shard_name, Placer, LINK_METHODS
+
+# make the shared modules in the repository root importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from dedup import load_skip_set
 
 IMAGE_DIR = 'images-extracted'
 OUTPUT_DIR = 'images-sorted'
 ACTION = 'copy' # 'copy' or 'move' the files
 ALLOWED_EXTENSIONS = ['jpg', 'png']
+STRIP_WORKERS = DEFAULT_WORKERS # processes that remove the EXIF data
+DIRECTORY_SIZE = 500000000 # bytes of images after which a directory is closed
+# tried in order before a byte copy when ACTION is 'copy', set to [] to always copy
+PLACE_METHODS = LINK_METHODS
+PLACE_WORKERS = 16 # threads that copy or move the files
+# duplicate report written by dedup.py, the duplicates it lists are not sorted
+DUPLICATES_REPORT = None
+# only sort the files that were added or changed since the last run, the
+# directories that are already sorted stay as they are
+INCREMENTAL = True
 
 
 # SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__)) # use the dataset is in the same directory as the script
@@ -16,116 +32,175 @@ SCRIPT_DIR = os.getcwd() # use this if dataset is in the current working directo
 OUTPUT_DIR = os.path.join(SCRIPT_DIR, OUTPUT_DIR)
 IMAGE_DIR = os.path.join(SCRIPT_DIR, IMAGE_DIR)
 
-# create output directory
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
-else:
-    # remove the directory
-    shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
-
-# create a list of all the files in the directory
-files_all = os.listdir(IMAGE_DIR)
-files_images = []
-
-
-def remove_all_exif_data(image_path):
-    with Image.open(image_path) as img:
-        # Remove all Exif data
-        img_without_exif = Image.new(img.mode, img.size)
-        img_without_exif.putdata(list(img.getdata()))
-        
-        # Save the image without Exif data
-        img_without_exif.save(image_path)
-
-    
-# iterate through the files
-image_count = 0
-
-print("Removing EXIF data from images...")
-for file in files_all:
-    image_count += 1
-    if image_count % 1000 == 0 :
-        print("Images Processed: ", image_count)
-    # get the extension of the file
-    ext = file.split('.')[-1]
-    # check if the extension is allowed
-    if ext not in ALLOWED_EXTENSIONS:
-        print(f'Invalid extension: {file}')
-        continue
-
-    # get the full path of the file
-    path = os.path.join(IMAGE_DIR, file)
- 
-    statfile = os.stat(path)
-    filesize = statfile.st_size
-    if filesize == 0:
-        print("IMAGE SIZE ZERO:",path)
-        continue
-    
-    try: 
-		#remove exif data
-        remove_all_exif_data(path)
-    except Exception as e:
-        print(e)
-        print("IMAGE CORRUPT:",path)
-        continue
-
-    # add the file to the list
-    files_images.append(file)
-
-# sort the files by name
-files = sorted(files_images, key=lambda x: int(x.split('.')[0]))
-
-total_bytes = 0
-start_index = 0
-directory_index = 0
 naming_convention = 'dataset-ava-'
-total_images = len(files)
-action = shutil.copy if ACTION == 'copy' else shutil.move
-print(f'Total number of images: {total_images}')
-
-# iterate through the files
-for index,file in enumerate(files):
-    # print the progress
-    print(f"Processing {file} {index+1}/{total_images}", end='\r')
-    path = os.path.join(IMAGE_DIR, file)
-    # read in the file
-    with open(path, 'rb') as f:
-        img = f.read()
-
-    # get the size of the file
-    size = len(img)
-    total_bytes += size
-
-    # if the total size is greater than 500 MB
-    if total_bytes > 500000000:
-        dir_name = f'{naming_convention}{str(directory_index).zfill(3)}'
-        # create a new directory
-        if not os.path.exists(os.path.join(SCRIPT_DIR, OUTPUT_DIR, dir_name)):
-            os.makedirs(os.path.join(SCRIPT_DIR, OUTPUT_DIR, dir_name))
-
-        for i in range(start_index, index+1):
-            src_path = os.path.join(SCRIPT_DIR, IMAGE_DIR, files[i])
-            dst_path = os.path.join(SCRIPT_DIR, OUTPUT_DIR, dir_name, files[i])
-            action(src_path, dst_path)
-
-        # reset the total size
-        total_bytes = 0
-        # reset the start index
-        start_index = index+1
-        # increment the directory index
-        directory_index += 1
-            
-# check if there are any files left
-if total_bytes > 0:
-    # create a new directory
-    dir_name = f'{naming_convention}{str(directory_index).zfill(3)}'
-    # create a new directory
-    if not os.path.exists(os.path.join(SCRIPT_DIR, OUTPUT_DIR, dir_name)):
-        os.makedirs(os.path.join(SCRIPT_DIR, OUTPUT_DIR, dir_name))
-
-    for i in range(start_index, len(files)):
-        src_path = os.path.join(SCRIPT_DIR, IMAGE_DIR, files[i])
-        dst_path = os.path.join(SCRIPT_DIR, OUTPUT_DIR, dir_name, files[i])
-        action(src_path, dst_path)
+
+
+def stat_entries(image_dir, files):
+    # manifest entries (without hash) of files in the extracted directory
+    entries = {}
+    for file in files:
+        statfile = os.stat(os.path.join(image_dir, file))
+        entries[file] = {'path': file, 'size': statfile.st_size, 'mtime': statfile.st_mtime_ns, 'sha256': ''}
+    return entries
+
+
+# sorts the images of image_dir into directories of about directory_size
+# bytes in output_dir; the defaults are the settings above
+def main(image_dir=IMAGE_DIR, output_dir=OUTPUT_DIR, action=ACTION, directory_size=DIRECTORY_SIZE, strip_workers=STRIP_WORKERS, place_methods=PLACE_METHODS, place_workers=PLACE_WORKERS, duplicates_report=DUPLICATES_REPORT, incremental=INCREMENTAL):
+    # size and mtime of the extracted files as they were when last sorted
+    state_path = f'{os.path.normpath(image_dir)}-sorted.csv'
+    # directory of every file placed by the last run
+    plan_path = f'{os.path.normpath(output_dir)}-plan.csv'
+
+    snapshot = load_snapshot(state_path)
+    incremental = incremental and bool(snapshot) and os.path.exists(output_dir)
+
+    # create output directory
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    elif not incremental:
+        # remove the directory
+        shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+        snapshot = {}
+
+    # create a list of all the files in the directory
+    files_all = os.listdir(image_dir)
+    files_images = []
+    removed = []
+
+    duplicates = set()
+    if duplicates_report:
+        _, duplicates = load_skip_set(duplicates_report)
+        print(f'Skipping {len(duplicates)} duplicate images listed in {duplicates_report}')
+
+    if incremental:
+        # only the files that are new or whose size or mtime changed since they
+        # were sorted are processed again
+        current = {path: {'path': path, 'size': size, 'mtime': mtime, 'sha256': ''}
+                   for path, (size, mtime) in scan_tree(image_dir).items() if '/' not in path}
+        added, changed, removed = diff_manifest(snapshot, current)
+        files_all = added + changed
+        print(f'Incremental run: {len(added)} new, {len(changed)} changed, {len(removed)} removed files')
+
+
+    # iterate through the files
+    image_count = 0
+    files_strip = []
+
+    print("Removing EXIF data from images...")
+    for file in files_all:
+        # get the extension of the file
+        ext = file.split('.')[-1]
+        # check if the extension is allowed
+        if ext not in ALLOWED_EXTENSIONS:
+            print(f'Invalid extension: {file}')
+            continue
+        if file in duplicates:
+            continue
+
+        # get the full path of the file
+        path = os.path.join(image_dir, file)
+
+        statfile = os.stat(path)
+        filesize = statfile.st_size
+        if filesize == 0:
+            print("IMAGE SIZE ZERO:",path)
+            continue
+
+        files_strip.append(file)
+
+    # the metadata is cut out of the file bytes on a pool of processes; files
+    # that can't be parsed are re-encoded instead
+    status_count = {}
+    paths = [os.path.join(image_dir, file) for file in files_strip]
+    for file, (path, status, error) in zip(files_strip, strip_files(paths, strip_workers)):
+        image_count += 1
+        if image_count % 1000 == 0 :
+            print("Images Processed: ", image_count)
+        status_count[status] = status_count.get(status, 0) + 1
+        if status == 'corrupt':
+            print(error)
+            print("IMAGE CORRUPT:",path)
+            continue
+
+        # add the file to the list
+        files_images.append(file)
+
+    print(', '.join(f'{count} {status}' for status, count in sorted(status_count.items())))
+
+    # the extracted files as they are now that their EXIF data is removed
+    processed_entries = stat_entries(image_dir, [file for file in files_all if os.path.isfile(os.path.join(image_dir, file))])
+
+    # sort the files by name
+    files = sorted(files_images, key=lambda x: int(x.split('.')[0]))
+
+    # file sizes come from the stat taken after stripping, no file is read
+    sizes = {file: processed_entries[file]['size'] for file in files}
+    total_bytes = 0
+    directory_index = 0
+    placer = Placer(action, place_methods, place_workers)
+    pairs = []
+
+    if incremental:
+        # directory of every image that is already sorted and the image bytes of
+        # every directory
+        placed = {}
+        directory_bytes = {}
+        for path, (size, _) in scan_tree(output_dir).items():
+            dir_name, _, file = path.rpartition('/')
+            if not dir_name.startswith(naming_convention) or file.split('.')[-1] not in ALLOWED_EXTENSIONS:
+                continue
+            placed[file] = dir_name
+            directory_bytes[dir_name] = directory_bytes.get(dir_name, 0) + size
+
+        # files that were removed from the extracted images are removed from
+        # their directory; moved files are expected to be gone
+        if action == 'copy':
+            for file in removed:
+                if file in placed:
+                    os.remove(os.path.join(output_dir, placed[file], file))
+                    print(f'Removed {file} from {placed[file]}')
+
+        # changed files replace the old copy in their directory
+        for file in [file for file in files if file in placed]:
+            pairs.append((os.path.join(image_dir, file), os.path.join(output_dir, placed[file], file)))
+        files = [file for file in files if file not in placed]
+
+        # new files go into the last directory until it is full, then into new
+        # directories; the directories before it are left untouched
+        directory_indices = [int(dir_name[len(naming_convention):]) for dir_name in directory_bytes]
+        if directory_indices:
+            directory_index = max(directory_indices)
+            total_bytes = directory_bytes[shard_name(naming_convention, directory_index)]
+            if total_bytes > directory_size:
+                total_bytes = 0
+                directory_index += 1
+
+    # assign the files to directories first, then place them all at once
+    plan = plan_shards(files, sizes, directory_size, naming_convention, directory_index, total_bytes)
+    write_plan(plan_path, plan, sizes)
+    for dir_name, shard_files in plan:
+        for file in shard_files:
+            pairs.append((os.path.join(image_dir, file), os.path.join(output_dir, dir_name, file)))
+
+    total_images = len(pairs)
+    print(f'Total number of images: {total_images}')
+    for index, (src_path, dst_path) in enumerate(placer.place_all(pairs)):
+        # print the progress
+        if (index + 1) % 1000 == 0 or index + 1 == total_images:
+            print(f"Placed {index+1}/{total_images}", end='\r')
+    if total_images:
+        print()
+    print(', '.join(f'{count} {method}' for method, count in sorted(placer.counts.items())))
+
+    # remember what was sorted so the next run only handles what changed
+    if action == 'copy':
+        for file in removed:
+            snapshot.pop(file, None)
+    snapshot.update(processed_entries)
+    write_manifest(state_path, snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import os
+import csv
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# a manifest lists every file of an image tree with its size, mtime and
+# sha256 so the other scripts don't have to list and re-read the images:
+#   path,size,mtime,sha256
+# path is relative to the tree and always uses '/'
+MANIFEST_COLUMNS = ['path', 'size', 'mtime', 'sha256']
+CHUNK_SIZE = 1024 * 1024 # bytes read per call, every worker owns one buffer
+# hashlib releases the GIL while hashing, so threads hash in parallel
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 2)
+# the files of a sorted tree that go into its manifest; the JSON files,
+# journals and temporary files the scripts write next to the images are
+# neither hashed nor zipped
+IMAGE_EXTENSIONS = ['jpg', 'png']
+
+
+def manifest_path(images_dir):
+    # the manifest sits next to the tree, not inside it, so the directory
+    # listing of the tree stays unchanged
+    return f'{os.path.normpath(images_dir)}-manifest.csv'
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    sha = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            sha.update(view[:size])
+    return sha.hexdigest()
+
+
+def scan_tree(images_dir, extensions=None):
+    # {relative path: (size, mtime)} of every file in the tree whose extension
+    # is in extensions (every file when it is None), from stat only
+    files = {}
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        with os.scandir(os.path.join(images_dir, relative_dir)) as entries:
+            for entry in entries:
+                relative_path = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relative_path)
+                elif entry.is_file():
+                    if extensions is not None and entry.name.split('.')[-1] not in extensions:
+                        continue
+                    stat = entry.stat()
+                    files[relative_path] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def read_manifest(path):
+    entries = {}
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            entries[row['path']] = {
+                'path': row['path'],
+                'size': int(row['size']),
+                'mtime': int(row['mtime']),
+                'sha256': row['sha256'],
+            }
+    return entries
+
+
+def write_manifest(path, entries):
+    with open(f'{path}.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS)
+        writer.writeheader()
+        for key in sorted(entries):
+            writer.writerow(entries[key])
+    os.replace(f'{path}.tmp', path)
+
+
+def hash_files(images_dir, files, workers=DEFAULT_WORKERS, chunk_size=CHUNK_SIZE):
+    # files is {relative path: (size, mtime)}; returns manifest entries
+    paths = sorted(files)
+    total = len(paths)
+    entries = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        hashes = executor.map(lambda path: hash_file(os.path.join(images_dir, path), chunk_size), paths)
+        for index, (path, sha256) in enumerate(zip(paths, hashes)):
+            if (index + 1) % 1000 == 0 or index + 1 == total:
+                print(f'Hashed {index+1}/{total} files', end='\r')
+            size, mtime = files[path]
+            entries[path] = {'path': path, 'size': size, 'mtime': mtime, 'sha256': sha256}
+    if total:
+        print()
+    return entries
+
+
+def build_manifest(images_dir, workers=DEFAULT_WORKERS, chunk_size=CHUNK_SIZE, extensions=IMAGE_EXTENSIONS):
+    return hash_files(images_dir, scan_tree(images_dir, extensions), workers, chunk_size)
+
+
+def ensure_manifest(images_dir, path=None, workers=DEFAULT_WORKERS, extensions=IMAGE_EXTENSIONS):
+    # load the manifest of the tree, bringing it up to date first: files
+    # whose size or mtime changed and new files are hashed, removed files
+    # are dropped. Only writes the manifest back when something changed.
+    # Files with other extensions are left out before anything is hashed
+    path = path or manifest_path(images_dir)
+    previous = read_manifest(path) if os.path.exists(path) else {}
+    files = scan_tree(images_dir, extensions)
+
+    stale = {relative_path: stat for relative_path, stat in files.items()
+             if relative_path not in previous or (previous[relative_path]['size'], previous[relative_path]['mtime']) != stat}
+    entries = {relative_path: previous[relative_path] for relative_path in files if relative_path not in stale}
+    entries.update(hash_files(images_dir, stale, workers))
+
+    if stale or len(entries) != len(previous):
+        write_manifest(path, entries)
+    return entries
+
+
+def diff_manifest(previous, current):
+    # (added, changed, removed) paths of current against an earlier
+    # manifest; a file counts as changed when its size or mtime differ
+    added = [path for path in current if path not in previous]
+    changed = [path for path in current if path in previous
+               and (previous[path]['size'], previous[path]['mtime']) != (current[path]['size'], current[path]['mtime'])]
+    removed = [path for path in previous if path not in current]
+    return sorted(added), sorted(changed), sorted(removed)
+
+
+def changed_directories(previous, current):
+    # relative directories with at least one added, changed or removed file
+    added, changed, removed = diff_manifest(previous, current)
+    return {path.rpartition('/')[0] for path in added + changed + removed}
+
+
+def load_snapshot(path):
+    # manifest a script stored after its last run, empty if there is none
+    return read_manifest(path) if os.path.exists(path) else {}
+
+
+def group_by_directory(entries):
+    # {relative directory: [entries sorted by path]}
+    directories = {}
+    for relative_path in sorted(entries):
+        directory = relative_path.rpartition('/')[0]
+        directories.setdefault(directory, []).append(entries[relative_path])
+    return directories
+
+
+def add_arguments(parser):
+    parser.add_argument('images_dir', nargs='?', default='images-sorted', help='Tree to hash (defaults to images-sorted in the current directory)')
+    parser.add_argument('--manifest', default=None, help='Path of the manifest (defaults to <images_dir>-manifest.csv)')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Number of hashing threads')
+    parser.add_argument('--extensions', nargs='*', default=IMAGE_EXTENSIONS, help='Extensions of the files that go into the manifest')
+
+
+def run(args):
+    start = time.time()
+    entries = ensure_manifest(args.images_dir, args.manifest, args.workers, args.extensions)
+    elapsed = max(time.time() - start, 1e-9)
+    total_mb = sum(entry['size'] for entry in entries.values()) / (1024 * 1024)
+    print(f'{len(entries)} files, {total_mb:.2f} MB in manifest ({elapsed:.2f} seconds)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hash every file of an image tree into a manifest (path, size, mtime, sha256).')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,116 @@
+import os
+import csv
+import errno
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# assigns files to size-bounded shard directories from their stat size only
+# and places them with the cheapest method the filesystem supports:
+#   reflink   copy-on-write clone (btrfs, xfs, ...), no data is copied
+#   hardlink  second name for the same file, no data is copied
+#   copy      regular byte copy
+PLAN_COLUMNS = ['file', 'directory', 'size']
+LINK_METHODS = ['reflink', 'hardlink']
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# ioctl request of FICLONE on Linux, clones a whole file
+FICLONE = 0x40049409
+# errors that mean a method isn't possible between these two paths
+UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM, errno.ENOSYS}
+
+
+def shard_name(naming_convention, index):
+    return f'{naming_convention}{str(index).zfill(3)}'
+
+
+def plan_shards(files, sizes, max_bytes, naming_convention, directory_index=0, total_bytes=0):
+    # [(directory, [files])] in order; the file that takes a shard over
+    # max_bytes is the last file of that shard. directory_index and
+    # total_bytes continue an open shard of an earlier run
+    plan = []
+    shard = []
+    for file in files:
+        shard.append(file)
+        total_bytes += sizes[file]
+        if total_bytes > max_bytes:
+            plan.append((shard_name(naming_convention, directory_index), shard))
+            shard = []
+            total_bytes = 0
+            directory_index += 1
+    if shard:
+        plan.append((shard_name(naming_convention, directory_index), shard))
+    return plan
+
+
+def write_plan(path, plan, sizes):
+    with open(f'{path}.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(PLAN_COLUMNS)
+        for directory, files in plan:
+            for file in files:
+                writer.writerow([file, directory, sizes[file]])
+    os.replace(f'{path}.tmp', path)
+
+
+def reflink(src_path, dst_path):
+    import fcntl
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copymode(src_path, dst_path)
+
+
+class Placer:
+    # copies or moves files on a pool of threads. For copies the link methods
+    # are tried in order and a method that fails as unsupported is not tried
+    # again, so a filesystem without reflinks costs one failed call
+    def __init__(self, action='copy', methods=LINK_METHODS, workers=DEFAULT_WORKERS):
+        self.action = action
+        self.methods = list(methods)
+        self.workers = workers
+        self.disabled = set()
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def _count(self, method):
+        with self._lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+
+    def place(self, src_path, dst_path):
+        # the file is created under a temporary name and renamed, so an
+        # existing destination is replaced in one step
+        if self.action == 'move':
+            shutil.move(src_path, dst_path)
+            self._count('move')
+            return
+        tmp_path = f'{dst_path}.tmp'
+        for method in self.methods:
+            if method in self.disabled:
+                continue
+            try:
+                if method == 'reflink':
+                    reflink(src_path, tmp_path)
+                else:
+                    os.link(src_path, tmp_path)
+            except (OSError, ImportError) as e:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                if isinstance(e, ImportError) or e.errno in UNSUPPORTED_ERRORS:
+                    self.disabled.add(method)
+                    continue
+                raise
+            os.replace(tmp_path, dst_path)
+            self._count(method)
+            return
+        shutil.copy(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+        self._count('copy')
+
+    def place_all(self, pairs):
+        # pairs is a list of (src_path, dst_path); yields them as they finish
+        for directory in {os.path.dirname(dst_path) for _, dst_path in pairs}:
+            os.makedirs(directory, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            futures = [executor.submit(self.place, src_path, dst_path) for src_path, dst_path in pairs]
+            for pair, future in zip(pairs, futures):
+                future.result()
+                yield pair
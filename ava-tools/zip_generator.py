@@ -1,47 +1,88 @@
 import os
-import zipfile
+import sys
+import time
 import shutil
+from manifest import ensure_manifest, group_by_directory, changed_directories, load_snapshot, write_manifest, manifest_path
+
+# make the shared modules in the repository root importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from zip_builder import build_archives, index_path, DEFAULT_WORKERS
 
 IMAGES_DIR = 'images-sorted' # directory that contains the images
 OUTPUT_DIR = 'images-zipped' # directory that will contain the zipped images
+INCREMENTAL = True # only rebuild the zip files of directories that changed since the last run
+ZIP_WORKERS = DEFAULT_WORKERS # zip files built in parallel, one process each
 
 #SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__)) # use this if the dataset is in the same directory as the script
 SCRIPT_DIR = os.getcwd() # use this if the dataset is in the current working directory
 
 IMAGES_DIR = os.path.join(SCRIPT_DIR, IMAGES_DIR)
 OUTPUT_DIR = os.path.join(SCRIPT_DIR, OUTPUT_DIR)
-print(f'Images directory: {IMAGES_DIR}')
-print(f'Output directory: {OUTPUT_DIR}')
-
-# if the output directory does not exist, create it
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
-else:
-    # remove the directory
-    shutil.rmtree(OUTPUT_DIR)
-    os.makedirs(OUTPUT_DIR)
-
-# create a list of all the files in the directory
-directories = os.listdir(IMAGES_DIR)
-# sort directories
-directories = sorted(directories)
-print(f'Total number of directories: {len(directories)}')
-
-for directory in directories:
-    print(f'Processing directory: {directory}')
-    # construct the path to the output file
-    path = os.path.join(OUTPUT_DIR, directory)
-    with zipfile.ZipFile(f'{path}.zip', 'w') as zip_file:
-        # iterate through the files in the directory
-        files = os.listdir(os.path.join(IMAGES_DIR, directory))
-        total_files = len(files)
-        for index, file in enumerate(files):
-            print(f'Processing file {index+1}/{total_files}', end='\r')
-            # read in the image
-            path = os.path.join(IMAGES_DIR, directory, file)
-            with open(os.path.join(IMAGES_DIR, directory, file), 'rb') as f:
-                img = f.read()
-            # add the image to the zip file
-            zip_file.writestr(f'{file}',img)
 
 
+# zips every directory of images_dir into output_dir; the defaults are the
+# settings above
+def main(images_dir=IMAGES_DIR, output_dir=OUTPUT_DIR, incremental=INCREMENTAL, zip_workers=ZIP_WORKERS):
+    # manifest of the sorted tree as it was when the zip files were last built
+    state_path = manifest_path(output_dir)
+    print(f'Images directory: {images_dir}')
+    print(f'Output directory: {output_dir}')
+
+    snapshot = load_snapshot(state_path)
+    incremental = incremental and bool(snapshot) and os.path.exists(output_dir)
+
+    # if the output directory does not exist, create it
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    elif not incremental:
+        # remove the directory
+        shutil.rmtree(output_dir)
+        os.makedirs(output_dir)
+
+    # list the files of every directory through the manifest of the sorted tree
+    entries = ensure_manifest(images_dir)
+    manifest = group_by_directory(entries)
+    directories = [directory for directory in manifest if directory]
+    # sort directories
+    directories = sorted(directories)
+    print(f'Total number of directories: {len(directories)}')
+
+    if incremental:
+        # zip files of directories that no longer exist are removed, the others
+        # are only rebuilt when a file in the directory changed or the zip is missing
+        changed = changed_directories(snapshot, entries)
+        for file in os.listdir(output_dir):
+            if file.endswith('.zip') and file[:-len('.zip')] not in manifest:
+                zip_path = os.path.join(output_dir, file)
+                os.remove(zip_path)
+                if os.path.exists(index_path(zip_path)):
+                    os.remove(index_path(zip_path))
+                print(f'Removed {file}')
+        unchanged = [directory for directory in directories
+                     if directory not in changed and os.path.exists(index_path(os.path.join(output_dir, f'{directory}.zip')))]
+        directories = [directory for directory in directories if directory not in unchanged]
+        print(f'{len(unchanged)} directories unchanged, rebuilding {len(directories)}')
+
+    # every zip file is built by a worker process that streams the files into
+    # it and writes <directory>.index.json with the offset, size and sha256 of
+    # every member next to it
+    jobs = []
+    for directory in directories:
+        zip_path = os.path.join(output_dir, f'{directory}.zip')
+        members = [(os.path.join(images_dir, entry['path']), os.path.basename(entry['path'])) for entry in manifest[directory]]
+        jobs.append((zip_path, members))
+
+    start = time.time()
+    total_bytes = 0
+    for index, (zip_path, total_files, zip_bytes) in enumerate(build_archives(jobs, zip_workers)):
+        total_bytes += zip_bytes
+        print(f'Built {os.path.basename(zip_path)} with {total_files} files ({index+1}/{len(jobs)})')
+    elapsed = max(time.time() - start, 1e-9)
+    print(f'Zipped {total_bytes / (1024 * 1024):.2f} MB in {elapsed:.2f} seconds ({total_bytes / (elapsed * 1024 * 1024):.2f} MB/s)')
+
+    # remember what was zipped so the next run only rebuilds what changed
+    write_manifest(state_path, entries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,574 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+
+# the AVA stages live in ava-tools
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ava-tools'))
+from exif_strip import strip_file
+from manifest import hash_file, scan_tree, build_manifest
+from shard_planner import plan_shards, Placer
+from zip_builder import build_archive, build_archives
+from zip_stream import iter_zip_batches, ZipStream
+from embedding_store import save_records
+
+# synthetic AVA-style dataset, generated once per (images, seed, max side,
+# shard size) and reused by later runs:
+#   <data>/AVA.txt             one AVA row per image
+#   <data>/images-extracted/   <id>.jpg with EXIF, made from the seed images
+#   <data>/images-zipped/      zip shards of about shard_mb each
+#   <data>/dataset.json        the parameters and the list of images
+# Every stage runs in its own forked process, so its peak RSS is its own.
+SEED_ZIP = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_data', 'Images_for_Json_generator.zip')
+DATASET_FILE_NAME = 'dataset.json'
+REPORT_FILE_NAME = 'benchmark-report.json'
+STAGES = ['strip', 'sort', 'hash', 'zip', 'decode', 'embed', 'write_json', 'write_npy']
+DEFAULT_IMAGES = 1000
+DEFAULT_SHARD_MB = 50
+DEFAULT_MAX_SIDE = 1024
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+PERCENTILES = (50, 90, 99)
+VECTOR_DIM = 768 # size of the vectors written by the write stages
+TINY_SIZE = 224 # input side of the tiny model
+
+
+def seed_images(path=SEED_ZIP):
+    # decoded seed images of the test zip, macOS metadata entries skipped
+    images = []
+    with zipfile.ZipFile(path) as zip_file:
+        for name in sorted(zip_file.namelist()):
+            if name.startswith('__MACOSX') or not name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                continue
+            images.append(Image.open(io.BytesIO(zip_file.read(name))).convert('RGB'))
+    return images
+
+
+def synthetic_image(seeds, rng, max_side):
+    # a random crop of a seed image, resized, color shifted and saved with
+    # EXIF at a random quality, so no two images are the same file
+    image = seeds[rng.integers(len(seeds))]
+    width, height = image.size
+    scale = rng.uniform(0.6, 1.0)
+    crop_width, crop_height = max(16, int(width * scale)), max(16, int(height * scale))
+    left = int(rng.integers(0, width - crop_width + 1))
+    top = int(rng.integers(0, height - crop_height + 1))
+    image = image.crop((left, top, left + crop_width, top + crop_height))
+    side = int(rng.integers(max_side // 4, max_side + 1))
+    image.thumbnail((side, side))
+    pixels = np.asarray(image, dtype=np.int16) + rng.integers(-12, 13, size=3)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    exif = Image.Exif()
+    exif[0x010F] = 'kcg-benchmark' # Make
+    exif[0x0110] = f'synthetic-{int(rng.integers(1000))}' # Model
+    exif[0x0131] = 'benchmark.py' # Software
+    exif[0x0132] = time.strftime('%Y:%m:%d %H:%M:%S') # DateTime
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=int(rng.integers(70, 96)), exif=exif.tobytes())
+    return output.getvalue()
+
+
+def dataset_parameters(images, seed, max_side, shard_mb):
+    return {'images': images, 'seed': seed, 'max_side': max_side, 'shard_mb': shard_mb}
+
+
+def load_dataset(data_dir):
+    with open(os.path.join(data_dir, DATASET_FILE_NAME), 'r') as f:
+        return json.load(f)
+
+
+def generate(data_dir, images=DEFAULT_IMAGES, seed=0, max_side=DEFAULT_MAX_SIDE, shard_mb=DEFAULT_SHARD_MB, source=SEED_ZIP, workers=DEFAULT_WORKERS):
+    parameters = dataset_parameters(images, seed, max_side, shard_mb)
+    dataset_path = os.path.join(data_dir, DATASET_FILE_NAME)
+    if os.path.exists(dataset_path) and load_dataset(data_dir)['parameters'] == parameters:
+        print(f'{data_dir} already holds this dataset')
+        return load_dataset(data_dir)
+    if os.path.exists(data_dir):
+        shutil.rmtree(data_dir)
+    extracted_dir = os.path.join(data_dir, 'images-extracted')
+    zipped_dir = os.path.join(data_dir, 'images-zipped')
+    os.makedirs(extracted_dir)
+    os.makedirs(zipped_dir)
+
+    seeds = seed_images(source)
+    rng = np.random.default_rng(seed)
+    files = []
+    with open(os.path.join(data_dir, 'AVA.txt'), 'w') as ava:
+        for image_id in range(1, images + 1):
+            file = f'{image_id}.jpg'
+            with open(os.path.join(extracted_dir, file), 'wb') as f:
+                f.write(synthetic_image(seeds, rng, max_side))
+            files.append(file)
+            # index, image id, ten score counts, two semantic tags, challenge
+            scores = ' '.join(str(count) for count in rng.integers(0, 40, size=10))
+            ava.write(f'{image_id} {image_id} {scores} {int(rng.integers(0, 66))} {int(rng.integers(0, 66))} {int(rng.integers(1, 1400))}\n')
+
+    sizes = {file: os.path.getsize(os.path.join(extracted_dir, file)) for file in files}
+    plan = plan_shards(files, sizes, shard_mb * 1024 * 1024, 'shard-')
+    jobs = [(os.path.join(zipped_dir, f'{directory}.zip'), [(os.path.join(extracted_dir, file), file) for file in shard_files])
+            for directory, shard_files in plan]
+    for _ in build_archives(jobs, workers):
+        pass
+
+    dataset = {
+        'parameters': parameters,
+        'images': len(files),
+        'bytes': sum(sizes.values()),
+        'shards': [directory for directory, _ in plan],
+        'files': files,
+    }
+    with open(f'{dataset_path}.tmp', 'w') as f:
+        json.dump(dataset, f, indent=1)
+    os.replace(f'{dataset_path}.tmp', dataset_path)
+    print(f"Generated {len(files)} images ({dataset['bytes'] / (1024 * 1024):.1f} MB) in {len(plan)} shards in {data_dir}")
+    return dataset
+
+
+class TinyEncoder:
+    # stand-in for a clip model: a small random conv net, so the pipeline can
+    # be measured without downloading weights
+    def __init__(self):
+        import torch
+        torch.manual_seed(0)
+        self.visual = torch.nn.Sequential(
+            torch.nn.Conv2d(3, 32, 7, stride=4), torch.nn.ReLU(),
+            torch.nn.Conv2d(32, 64, 3, stride=2), torch.nn.ReLU(),
+            torch.nn.AdaptiveAvgPool2d(1), torch.nn.Flatten(), torch.nn.Linear(64, VECTOR_DIM)).eval()
+
+    def encode_image(self, images):
+        return self.visual(images)
+
+
+def tiny_preprocess(image):
+    import torch
+    image = image.resize((TINY_SIZE, TINY_SIZE), Image.BILINEAR)
+    return torch.from_numpy(np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255)
+
+
+def load_model(name, pretrained):
+    # (model, preprocess); 'tiny' needs no weights
+    if name == 'tiny':
+        return TinyEncoder(), tiny_preprocess
+    import open_clip
+    model, _, preprocess = open_clip.create_model_and_transforms(name, pretrained=pretrained)
+    return model.eval(), preprocess
+
+
+def _timed(function, unit):
+    start = time.perf_counter()
+    result = function(unit)
+    return result, time.perf_counter() - start
+
+
+def run_units(function, units, workers=1, processes=False):
+    # (result, seconds) of function on every unit, on a pool of threads or
+    # forked processes like the stage itself uses
+    if workers <= 1:
+        return [_timed(function, unit) for unit in units]
+    if processes:
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    with executor:
+        return list(executor.map(_timed, [function] * len(units), units))
+
+
+def copy_tree(data_dir, scratch, name='images-extracted'):
+    # a private copy of a dataset tree for the stages that change it
+    destination = os.path.join(scratch, name)
+    if os.path.exists(destination):
+        shutil.rmtree(destination)
+    shutil.copytree(os.path.join(data_dir, name), destination)
+    return destination
+
+
+def zip_paths(data_dir):
+    zipped_dir = os.path.join(data_dir, 'images-zipped')
+    return sorted(os.path.join(zipped_dir, file) for file in os.listdir(zipped_dir) if file.endswith('.zip'))
+
+
+def read_batches(data_dir, batch_size):
+    return [batch_data for zip_path in zip_paths(data_dir) for _, batch_data in iter_zip_batches(zip_path, batch_size)]
+
+
+def _build(job):
+    return build_archive(*job)
+
+
+def _prepare(batch_data):
+    from clip_pipeline import prepare_batch
+    return prepare_batch(batch_data, _stage_preprocess)
+
+
+# preprocess of the decode stage, inherited by its forked workers
+_stage_preprocess = None
+
+
+def stage_strip(data_dir, scratch, args):
+    extracted_dir = copy_tree(data_dir, scratch)
+    paths = sorted(os.path.join(extracted_dir, file) for file in os.listdir(extracted_dir))
+    size = sum(os.path.getsize(path) for path in paths)
+    start = time.perf_counter()
+    results = run_units(strip_file, paths, args.workers, processes=True)
+    return {'unit': 'image', 'images': len(paths), 'bytes': size, 'seconds': time.perf_counter() - start,
+            'latencies': [seconds for _, seconds in results],
+            'statuses': {status: sum(1 for (result, _) in results if result[0] == status) for status in sorted({result[0] for result, _ in results})}}
+
+
+def stage_sort(data_dir, scratch, args):
+    extracted_dir = os.path.join(data_dir, 'images-extracted')
+    sorted_dir = os.path.join(scratch, 'images-sorted')
+    if os.path.exists(sorted_dir):
+        shutil.rmtree(sorted_dir)
+    start = time.perf_counter()
+    files = sorted(os.listdir(extracted_dir), key=lambda file: int(file.split('.')[0]))
+    sizes = {file: size for file, (size, _) in scan_tree(extracted_dir).items()}
+    plan = plan_shards(files, sizes, args.shard_mb * 1024 * 1024, 'dataset-')
+    pairs = [(os.path.join(extracted_dir, file), os.path.join(sorted_dir, directory, file)) for directory, shard_files in plan for file in shard_files]
+    for directory, _ in plan:
+        os.makedirs(os.path.join(sorted_dir, directory), exist_ok=True)
+    placer = Placer('copy', args.place_methods, args.workers)
+    results = run_units(lambda pair: placer.place(*pair), pairs, args.workers)
+    return {'unit': 'image', 'images': len(pairs), 'bytes': sum(sizes.values()), 'seconds': time.perf_counter() - start,
+            'latencies': [seconds for _, seconds in results], 'methods': placer.counts}
+
+
+def stage_hash(data_dir, scratch, args):
+    extracted_dir = os.path.join(data_dir, 'images-extracted')
+    paths = sorted(os.path.join(extracted_dir, file) for file in os.listdir(extracted_dir))
+    start = time.perf_counter()
+    results = run_units(hash_file, paths, args.workers)
+    return {'unit': 'image', 'images': len(paths), 'bytes': sum(os.path.getsize(path) for path in paths),
+            'seconds': time.perf_counter() - start, 'latencies': [seconds for _, seconds in results]}
+
+
+def stage_zip(data_dir, scratch, args):
+    extracted_dir = os.path.join(data_dir, 'images-extracted')
+    zipped_dir = os.path.join(scratch, 'images-zipped')
+    os.makedirs(zipped_dir, exist_ok=True)
+    files = sorted(os.listdir(extracted_dir), key=lambda file: int(file.split('.')[0]))
+    sizes = {file: os.path.getsize(os.path.join(extracted_dir, file)) for file in files}
+    plan = plan_shards(files, sizes, args.shard_mb * 1024 * 1024, 'shard-')
+    jobs = [(os.path.join(zipped_dir, f'{directory}.zip'), [(os.path.join(extracted_dir, file), file) for file in shard_files])
+            for directory, shard_files in plan]
+    start = time.perf_counter()
+    results = run_units(_build, jobs, min(args.workers, len(jobs)), processes=True)
+    return {'unit': 'shard', 'images': len(files), 'bytes': sum(sizes.values()), 'seconds': time.perf_counter() - start,
+            'latencies': [seconds for _, seconds in results]}
+
+
+def stage_decode(data_dir, scratch, args):
+    global _stage_preprocess
+    _, _stage_preprocess = load_model(args.model, args.pretrained)
+    batches = read_batches(data_dir, args.batch_size)
+    start = time.perf_counter()
+    results = run_units(_prepare, batches, args.workers, processes=True)
+    return {'unit': 'batch', 'images': sum(len(batch) for batch in batches), 'bytes': sum(len(data) for batch in batches for data in batch),
+            'seconds': time.perf_counter() - start, 'latencies': [seconds for _, seconds in results],
+            'errors': sum(len(prepared['errors']) for prepared, _ in results)}
+
+
+def stage_embed(data_dir, scratch, args):
+    import torch
+    from clip_pipeline import prepare_batch
+    from clip_backend import load_backend
+    model, preprocess = load_model(args.model, args.pretrained)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.model != 'tiny':
+        model = model.to(device)
+    encoder = load_backend(model, args.backend, device, args.threads)
+    pixels = [prepare_batch(batch_data, preprocess)['pixels'] for batch_data in read_batches(data_dir, args.batch_size)]
+    pixels = [batch for batch in pixels if batch is not None]
+
+    def encode(batch):
+        with torch.no_grad():
+            return encoder.encode_image(torch.from_numpy(batch).to(device)).cpu().numpy()
+
+    # the first batch warms up lazy backends and is not measured
+    encode(pixels[0])
+    start = time.perf_counter()
+    results = run_units(encode, pixels)
+    return {'unit': 'batch', 'images': sum(len(batch) for batch in pixels), 'bytes': sum(batch.nbytes for batch in pixels),
+            'seconds': time.perf_counter() - start, 'latencies': [seconds for _, seconds in results]}
+
+
+def shard_records(data_dir):
+    # (name, records, vectors) of every zip shard, with random vectors
+    rng = np.random.default_rng(0)
+    shards = []
+    for zip_path in zip_paths(data_dir):
+        with zipfile.ZipFile(zip_path) as zip_file:
+            names = zip_file.namelist()
+        name = os.path.splitext(os.path.basename(zip_path))[0]
+        records = [{'file_archive': os.path.basename(zip_path), 'file_name': file, 'file_path': zip_path,
+                    'file_hash': f'{index:064x}', 'clip_model': 'benchmark'} for index, file in enumerate(names)]
+        shards.append((name, records, rng.standard_normal((len(records), VECTOR_DIM), dtype=np.float32)))
+    return shards
+
+
+def stage_write(data_dir, scratch, args, output_format):
+    output_dir = os.path.join(scratch, f'write-{output_format}')
+    os.makedirs(output_dir, exist_ok=True)
+    shards = shard_records(data_dir)
+    start = time.perf_counter()
+    results = run_units(lambda shard: save_records(output_dir, *shard, output_format, args.dtype), shards)
+    written = sum(os.path.getsize(path) for paths, _ in results for path in paths)
+    return {'unit': 'shard', 'images': sum(len(records) for _, records, _ in shards), 'bytes': written,
+            'seconds': time.perf_counter() - start, 'latencies': [seconds for _, seconds in results]}
+
+
+def stage_end_to_end(data_dir, scratch, args):
+    # the stages chained the way the scripts run them, each one timed
+    import torch
+    from clip_pipeline import EncodePipeline
+    from clip_backend import load_backend
+    from exif_strip import strip_files
+    seconds = {}
+    start = time.perf_counter()
+
+    extracted_dir = copy_tree(data_dir, scratch)
+    seconds['copy'] = time.perf_counter() - start
+    total_bytes = sum(size for size, _ in scan_tree(extracted_dir).values())
+
+    step = time.perf_counter()
+    for _ in strip_files(sorted(os.path.join(extracted_dir, file) for file in os.listdir(extracted_dir)), args.workers):
+        pass
+    seconds['strip'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    sorted_dir = os.path.join(scratch, 'e2e-sorted')
+    files = sorted(os.listdir(extracted_dir), key=lambda file: int(file.split('.')[0]))
+    sizes = {file: size for file, (size, _) in scan_tree(extracted_dir).items()}
+    plan = plan_shards(files, sizes, args.shard_mb * 1024 * 1024, 'dataset-')
+    pairs = [(os.path.join(extracted_dir, file), os.path.join(sorted_dir, directory, file)) for directory, shard_files in plan for file in shard_files]
+    for _ in Placer('copy', args.place_methods, args.workers).place_all(pairs):
+        pass
+    seconds['sort'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    build_manifest(sorted_dir, args.workers)
+    seconds['hash'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    zipped_dir = os.path.join(scratch, 'e2e-zipped')
+    os.makedirs(zipped_dir, exist_ok=True)
+    jobs = [(os.path.join(zipped_dir, f'{directory}.zip'), [(os.path.join(sorted_dir, directory, file), file) for file in shard_files])
+            for directory, shard_files in plan]
+    for _ in build_archives(jobs, args.workers):
+        pass
+    seconds['zip'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    model, preprocess = load_model(args.model, args.pretrained)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.model != 'tiny':
+        model = model.to(device)
+    encoder = load_backend(model, args.backend, device, args.threads)
+    seconds['load_model'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    output_dir = os.path.join(scratch, 'e2e-vectors')
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    pipeline = EncodePipeline(encoder, preprocess, device, args.workers, batch_size=args.encode_batch_size)
+    stream = ZipStream([zip_path for zip_path, _ in jobs], args.batch_size)
+    for (zip_path, file_names), prepared, vectors in pipeline.run(stream.batches()):
+        records, shard_vectors = results.setdefault(zip_path, ([], []))
+        for idx, vector in zip(prepared['ok'], vectors):
+            records.append({'file_name': file_names[idx], 'file_hash': prepared['hashes'][idx]})
+            shard_vectors.append(vector)
+    pipeline.close()
+    seconds['embed'] = time.perf_counter() - step
+
+    step = time.perf_counter()
+    for zip_path, (records, vectors) in results.items():
+        save_records(output_dir, os.path.splitext(os.path.basename(zip_path))[0], records, vectors, 'npy', args.dtype)
+    seconds['write'] = time.perf_counter() - step
+
+    return {'unit': 'run', 'images': len(files), 'bytes': total_bytes, 'seconds': time.perf_counter() - start - seconds['copy'],
+            'latencies': [], 'stage_seconds': seconds, 'encode_batch_size': pipeline.sizer.size}
+
+
+STAGE_FUNCTIONS = {
+    'strip': stage_strip,
+    'sort': stage_sort,
+    'hash': stage_hash,
+    'zip': stage_zip,
+    'decode': stage_decode,
+    'embed': stage_embed,
+    'write_json': lambda data_dir, scratch, args: stage_write(data_dir, scratch, args, 'json'),
+    'write_npy': lambda data_dir, scratch, args: stage_write(data_dir, scratch, args, 'npy'),
+    'end_to_end': stage_end_to_end,
+}
+
+
+def peak_rss():
+    # peak resident set size in bytes of this process and of its finished
+    # children (the stage's worker pools); ru_maxrss is in kB on Linux
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def summarize(result):
+    seconds = max(result.pop('seconds'), 1e-9)
+    latencies = np.asarray(result.pop('latencies'), dtype=np.float64) * 1000
+    summary = {
+        'images': result.pop('images'),
+        'bytes': result.pop('bytes'),
+        'seconds': seconds,
+    }
+    summary['images_per_second'] = summary['images'] / seconds
+    summary['mb_per_second'] = summary['bytes'] / (seconds * 1024 * 1024)
+    if len(latencies):
+        summary['latency_ms'] = {f'p{percentile}': float(np.percentile(latencies, percentile)) for percentile in PERCENTILES}
+        summary['latency_ms']['mean'] = float(latencies.mean())
+        summary['latency_ms']['max'] = float(latencies.max())
+    summary.update(result)
+    return summary
+
+
+def _run_child(name, data_dir, scratch, args, connection):
+    try:
+        result = summarize(STAGE_FUNCTIONS[name](data_dir, scratch, args))
+        result['peak_rss_bytes'] = peak_rss()
+        connection.send(result)
+    except BaseException as e:
+        connection.send({'error': f'{type(e).__name__}: {e}'})
+        raise
+    finally:
+        connection.close()
+
+
+def run_stage(name, data_dir, scratch, args):
+    # runs a stage in a forked child so its peak RSS starts from this small
+    # process instead of from whatever the stages before it allocated
+    context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else multiprocessing
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_child, args=(name, data_dir, scratch, args, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'error': 'the stage process exited without a result'}
+    process.join()
+    return result
+
+
+def git_commit():
+    # (commit, dirty) of the repository the benchmark runs from
+    root = os.path.dirname(os.path.realpath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def run(args):
+    dataset = load_dataset(args.data)
+    scratch = args.scratch or os.path.join(args.data, 'scratch')
+    os.makedirs(scratch, exist_ok=True)
+    commit, dirty = git_commit()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+        'dataset': {key: dataset[key] for key in ('parameters', 'images', 'bytes', 'shards')},
+        'config': {key: getattr(args, key) for key in ('workers', 'batch_size', 'encode_batch_size', 'model', 'pretrained', 'backend', 'threads', 'dtype', 'shard_mb', 'place_methods')},
+        'stages': {},
+    }
+    stages = list(args.stages)
+    if args.end_to_end:
+        stages.append('end_to_end')
+    for name in stages:
+        print(f'Running {name}...')
+        result = run_stage(name, args.data, scratch, args)
+        report['stages'][name] = result
+        if 'error' in result:
+            print(f"  failed: {result['error']}")
+        else:
+            print(f"  {result['images_per_second']:.1f} images/s, {result['mb_per_second']:.1f} MB/s, peak RSS {result['peak_rss_bytes'] / (1024 * 1024):.0f} MB")
+    if not args.keep_scratch:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    with open(f'{args.report}.tmp', 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(f'{args.report}.tmp', args.report)
+    print(f'Report written to {args.report}')
+    return report
+
+
+def compare(baseline_path, candidate_path):
+    # images/s of every stage of two reports and their ratio
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    with open(candidate_path, 'r') as f:
+        candidate = json.load(f)
+    if baseline['dataset']['parameters'] != candidate['dataset']['parameters']:
+        print('Warning: the reports were made on different datasets')
+    print(f"{'stage':<12} {'baseline':>12} {'candidate':>12} {'ratio':>7}   images/s ({(baseline['commit'] or '?')[:10]} -> {(candidate['commit'] or '?')[:10]})")
+    for name in baseline['stages']:
+        old = baseline['stages'][name].get('images_per_second')
+        new = candidate['stages'].get(name, {}).get('images_per_second')
+        if old is None or new is None:
+            continue
+        print(f'{name:<12} {old:12.1f} {new:12.1f} {new / old:7.2f}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the dataset pipeline on a synthetic AVA-style dataset.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = subparsers.add_parser('generate', help='Generate a synthetic dataset')
+    generate_parser.add_argument('data', help='Directory of the dataset')
+    generate_parser.add_argument('--images', type=int, default=DEFAULT_IMAGES, help='Number of images')
+    generate_parser.add_argument('--seed', type=int, default=0, help='Random seed, the same seed gives the same dataset')
+    generate_parser.add_argument('--max-side', type=int, default=DEFAULT_MAX_SIDE, help='Longest side of the largest images')
+    generate_parser.add_argument('--shard-mb', type=int, default=DEFAULT_SHARD_MB, help='Size of the zip shards in MB')
+    generate_parser.add_argument('--source', default=SEED_ZIP, help='Zip file of the seed images')
+
+    run_parser = subparsers.add_parser('run', help='Run the stages on a generated dataset')
+    run_parser.add_argument('data', help='Directory of the dataset')
+    run_parser.add_argument('--stages', nargs='*', choices=STAGES, default=STAGES, help='Stages to run in isolation')
+    run_parser.add_argument('--end-to-end', action='store_true', help='Also run all stages chained')
+    run_parser.add_argument('--report', default=REPORT_FILE_NAME, help='Path of the JSON report')
+    run_parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Workers of the stages that run in parallel')
+    run_parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Images per decode/embed batch')
+    run_parser.add_argument('--encode-batch-size', type=int, default=None, help='Encode batch size of the end to end run (tuned when omitted)')
+    run_parser.add_argument('--model', default='tiny', help="open_clip model name, or 'tiny' for a small random model that needs no weights")
+    run_parser.add_argument('--pretrained', default='openai', help='open_clip pretrained tag')
+    run_parser.add_argument('--backend', default='eager', help='CPU backend of the encoder, see clip_backend.py')
+    run_parser.add_argument('--threads', type=int, default=None, help='Intra-op threads of the encoder')
+    run_parser.add_argument('--dtype', default='float16', help='Precision of the written vector matrices')
+    run_parser.add_argument('--shard-mb', type=int, default=DEFAULT_SHARD_MB, help='Size of the sorted directories and zip files in MB')
+    run_parser.add_argument('--place-methods', nargs='*', default=[], help='Link methods the sort stage may use (reflink, hardlink); none copies the bytes')
+    run_parser.add_argument('--scratch', default=None, help='Directory for stage outputs (defaults to <data>/scratch)')
+    run_parser.add_argument('--keep-scratch', action='store_true', help='Keep the stage outputs')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two reports')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        generate(args.data, args.images, args.seed, args.max_side, args.shard_mb, args.source)
+    elif args.command == 'run':
+        run(args)
+    else:
+        compare(args.baseline, args.candidate)
@@ -0,0 +1,254 @@
+import io
+import os
+import time
+import zipfile
+import argparse
+import tempfile
+import numpy as np
+from zip_stream import IMAGE_EXTENSIONS
+
+# CPU inference backends of the clip image encoder:
+#   eager        the model as loaded, fp32
+#   bf16         eager under bfloat16 autocast (fast on CPUs with AVX512-BF16/AMX)
+#   int8         dynamic int8 quantization of the linear layers
+#   torchscript  traced and frozen for inference
+#   compile      torch.compile
+#   onnx         exported to ONNX and run by ONNX Runtime
+# Every backend except eager wraps model.visual, so it works the same for
+# models of the openai clip package and of open_clip. torch is imported on
+# first use, so importing the backend names costs nothing.
+BACKENDS = ['eager', 'bf16', 'int8', 'torchscript', 'compile', 'onnx']
+# backends whose vectors differ from eager by more than float rounding, their
+# vectors are cached under their own pretrained tag
+LOSSY_BACKENDS = ('bf16', 'int8')
+PARITY_COSINE = 0.99 # lowest cosine similarity to the eager vectors the parity check accepts
+PARITY_IMAGES = 32
+
+
+def set_threads(threads=None, interop_threads=None):
+    # intra-op threads parallelize a single operator, inter-op threads run
+    # independent operators at the same time. The inter-op pool can only be
+    # sized before its first use.
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            print(f'Inter-op threads are already in use, keeping {torch.get_num_interop_threads()}')
+
+
+def cache_tag(pretrained, backend):
+    # pretrained tag of the embedding cache entries of a backend
+    return f'{pretrained}+{backend}' if backend in LOSSY_BACKENDS else pretrained
+
+
+# the ImageTower class, defined on the first image_tower call
+_ImageTower = None
+
+
+def image_tower(visual, autocast=False):
+    # model.visual with the input cast like encode_image does and fp32 output
+    global _ImageTower
+    import torch
+    if _ImageTower is None:
+        class ImageTower(torch.nn.Module):
+            def __init__(self, visual, autocast=False):
+                super().__init__()
+                self.visual = visual
+                self.dtype = next(visual.parameters()).dtype
+                self.autocast = autocast
+
+            def forward(self, images):
+                if self.autocast:
+                    with torch.autocast('cpu', dtype=torch.bfloat16):
+                        return self.visual(images.type(self.dtype)).float()
+                return self.visual(images.type(self.dtype)).float()
+        _ImageTower = ImageTower
+    return _ImageTower(visual, autocast)
+
+
+class BackendEncoder:
+    # drop-in for the model in EncodePipeline: encode_image(images) returns
+    # the vectors as a float32 tensor. Traced, compiled and ONNX backends are
+    # built on the first batch, so the input shape never has to be guessed.
+    def __init__(self, model, backend, threads=None, interop_threads=None, onnx_path=None):
+        if backend not in BACKENDS:
+            raise ValueError(f'backend must be one of {BACKENDS}, got {backend}')
+        self.backend = backend
+        self.threads = threads
+        self.interop_threads = interop_threads
+        self.onnx_path = onnx_path
+        self.session = None
+        self._onnx_directory = None
+        visual = model.visual.eval()
+        if backend == 'bf16':
+            self.module = image_tower(visual, autocast=True)
+        elif backend == 'int8':
+            import torch
+            self.module = torch.ao.quantization.quantize_dynamic(image_tower(visual), {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            self.module = image_tower(visual)
+        self.built = backend in ('eager', 'bf16', 'int8')
+
+    def _build(self, images):
+        import torch
+        if self.backend == 'torchscript':
+            with torch.no_grad():
+                self.module = torch.jit.optimize_for_inference(torch.jit.trace(self.module, images, check_trace=False))
+        elif self.backend == 'compile':
+            self.module = torch.compile(self.module, dynamic=True)
+        elif self.backend == 'onnx':
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError('the onnx backend needs onnxruntime (pip install onnx onnxruntime)')
+            path = self.onnx_path
+            if path is None:
+                # the export lives as long as the encoder, and is removed at
+                # exit at the latest
+                self._onnx_directory = tempfile.TemporaryDirectory(prefix='clip-visual-')
+                path = os.path.join(self._onnx_directory.name, 'clip-visual.onnx')
+            torch.onnx.export(self.module, (images,), path, input_names=['images'], output_names=['vectors'],
+                              dynamic_axes={'images': {0: 'batch'}, 'vectors': {0: 'batch'}})
+            options = onnxruntime.SessionOptions()
+            if self.threads:
+                options.intra_op_num_threads = self.threads
+            if self.interop_threads:
+                options.inter_op_num_threads = self.interop_threads
+                options.execution_mode = onnxruntime.ExecutionMode.ORT_PARALLEL
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.built = True
+
+    def encode_image(self, images):
+        import torch
+        images = images.float()
+        if not self.built:
+            self._build(images)
+        if self.session is not None:
+            return torch.from_numpy(self.session.run(None, {'images': images.numpy()})[0])
+        with torch.no_grad():
+            return self.module(images)
+
+    def close(self):
+        # drops the ONNX session and its temporary export; an onnx_path given
+        # by the caller is kept
+        self.session = None
+        self.built = self.backend in ('eager', 'bf16', 'int8')
+        if self._onnx_directory is not None:
+            self._onnx_directory.cleanup()
+            self._onnx_directory = None
+
+
+def load_backend(model, backend='eager', device='cpu', threads=None, interop_threads=None, onnx_path=None):
+    # the encoder EncodePipeline should call; eager returns the model itself
+    # so its vectors stay exactly as before
+    set_threads(threads, interop_threads)
+    if backend == 'eager':
+        return model
+    if device != 'cpu':
+        raise ValueError(f'the {backend} backend runs on the CPU only, not on {device}')
+    return BackendEncoder(model, backend, threads, interop_threads, onnx_path)
+
+
+def load_sample(path, preprocess, count=PARITY_IMAGES, extensions=IMAGE_EXTENSIONS):
+    # (count, 3, h, w) preprocessed images of the first image files of a zip
+    # file or a directory tree of images and zip files
+    import torch
+    from PIL import Image
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, file) for root, _, files in os.walk(path) for file in files)
+    else:
+        paths = [path]
+    images = []
+    for file_path in paths:
+        if len(images) >= count:
+            break
+        if file_path.endswith('.zip'):
+            with zipfile.ZipFile(file_path) as zip_file:
+                for name in zip_file.namelist():
+                    if len(images) >= count:
+                        break
+                    if name.lower().endswith(extensions):
+                        images.append(Image.open(io.BytesIO(zip_file.read(name))).convert('RGB'))
+        elif file_path.lower().endswith(extensions):
+            images.append(Image.open(file_path).convert('RGB'))
+    if not images:
+        raise ValueError(f'no images found in {path}')
+    return torch.stack([preprocess(image) for image in images])
+
+
+def images_per_second(encoder, pixels, repeats=3):
+    # warm up once (tracing, compiling and the ONNX export happen here), then
+    # the best of repeats runs
+    import torch
+    with torch.no_grad():
+        vectors = encoder.encode_image(pixels).float().numpy()
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            encoder.encode_image(pixels)
+            best = min(best, time.perf_counter() - start)
+    return vectors, len(pixels) / max(best, 1e-9)
+
+
+def check_parity(model, encoder, pixels, min_cosine=PARITY_COSINE, repeats=3):
+    # vectors and throughput of a backend against the eager model on the same
+    # preprocessed images
+    reference, eager_rate = images_per_second(model, pixels, repeats)
+    vectors, backend_rate = images_per_second(encoder, pixels, repeats)
+    cosine = np.sum(reference * vectors, axis=1) / np.maximum(np.linalg.norm(reference, axis=1) * np.linalg.norm(vectors, axis=1), 1e-12)
+    report = {
+        'backend': getattr(encoder, 'backend', 'eager'),
+        'images': len(pixels),
+        'min_cosine': float(cosine.min()),
+        'mean_cosine': float(cosine.mean()),
+        'max_abs_diff': float(np.abs(reference - vectors).max()),
+        'eager_images_per_second': eager_rate,
+        'backend_images_per_second': backend_rate,
+        'speedup': backend_rate / eager_rate,
+    }
+    report['passed'] = report['min_cosine'] >= min_cosine
+    return report
+
+
+def format_parity(report):
+    return (f"{report['backend']}: cosine to eager min {report['min_cosine']:.5f} mean {report['mean_cosine']:.5f}, "
+            f"max abs diff {report['max_abs_diff']:.5f}, {report['backend_images_per_second']:.2f} images/s "
+            f"against {report['eager_images_per_second']:.2f} eager ({report['speedup']:.2f}x) on {report['images']} images"
+            f"{'' if report['passed'] else ' - PARITY CHECK FAILED'}")
+
+
+def ensure_parity(model, encoder, pixels, min_cosine=PARITY_COSINE):
+    # runs the parity check and refuses a backend whose vectors drift too far
+    report = check_parity(model, encoder, pixels, min_cosine)
+    print(format_parity(report))
+    if not report['passed']:
+        raise ValueError(f"the {report['backend']} backend is below the parity threshold of {min_cosine}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the CPU backends of an open_clip image encoder with the eager model.')
+    parser.add_argument('images', help='Zip file or directory of images and zip files to take the sample from')
+    parser.add_argument('--model', default='ViT-L-14', help='open_clip model name')
+    parser.add_argument('--pretrained', default='openai', help='open_clip pretrained tag')
+    parser.add_argument('--backend', choices=BACKENDS, nargs='+', default=BACKENDS[1:], help='Backends to compare')
+    parser.add_argument('--count', type=int, default=PARITY_IMAGES, help='Number of sample images')
+    parser.add_argument('--threads', type=int, default=None, help='Intra-op threads')
+    parser.add_argument('--interop-threads', type=int, default=None, help='Inter-op threads')
+    parser.add_argument('--min-cosine', type=float, default=PARITY_COSINE, help='Lowest accepted cosine similarity to the eager vectors')
+    args = parser.parse_args()
+
+    import open_clip
+    set_threads(args.threads, args.interop_threads)
+    model, _, preprocess = open_clip.create_model_and_transforms(args.model, pretrained=args.pretrained)
+    model.eval()
+    pixels = load_sample(args.images, preprocess, args.count)
+    for backend in args.backend:
+        try:
+            report = check_parity(model, load_backend(model, backend, 'cpu', args.threads, args.interop_threads), pixels, args.min_cosine)
+            print(format_parity(report))
+        except Exception as e:
+            print(f'{backend}: {e}')
@@ -0,0 +1,438 @@
+import io
+import os
+import time
+import hashlib
+import collections
+import multiprocessing
+import numpy as np
+from PIL import Image
+from dedup import dhash
+from metrics import metrics
+from clip_backend import BackendEncoder
+
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+DEFAULT_BATCH_SIZE = 32 # images read and decoded together
+# the encode batch size starts at INITIAL_BATCH_SIZE and doubles while that
+# gains at least MIN_GAIN images/s, measured over PROBE_BATCHES batches each
+INITIAL_BATCH_SIZE = 8
+MAX_BATCH_SIZE = 512
+MIN_GAIN = 0.05
+PROBE_BATCHES = 2
+MEMORY_FRACTION = 0.5 # share of the free memory a batch may take
+# activations per byte of input pixels of a CPU forward pass, a rough bound
+# used where the peak memory of a batch can't be measured
+CPU_ACTIVATION_FACTOR = 32
+STAGES = ['read', 'hash', 'cache', 'decode', 'preprocess', 'wait', 'encode']
+
+
+def convert_images(image_data_list):
+    converted_images = []
+    errors = []
+
+    for idx, image_data in enumerate(image_data_list):
+        try:
+            image = Image.open(io.BytesIO(image_data)).convert("RGB")
+            converted_images.append(image)
+        except Exception as e:
+            errors.append((idx, str(e)))
+
+    return converted_images, errors
+
+
+def compute_sha256(image_data_list):
+    return [hashlib.sha256(image_data).hexdigest() for image_data in image_data_list]
+
+
+# preprocess transform, embedding cache and hashes to skip of the current
+# worker process, set by _init_worker
+_preprocess = None
+_cache = None
+_skip = None
+
+
+def _init_worker(preprocess, cache, skip=None):
+    global _preprocess, _cache, _skip
+    _preprocess = preprocess
+    _cache = cache
+    _skip = skip
+    import torch
+    # every worker handles a whole batch on its own, intra-op threads would
+    # only compete with the encoder for the same cores
+    torch.set_num_threads(1)
+
+
+def prepare_batch(batch_data, preprocess=None, cache=None, skip=None):
+    # hash, decode and preprocess one batch into a ready (n, 3, h, w) array.
+    # Images whose hash is in the cache, or that repeat an earlier image of
+    # the batch, are not decoded at all, unless the cache has no dHash for
+    # them yet. Images whose hash is in skip (known duplicates) are dropped
+    # right after hashing.
+    #   'ok'       batch positions that end up with a vector
+    #   'encode'   batch positions of the rows of 'pixels'
+    #   'cached'   {hash: vector} of the cache hits
+    #   'phashes'  {hash: dHash} of the decoded images and the cache hits
+    #   'rehashed' {hash: dHash} of the cache hits that had no dHash yet
+    #   'skipped'  batch positions of the skipped duplicates
+    preprocess = preprocess or _preprocess
+    cache = cache if cache is not None else _cache
+    skip = skip if skip is not None else (_skip or ())
+    timings = {}
+
+    start = time.perf_counter()
+    hashes = compute_sha256(batch_data)
+    timings['hash'] = time.perf_counter() - start
+    skipped = [idx for idx, file_hash in enumerate(hashes) if file_hash in skip]
+
+    start = time.perf_counter()
+    cached = cache.get_many(hashes) if cache is not None else {}
+    phashes = cache.get_phashes(cached) if cached else {}
+    timings['cache'] = time.perf_counter() - start
+
+    to_decode = []
+    seen = set(cached) | {hashes[idx] for idx in skipped}
+    for idx, file_hash in enumerate(hashes):
+        if file_hash not in seen:
+            seen.add(file_hash)
+            to_decode.append(idx)
+
+    start = time.perf_counter()
+    images, conversion_errors = convert_images([batch_data[idx] for idx in to_decode])
+    failed_positions = {idx for idx, _ in conversion_errors}
+    decoded = [idx for position, idx in enumerate(to_decode) if position not in failed_positions]
+    phashes.update((hashes[idx], dhash(image)) for idx, image in zip(decoded, images))
+    # cache hits stored without a dHash are decoded for it, but not encoded
+    unhashed = {}
+    for idx, file_hash in enumerate(hashes):
+        if file_hash in cached and file_hash not in phashes:
+            unhashed.setdefault(file_hash, idx)
+    rehashed = {}
+    if unhashed:
+        rehash_images, rehash_errors = convert_images([batch_data[idx] for idx in unhashed.values()])
+        rehash_failed = {position for position, _ in rehash_errors}
+        rehash_hashes = [file_hash for position, file_hash in enumerate(unhashed) if position not in rehash_failed]
+        rehashed = {file_hash: dhash(image) for file_hash, image in zip(rehash_hashes, rehash_images)}
+        phashes.update(rehashed)
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    import torch
+    pixels = torch.stack([preprocess(image) for image in images]).numpy() if images else None
+    timings['preprocess'] = time.perf_counter() - start
+
+    failed = {hashes[to_decode[idx]]: error for idx, error in conversion_errors}
+    skipped_hashes = {hashes[idx] for idx in skipped}
+    return {
+        'hashes': hashes,
+        'ok': [idx for idx, file_hash in enumerate(hashes) if file_hash not in failed and file_hash not in skipped_hashes],
+        'encode': [idx for idx in to_decode if hashes[idx] not in failed],
+        'cached': cached,
+        'errors': [(idx, failed[file_hash]) for idx, file_hash in enumerate(hashes) if file_hash in failed],
+        'phashes': phashes,
+        'rehashed': rehashed,
+        'skipped': skipped,
+        'pixels': pixels,
+        'bytes': sum(len(image_data) for image_data in batch_data),
+        'timings': timings,
+    }
+
+
+def available_memory(device):
+    # free bytes on the device the encoder runs on, None when unknown
+    if str(device).startswith('cuda'):
+        import torch
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def is_out_of_memory(error):
+    return isinstance(error, MemoryError) or 'out of memory' in str(error) or "can't allocate memory" in str(error)
+
+
+class BatchSizer:
+    # encode batch size tuned from the measured throughput: the size doubles
+    # while images/s improves by at least MIN_GAIN and a batch fits in
+    # MEMORY_FRACTION of the free memory, then it stays at the fastest size
+    # seen. Running out of memory halves the size and caps it there.
+    # A given size is never changed.
+    def __init__(self, device, size=None, initial=INITIAL_BATCH_SIZE, max_size=MAX_BATCH_SIZE):
+        self.device = device
+        self.size = size or initial
+        self.max_size = size or max_size
+        self.settled = size is not None
+        self.rates = {}
+        self.bytes_per_image = None
+
+    def memory_limit(self):
+        free = available_memory(self.device)
+        if free is None or not self.bytes_per_image:
+            return self.max_size
+        return max(1, int(free * MEMORY_FRACTION / self.bytes_per_image))
+
+    def record(self, images, seconds, bytes_per_image=None):
+        # only full batches of the size being probed are measured
+        if self.settled or images != self.size:
+            return
+        if bytes_per_image:
+            self.bytes_per_image = max(self.bytes_per_image or 0, bytes_per_image)
+        self.rates.setdefault(self.size, []).append(images / max(seconds, 1e-9))
+        if len(self.rates[self.size]) < PROBE_BATCHES:
+            return
+
+        # the first batch of a size may include warm-up, the best one counts
+        rate = max(self.rates[self.size])
+        smaller = self.rates.get(self.size // 2)
+        if smaller and rate < max(smaller) * (1 + MIN_GAIN):
+            # not worth the extra latency and memory
+            self.size //= 2
+            self.settled = True
+        elif self.size * 2 <= min(self.max_size, self.memory_limit()):
+            self.size *= 2
+        else:
+            self.settled = True
+
+    def out_of_memory(self):
+        if self.size == 1:
+            return False
+        self.size //= 2
+        self.max_size = self.size
+        self.settled = True
+        return True
+
+
+class PipelineStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.images = 0
+        self.cached = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+
+    def add(self, stage, seconds):
+        self.seconds[stage] += seconds
+        metrics.observe('stage_seconds', seconds, stage=stage)
+
+    def report(self):
+        wall = max(time.perf_counter() - self.start, 1e-9)
+        lines = [f"{self.images} images, {self.bytes / (1024 * 1024):.2f} MB in {wall:.2f} s "
+                 f"({self.images / wall:.2f} images/s, {self.bytes / (wall * 1024 * 1024):.2f} MB/s), "
+                 f"{self.cached} served from the embedding cache, {self.skipped} duplicates skipped"]
+        for stage in STAGES:
+            seconds = self.seconds[stage]
+            rate = f"{self.images / seconds:.2f} images/s" if seconds > 0 else "-"
+            lines.append(f"  {stage:<10} {seconds:8.2f} s  {rate}")
+        return '\n'.join(lines)
+
+
+class EncodePipeline:
+    # decode/hash/preprocess runs in a pool of worker processes and feeds a
+    # bounded queue of ready batches in front of model.encode_image, so the
+    # next batches are decoded while the current one is encoded.
+    # With workers=0 everything runs serially in the calling process.
+    # When an EmbeddingCache is given, cached images skip decoding and
+    # encoding and newly encoded vectors are added to the cache. Images whose
+    # sha256 is in skip are neither decoded nor encoded.
+    # The rows of consecutive batches are encoded together in batches of
+    # batch_size, or of a size tuned by BatchSizer when batch_size is None,
+    # whatever the size of the batches read.
+    def __init__(self, model, preprocess, device, workers=DEFAULT_WORKERS, queue_depth=None, cache=None, skip=None, batch_size=None):
+        self.model = model
+        self.preprocess = preprocess
+        self.device = device
+        self.cache = cache
+        self.skip = frozenset(skip or ())
+        self.workers = workers
+        self.queue_depth = queue_depth or max(2, 2 * workers)
+        self.stats = PipelineStats()
+        self.sizer = BatchSizer(device, batch_size)
+        # batches waiting for their vectors, in input order, and the rows of
+        # them that are not encoded yet
+        self.waiting = collections.deque()
+        self.rows = collections.deque()
+        self.pool = None
+        if workers > 0:
+            self.pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(preprocess, cache, self.skip))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        if self.cache is not None:
+            self.cache.close()
+        # the ONNX backend keeps its export in a temporary directory
+        if isinstance(self.model, BackendEncoder):
+            self.model.close()
+
+    def _encode_batch(self, pixels):
+        # vectors of one batch and the bytes per image it needed at its peak
+        import torch
+        cuda = str(self.device).startswith('cuda')
+        if cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+            before = torch.cuda.memory_allocated(self.device)
+        image_inputs = torch.from_numpy(pixels).to(self.device)
+        with torch.no_grad():
+            image_features = self.model.encode_image(image_inputs)
+        vectors = image_features.cpu().numpy()
+        if cuda:
+            return vectors, (torch.cuda.max_memory_allocated(self.device) - before) / len(pixels)
+        return vectors, pixels[0].nbytes * CPU_ACTIVATION_FACTOR
+
+    def encode(self, pixels):
+        # encodes the rows in batches of the current batch size; a batch that
+        # runs out of memory is retried at half the size
+        vectors = []
+        done = 0
+        while done < len(pixels):
+            batch = pixels[done:done + self.sizer.size]
+            start = time.perf_counter()
+            try:
+                batch_vectors, bytes_per_image = self._encode_batch(batch)
+            except (RuntimeError, MemoryError) as e:
+                if not is_out_of_memory(e) or not self.sizer.out_of_memory():
+                    raise
+                if str(self.device).startswith('cuda'):
+                    import torch
+                    torch.cuda.empty_cache()
+                print(f"Out of memory at {len(batch)} images per batch, continuing with {self.sizer.size}")
+                metrics.count('out_of_memory')
+                continue
+            seconds = time.perf_counter() - start
+            self.stats.add('encode', seconds)
+            metrics.count('encoded_images', len(batch))
+            self.sizer.record(len(batch), seconds, bytes_per_image)
+            metrics.gauge('encode_batch_size', self.sizer.size)
+            vectors.append(batch_vectors)
+            done += len(batch)
+        return np.concatenate(vectors)
+
+    def _collect(self, key, prepared):
+        # queues a prepared batch for encoding and yields the batches whose
+        # vectors are complete
+        for stage, seconds in prepared['timings'].items():
+            self.stats.add(stage, seconds)
+        self.stats.images += len(prepared['hashes'])
+        self.stats.skipped += len(prepared['skipped'])
+        self.stats.bytes += prepared['bytes']
+        metrics.count('images', len(prepared['hashes']))
+        metrics.count('image_bytes', prepared['bytes'])
+        metrics.count('skipped_images', len(prepared['skipped']))
+        metrics.count('decode_errors', len(prepared['errors']))
+        item = {'key': key, 'prepared': prepared, 'encoded': [], 'missing': 0}
+        if prepared['pixels'] is not None:
+            item['missing'] = len(prepared['pixels'])
+            self.rows.append((item, prepared['pixels']))
+        self.waiting.append(item)
+        if sum(len(pixels) for _, pixels in self.rows) >= self.sizer.size:
+            yield from self._flush(final=False)
+        else:
+            yield from self._complete()
+
+    def _flush(self, final):
+        # encodes the waiting rows in whole batches (all of them when final)
+        # and yields the batches that are complete
+        total = sum(len(pixels) for _, pixels in self.rows)
+        take = total if final else total - total % self.sizer.size
+        if take:
+            owners = []
+            parts = []
+            while sum(len(part) for part in parts) < take:
+                item, pixels = self.rows.popleft()
+                needed = take - sum(len(part) for part in parts)
+                if len(pixels) > needed:
+                    self.rows.appendleft((item, pixels[needed:]))
+                    pixels = pixels[:needed]
+                owners.append((item, len(pixels)))
+                parts.append(pixels)
+            vectors = self.encode(np.concatenate(parts))
+            start = 0
+            for item, count in owners:
+                item['encoded'].append(vectors[start:start + count])
+                item['missing'] -= count
+                start += count
+        yield from self._complete()
+
+    def _complete(self):
+        while self.waiting and self.waiting[0]['missing'] == 0:
+            yield self._finish(self.waiting.popleft())
+
+    def _finish(self, item):
+        prepared = item['prepared']
+        encoded = []
+        if item['encoded']:
+            hashes = [prepared['hashes'][idx] for idx in prepared['encode']]
+            encoded = list(zip(hashes, np.concatenate(item['encoded'])))
+            if self.cache is not None:
+                self.cache.put_many((file_hash, vector, prepared['phashes'].get(file_hash)) for file_hash, vector in encoded)
+        if self.cache is not None and prepared['rehashed']:
+            self.cache.put_phashes(prepared['rehashed'].items())
+
+        # vectors come back aligned with prepared['ok']
+        by_hash = dict(prepared['cached'])
+        by_hash.update(encoded)
+        cached = sum(1 for idx in prepared['ok'] if prepared['hashes'][idx] in prepared['cached'])
+        self.stats.cached += cached
+        metrics.count('cached_images', cached)
+        if not prepared['ok']:
+            return item['key'], prepared, np.empty((0, 0), dtype=np.float32)
+        vectors = np.stack([by_hash[prepared['hashes'][idx]] for idx in prepared['ok']])
+        return item['key'], prepared, vectors
+
+    def _next(self, batches):
+        start = time.perf_counter()
+        batch = next(batches, None)
+        self.stats.add('read', time.perf_counter() - start)
+        return batch
+
+    def run(self, batches):
+        # batches yields (key, batch_data), the key (e.g. the file names) is
+        # passed through untouched; results come back in input order as
+        # (key, prepared, vectors). A batch comes back once all its rows are
+        # encoded, which may wait for rows of the batches after it.
+        try:
+            yield from self._run(iter(batches))
+        finally:
+            # a run the consumer gave up on leaves nothing for the next one
+            self.waiting.clear()
+            self.rows.clear()
+
+    def _run(self, batches):
+        if self.pool is None:
+            while (batch := self._next(batches)) is not None:
+                key, batch_data = batch
+                yield from self._collect(key, prepare_batch(batch_data, self.preprocess, self.cache, self.skip))
+            yield from self._flush(final=True)
+            return
+
+        pending = collections.deque()
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < self.queue_depth:
+                batch = self._next(batches)
+                if batch is None:
+                    exhausted = True
+                    break
+                key, batch_data = batch
+                pending.append((key, self.pool.apply_async(prepare_batch, (batch_data,))))
+            if not pending:
+                break
+
+            key, result = pending.popleft()
+            start = time.perf_counter()
+            prepared = result.get()
+            self.stats.add('wait', time.perf_counter() - start)
+            yield from self._collect(key, prepared)
+        yield from self._flush(final=True)
@@ -0,0 +1,196 @@
+import os
+import json
+import argparse
+import numpy as np
+from PIL import Image
+from vector_index import find_sources, read_source, normalize, source_model
+
+# near-duplicate groups are found from three signals, any one of them links
+# two images:
+#   - equal sha256 (file_hash / FileHash)
+#   - difference hashes (dHash) at most PHASH_DISTANCE bits apart
+#   - clip vectors with a cosine similarity of at least SIMILARITY
+# The report lists every group with the image that is kept (the first in
+# source and name order) and the duplicates that can be skipped.
+HASH_SIZE = 8 # 8 x 8 = 64 bit dHash
+PHASH_DISTANCE = 4
+SIMILARITY = 0.97
+BLOCK_SIZE = 4096 # rows compared per block of the similarity join
+REPORT_FILE_NAME = 'duplicates.json'
+HASH_FIELDS = ('file_hash', 'FileHash')
+NAME_FIELDS = ('file_name', 'FileName')
+PHASH_FIELDS = ('file_phash',)
+# set bits of every byte value, np.bitwise_count needs numpy 2
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1, dtype=np.uint8)
+
+
+def dhash(image, hash_size=HASH_SIZE):
+    # difference hash of a decoded image as 16 hex digits: one bit per
+    # horizontally adjacent pixel pair of a (hash_size + 1) x hash_size
+    # grayscale thumbnail
+    image = image.convert('L').resize((hash_size + 1, hash_size), Image.BOX)
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).reshape(-1)
+    return f'{int(np.packbits(bits).view(">u8")[0]):016x}'
+
+
+class UnionFind:
+    def __init__(self, size):
+        self.parent = np.arange(size)
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            # the smaller index stays the root, so the first image is kept
+            self.parent[max(a, b)] = min(a, b)
+
+    def union_pairs(self, left, right):
+        for a, b in zip(left.tolist(), right.tolist()):
+            self.union(a, b)
+
+
+def blocked_pairs(items, matches, block_size=BLOCK_SIZE):
+    # (i, j) with i < j of every pair for which matches(rows, columns) is
+    # true, computed one block_size x block_size tile of the upper triangle
+    # at a time so memory stays bounded
+    for row_start in range(0, len(items), block_size):
+        rows = items[row_start:row_start + block_size]
+        for column_start in range(row_start, len(items), block_size):
+            left, right = np.nonzero(matches(rows, items[column_start:column_start + block_size]))
+            left += row_start
+            right += column_start
+            keep = left < right
+            yield left[keep], right[keep]
+
+
+def similar_pairs(vectors, threshold=SIMILARITY, block_size=BLOCK_SIZE):
+    # pairs of rows whose cosine similarity is at least threshold
+    return blocked_pairs(normalize(vectors), lambda rows, columns: rows @ columns.T >= threshold, block_size)
+
+
+def bit_distance(rows, columns):
+    # number of differing bits between every pair of 64 bit hashes
+    differences = np.ascontiguousarray(rows[:, None] ^ columns[None, :]).view(np.uint8)
+    return POPCOUNT[differences].reshape(len(rows), len(columns), 8).sum(axis=2, dtype=np.uint8)
+
+
+def close_hashes(phashes, distance=PHASH_DISTANCE, block_size=BLOCK_SIZE):
+    # pairs of 64 bit hashes at most distance bits apart
+    return blocked_pairs(phashes, lambda rows, columns: bit_distance(rows, columns) <= distance, block_size)
+
+
+def field(record, names):
+    return next((record[name] for name in names if record.get(name)), None)
+
+
+def find_duplicates(records, vectors, similarity=SIMILARITY, phash_distance=PHASH_DISTANCE):
+    # [[positions]] of every group of two or more near-identical images,
+    # each group in position order
+    groups = UnionFind(len(records))
+
+    first_by_hash = {}
+    for position, record in enumerate(records):
+        file_hash = field(record, HASH_FIELDS)
+        if file_hash:
+            groups.union(first_by_hash.setdefault(file_hash, position), position)
+
+    with_phash = [position for position, record in enumerate(records) if field(record, PHASH_FIELDS)]
+    if with_phash:
+        phashes = np.array([int(field(records[position], PHASH_FIELDS), 16) for position in with_phash], dtype=np.uint64)
+        with_phash = np.array(with_phash)
+        for left, right in close_hashes(phashes, phash_distance):
+            groups.union_pairs(with_phash[left], with_phash[right])
+
+    if len(vectors):
+        for left, right in similar_pairs(vectors, similarity):
+            groups.union_pairs(left, right)
+
+    members = {}
+    for position in range(len(records)):
+        members.setdefault(groups.find(position), []).append(position)
+    return [group for group in members.values() if len(group) > 1]
+
+
+def build_report(paths, similarity=SIMILARITY, phash_distance=PHASH_DISTANCE):
+    records = []
+    vectors = []
+    models = {}
+    for path in find_sources(paths):
+        source_records, source_vectors = read_source(path)
+        if not source_records:
+            continue
+        # vectors of different clip models are not comparable, even when
+        # they have the same dimension
+        model = source_model(source_records[0])
+        if model != (None, None):
+            models.setdefault(model, path)
+            if len(models) > 1:
+                first_model, first_path = next(iter(models.items()))
+                raise ValueError(f'{path} was embedded with {model[0]} ({model[1]}) but {first_path} with {first_model[0]} ({first_model[1]}), '
+                                 'vectors of different clip models can\'t be compared')
+        for record in source_records:
+            record.setdefault('source', os.path.basename(path))
+        records.extend(source_records)
+        vectors.append(source_vectors)
+    vectors = np.concatenate(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    report_groups = []
+    for group in find_duplicates(records, vectors, similarity, phash_distance):
+        members = [{'source': records[position]['source'],
+                    'file_name': field(records[position], NAME_FIELDS),
+                    'file_hash': field(records[position], HASH_FIELDS)} for position in group]
+        report_groups.append({'keep': members[0], 'duplicates': members[1:]})
+    return {
+        'similarity': similarity,
+        'phash_distance': phash_distance,
+        'images': len(records),
+        'duplicates': sum(len(group['duplicates']) for group in report_groups),
+        'groups': report_groups,
+    }
+
+
+def write_report(path, report):
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(f'{path}.tmp', path)
+
+
+def load_skip_set(path):
+    # (file hashes, file names) of the duplicates in a report, the images
+    # that are kept are not in either set
+    with open(path, 'r') as f:
+        report = json.load(f)
+    hashes = set()
+    names = set()
+    for group in report['groups']:
+        keep = group['keep']
+        for member in group['duplicates']:
+            # an exact copy of the kept image has the same hash (or, in
+            # another archive, the same name) and must not take the kept
+            # image with it
+            if member['file_hash'] and member['file_hash'] != keep['file_hash']:
+                hashes.add(member['file_hash'])
+            if member['file_name'] and member['file_name'] != keep['file_name']:
+                names.add(member['file_name'])
+    return hashes, names
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find groups of near-duplicate images in the generated clip vectors.')
+    parser.add_argument('sources', nargs='+', help='Embedding stores, JSON outputs or directories of them')
+    parser.add_argument('--output', default=REPORT_FILE_NAME, help=f'Path of the report (defaults to {REPORT_FILE_NAME})')
+    parser.add_argument('--similarity', type=float, default=SIMILARITY, help='Cosine similarity from which two clip vectors are duplicates')
+    parser.add_argument('--phash-distance', type=int, default=PHASH_DISTANCE, help='Number of differing dHash bits up to which two images are duplicates')
+    args = parser.parse_args()
+
+    report = build_report(args.sources, args.similarity, args.phash_distance)
+    write_report(args.output, report)
+    print(f"{report['duplicates']} duplicates of {report['images']} images in {len(report['groups'])} groups written to {args.output}")
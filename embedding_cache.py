@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import numpy as np
+
+CACHE_FILE_NAME = 'embedding-cache.sqlite'
+# keep the IN (...) lists well below sqlite's host parameter limit
+QUERY_CHUNK = 500
+
+
+class EmbeddingCache:
+    # persistent (file hash, model, pretrained) -> vector and dHash cache in
+    # a sqlite file. The connection is opened lazily and reopened after a fork or when
+    # the object is unpickled, so one cache object can be handed to worker
+    # processes. WAL mode lets readers in workers run next to the writer.
+    def __init__(self, path, model_name, pretrained):
+        self.path = path
+        self.model_name = model_name
+        self.pretrained = pretrained
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    def _connect(self):
+        if self._connection is not None and self._pid == os.getpid():
+            return self._connection
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._connection = sqlite3.connect(self.path, timeout=60)
+        self._pid = os.getpid()
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                file_hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                pretrained TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                phash TEXT,
+                PRIMARY KEY (file_hash, model, pretrained)
+            )''')
+        # caches written before the dHash was stored get the column
+        columns = {row[1] for row in self._connection.execute('PRAGMA table_info(embeddings)')}
+        if 'phash' not in columns:
+            try:
+                self._connection.execute('ALTER TABLE embeddings ADD COLUMN phash TEXT')
+            except sqlite3.OperationalError:
+                # another process added it first
+                pass
+        self._connection.commit()
+        return self._connection
+
+    def get_many(self, hashes):
+        # returns {hash: float32 vector} for the hashes found in the cache
+        connection = self._connect()
+        hashes = list(dict.fromkeys(hashes))
+        found = {}
+        for start in range(0, len(hashes), QUERY_CHUNK):
+            chunk = hashes[start:start + QUERY_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = connection.execute(
+                f'SELECT file_hash, vector FROM embeddings WHERE model = ? AND pretrained = ? AND file_hash IN ({placeholders})',
+                [self.model_name, self.pretrained, *chunk])
+            for file_hash, vector in rows:
+                found[file_hash] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def get(self, file_hash):
+        return self.get_many([file_hash]).get(file_hash)
+
+    def get_phashes(self, hashes):
+        # returns {hash: dHash} for the hashes whose entry has one
+        connection = self._connect()
+        hashes = list(dict.fromkeys(hashes))
+        found = {}
+        for start in range(0, len(hashes), QUERY_CHUNK):
+            chunk = hashes[start:start + QUERY_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = connection.execute(
+                f'SELECT file_hash, phash FROM embeddings WHERE model = ? AND pretrained = ? AND phash IS NOT NULL AND file_hash IN ({placeholders})',
+                [self.model_name, self.pretrained, *chunk])
+            found.update(rows)
+        return found
+
+    def put_many(self, items):
+        # items is an iterable of (hash, vector) or (hash, vector, dHash); a
+        # missing dHash keeps the one already stored
+        rows = []
+        for item in items:
+            file_hash, vector = item[:2]
+            phash = item[2] if len(item) > 2 else None
+            vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+            rows.append((file_hash, self.model_name, self.pretrained, len(vector), vector.tobytes(), phash))
+        if not rows:
+            return
+        connection = self._connect()
+        with connection:
+            connection.executemany('''
+                INSERT INTO embeddings (file_hash, model, pretrained, dim, vector, phash) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (file_hash, model, pretrained) DO UPDATE SET
+                    dim = excluded.dim, vector = excluded.vector, phash = COALESCE(excluded.phash, embeddings.phash)''', rows)
+
+    def put_phashes(self, items):
+        # items is an iterable of (hash, dHash) of entries already cached
+        rows = [(phash, file_hash, self.model_name, self.pretrained) for file_hash, phash in items]
+        if not rows:
+            return
+        connection = self._connect()
+        with connection:
+            connection.executemany('UPDATE embeddings SET phash = ? WHERE file_hash = ? AND model = ? AND pretrained = ?', rows)
+
+    def __len__(self):
+        connection = self._connect()
+        return connection.execute('SELECT COUNT(*) FROM embeddings WHERE model = ? AND pretrained = ?',
+                                  [self.model_name, self.pretrained]).fetchone()[0]
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+        self._pid = None
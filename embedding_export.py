@@ -0,0 +1,282 @@
+import os
+import json
+import argparse
+import itertools
+import numpy as np
+from embedding_store import write_embedding_store, store_name
+from vector_index import find_sources, iter_source, normalize
+
+# exports generator outputs as smaller embedding stores, one per source:
+#   float16  half precision, 2x smaller
+#   int8     per dimension scalar quantization, 4x smaller; the scale and
+#            offset of every dimension are stored in the codec
+#   pca      projection on the first pca_dims principal components, can be
+#            combined with either of the above
+# The codec (mean, components, scale, offset) is fitted in streaming passes
+# over the sources, so the vectors never have to fit in memory at once, and
+# is saved as codec.npz + codec.json next to the exported stores. A store
+# that holds int8 codes or PCA projections is marked as encoded, so readers
+# expecting clip vectors refuse it.
+QUANTIZATIONS = ['float32', 'float16', 'int8']
+CODEC_FILE_NAME = 'codec'
+REPORT_FILE_NAME = 'export-report.json'
+REPORT_QUERIES = 1000 # queries the recall is measured with
+REPORT_BASE = 100000 # vectors the queries are searched in
+DEFAULT_RECALL_K = 10
+CHUNK_SIZE = 65536 # rows processed at a time
+
+
+def iter_chunks(sources, with_records=True):
+    # (source, records, float32 vectors) of every source in chunks of
+    # CHUNK_SIZE rows, stores are read through their memory map
+    for path in sources:
+        for records, vectors in iter_source(path, CHUNK_SIZE, with_records):
+            if len(vectors):
+                yield path, records, vectors
+
+
+class Codec:
+    def __init__(self, quantize='float16', pca_dims=None, mean=None, components=None, scale=None, offset=None):
+        if quantize not in QUANTIZATIONS:
+            raise ValueError(f'quantize must be one of {QUANTIZATIONS}, got {quantize}')
+        self.quantize = quantize
+        self.pca_dims = pca_dims
+        self.mean = mean
+        self.components = components
+        self.scale = scale
+        self.offset = offset
+
+    def project(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.components is None:
+            return vectors
+        return (vectors - self.mean) @ self.components.T
+
+    def encode(self, vectors):
+        projected = self.project(vectors)
+        if self.quantize == 'int8':
+            levels = np.rint((projected - self.offset) / self.scale) - 128
+            return np.clip(levels, -128, 127).astype(np.int8)
+        return projected.astype(self.quantize)
+
+    def decode(self, encoded):
+        # float32 vectors in the (possibly reduced) exported space
+        if self.quantize == 'int8':
+            return (encoded.astype(np.float32) + 128) * self.scale + self.offset
+        return encoded.astype(np.float32)
+
+    def reconstruct(self, encoded):
+        # float32 vectors in the original space
+        decoded = self.decode(encoded)
+        if self.components is None:
+            return decoded
+        return decoded @ self.components + self.mean
+
+    def bytes_per_vector(self, dim):
+        dims = self.pca_dims or dim
+        return dims * np.dtype(self.quantize).itemsize
+
+    def encoding(self):
+        # marker of the exported stores, None when they hold plain vectors
+        if self.quantize != 'int8' and self.components is None:
+            return None
+        return {'quantize': self.quantize, 'pca_dims': self.pca_dims, 'codec': CODEC_FILE_NAME}
+
+    def save(self, output_directory):
+        base = os.path.join(output_directory, CODEC_FILE_NAME)
+        arrays = {name: value for name, value in
+                  (('mean', self.mean), ('components', self.components), ('scale', self.scale), ('offset', self.offset))
+                  if value is not None}
+        np.savez(f'{base}.npz', **arrays)
+        with open(f'{base}.json', 'w') as f:
+            json.dump({'quantize': self.quantize, 'pca_dims': self.pca_dims}, f, indent=1)
+
+    @classmethod
+    def load(cls, output_directory):
+        base = os.path.join(output_directory, CODEC_FILE_NAME)
+        with open(f'{base}.json', 'r') as f:
+            info = json.load(f)
+        with np.load(f'{base}.npz') as arrays:
+            return cls(info['quantize'], info['pca_dims'], **{name: arrays[name] for name in arrays.files})
+
+
+def fit_codec(sources, quantize='float16', pca_dims=None):
+    # one pass for the mean and covariance (when reducing), one more for the
+    # range of every dimension (when quantizing to int8)
+    codec = Codec(quantize, pca_dims)
+    if pca_dims:
+        count = 0
+        total = None
+        gram = None
+        for _, _, vectors in iter_chunks(sources, with_records=False):
+            vectors = vectors.astype(np.float64)
+            if total is None:
+                total = np.zeros(vectors.shape[1])
+                gram = np.zeros((vectors.shape[1], vectors.shape[1]))
+            count += len(vectors)
+            total += vectors.sum(axis=0)
+            gram += vectors.T @ vectors
+        if not count:
+            raise ValueError('no vectors found in the sources')
+        mean = total / count
+        covariance = (gram - count * np.outer(mean, mean)) / max(count - 1, 1)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:pca_dims]
+        codec.mean = mean.astype(np.float32)
+        codec.components = eigenvectors[:, order].T.astype(np.float32)
+        codec.explained_variance = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+
+    if quantize == 'int8':
+        low = None
+        high = None
+        for _, _, vectors in iter_chunks(sources, with_records=False):
+            projected = codec.project(vectors)
+            low = projected.min(axis=0) if low is None else np.minimum(low, projected.min(axis=0))
+            high = projected.max(axis=0) if high is None else np.maximum(high, projected.max(axis=0))
+        if low is None:
+            raise ValueError('no vectors found in the sources')
+        codec.offset = low.astype(np.float32)
+        codec.scale = np.maximum((high - low) / 255, 1e-12).astype(np.float32)
+    return codec
+
+
+class Sample:
+    # a uniform random sample of at most size vectors of a stream: every
+    # vector draws a random key and the size smallest keys are kept
+    def __init__(self, size=REPORT_BASE, seed=0):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.total = 0
+        self.keys = np.empty(0)
+        self.vectors = None
+
+    def add(self, vectors):
+        self.total += len(vectors)
+        keys = np.concatenate([self.keys, self.rng.random(len(vectors))])
+        vectors = vectors if self.vectors is None else np.concatenate([self.vectors, vectors])
+        keep = np.sort(np.argpartition(keys, self.size)[:self.size]) if len(keys) > self.size else np.arange(len(keys))
+        self.keys = keys[keep]
+        self.vectors = vectors[keep]
+
+
+def export_names(sources):
+    # name of the exported store of every source: its path relative to the
+    # directory all sources are under, so same-named stores of different
+    # directories don't overwrite each other
+    if not sources:
+        return {}
+    bases = [os.path.abspath(store_name(path) if path.endswith('.npy') else os.path.splitext(path)[0]) for path in sources]
+    root = os.path.commonpath([os.path.dirname(base) for base in bases])
+    names = {}
+    paths = {}
+    for path, base in zip(sources, bases):
+        name = os.path.relpath(base, root)
+        if name in paths:
+            raise ValueError(f'{path} and {paths[name]} would both be exported as {name}')
+        names[path] = name
+        paths[name] = path
+    return names
+
+
+def export(sources, output_directory, codec, sample=None):
+    # writes one exported store per source; returns the stores written. The
+    # vectors are added to sample on the way, so evaluating the export needs
+    # no further pass over the sources
+    names = export_names(sources)
+    written = []
+    for path, chunks in itertools.groupby(iter_chunks(sources), key=lambda chunk: chunk[0]):
+        records = []
+        encoded = []
+        for _, chunk_records, vectors in chunks:
+            records.extend(chunk_records)
+            encoded.append(codec.encode(vectors))
+            if sample is not None:
+                sample.add(vectors)
+        name = names[path]
+        os.makedirs(os.path.join(output_directory, os.path.dirname(name)), exist_ok=True)
+        written.append(write_embedding_store(output_directory, name, records, np.concatenate(encoded), codec.quantize, codec.encoding())[0])
+    if not written:
+        raise ValueError('no vectors found in the sources')
+    codec.save(output_directory)
+    return written
+
+
+def evaluate(sample, codec, queries=REPORT_QUERIES, k=DEFAULT_RECALL_K, seed=0):
+    # reconstruction error and recall@k of the exported vectors against the
+    # original ones on a Sample of the sources
+    total = sample.total
+    if not total:
+        raise ValueError('no vectors found in the sources')
+    rng = np.random.default_rng(seed)
+    sample = sample.vectors
+    encoded = codec.encode(sample)
+
+    reconstructed = codec.reconstruct(encoded)
+    error = np.sum((sample - reconstructed) ** 2, axis=1) / np.maximum(np.sum(sample ** 2, axis=1), 1e-12)
+    cosine = np.sum(normalize(sample) * normalize(reconstructed), axis=1)
+
+    # top k in the exported space against the exact top k in the original
+    # space, the query itself left out of both. A found vector is a hit when
+    # it scores at least the k-th best original score, so exact duplicates
+    # and other ties count whichever of them is returned
+    k = min(k, len(sample) - 1)
+    query_rows = rng.choice(len(sample), min(queries, len(sample)), replace=False)
+    original = normalize(sample)
+    exported = normalize(codec.decode(encoded))
+    hits = 0
+    for start in range(0, len(query_rows) if k > 0 else 0, 256):
+        rows = query_rows[start:start + 256]
+        itself = (np.arange(len(rows)), rows)
+        truth = original[rows] @ original.T
+        truth[itself] = -np.inf
+        scores = exported[rows] @ exported.T
+        scores[itself] = -np.inf
+        kth = -np.partition(-truth, k - 1, axis=1)[:, k - 1]
+        found = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        hits += int(np.sum(np.take_along_axis(truth, found, axis=1) >= kth[:, None]))
+
+    dim = sample.shape[1]
+    report = {
+        'quantize': codec.quantize,
+        'pca_dims': codec.pca_dims,
+        'vectors': total,
+        'sample': len(sample),
+        'bytes_per_vector': codec.bytes_per_vector(dim),
+        'compression': dim * 4 / codec.bytes_per_vector(dim),
+        'relative_squared_error': float(error.mean()),
+        'mean_cosine': float(cosine.mean()),
+        f'recall@{k}': hits / (len(query_rows) * k) if k > 0 else None,
+    }
+    if getattr(codec, 'explained_variance', None) is not None:
+        report['explained_variance'] = codec.explained_variance
+    return report
+
+
+def add_arguments(parser):
+    parser.add_argument('sources', nargs='+', help='Embedding stores, JSON outputs or directories of them')
+    parser.add_argument('--output', required=True, help='Directory of the exported stores and codec')
+    parser.add_argument('--quantize', choices=QUANTIZATIONS, default='float16', help='Storage of every exported dimension')
+    parser.add_argument('--pca-dims', type=int, default=None, help='Keep only this many principal components')
+    parser.add_argument('--recall-k', type=int, default=DEFAULT_RECALL_K, help='k of the reported recall@k')
+    parser.add_argument('--no-report', action='store_true', help='Skip measuring reconstruction error and recall')
+
+
+def run(args):
+    sources = find_sources(args.sources)
+    if not sources:
+        raise ValueError(f"no stores found under {', '.join(args.sources)}")
+    codec = fit_codec(sources, args.quantize, args.pca_dims)
+    sample = None if args.no_report else Sample()
+    written = export(sources, args.output, codec, sample)
+    print(f'Exported {len(written)} stores to {args.output}')
+    if not args.no_report:
+        report = evaluate(sample, codec, k=args.recall_k)
+        with open(os.path.join(args.output, REPORT_FILE_NAME), 'w') as f:
+            json.dump(report, f, indent=1)
+        print(json.dumps(report, indent=1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export clip vectors in reduced precision and/or reduced dimensions.')
+    add_arguments(parser)
+    run(parser.parse_args())
@@ -0,0 +1,101 @@
+import os
+import json
+import zlib
+import struct
+import numpy as np
+
+JOURNAL_SUFFIX = '.journal'
+MAGIC = b'KCGJ'
+# magic, header length, vector bytes length, crc32 of header + vectors
+ENTRY_HEADER = struct.Struct('<4sIQI')
+
+
+class EmbeddingJournal:
+    # append-only write-ahead journal of the batches that finished encoding
+    # for one output. Every entry is fsynced before append() returns, so a
+    # restarted run can continue after the last committed batch. A torn entry
+    # at the end of the file (crash in the middle of a write) is dropped.
+    #
+    # entry layout: ENTRY_HEADER, JSON header {records, errors, dtype, shape},
+    # raw vector bytes
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _scan(self):
+        # yields (end offset, records, errors, vectors) of every committed entry
+        if not self.exists():
+            return
+        with open(self.path, 'rb') as f:
+            while True:
+                prefix = f.read(ENTRY_HEADER.size)
+                if len(prefix) < ENTRY_HEADER.size:
+                    return
+                magic, header_length, vectors_length, checksum = ENTRY_HEADER.unpack(prefix)
+                if magic != MAGIC:
+                    return
+                header = f.read(header_length)
+                vector_bytes = f.read(vectors_length)
+                if len(header) < header_length or len(vector_bytes) < vectors_length:
+                    return
+                if zlib.crc32(vector_bytes, zlib.crc32(header)) != checksum:
+                    return
+                header = json.loads(header)
+                vectors = np.frombuffer(vector_bytes, dtype=header['dtype']).reshape(header['shape'])
+                yield f.tell(), header['records'], header['errors'], vectors
+
+    def entries(self):
+        # yields (records, errors, vectors) of every committed entry
+        for _, records, errors, vectors in self._scan():
+            yield records, errors, vectors
+
+    def recover(self):
+        # cut off a torn last entry so new entries are appended after the
+        # last committed one; returns (records, errors, vectors) of the
+        # committed entries
+        records = []
+        errors = []
+        vectors = []
+        length = 0
+        for length, entry_records, entry_errors, entry_vectors in self._scan():
+            records.extend(entry_records)
+            errors.extend(entry_errors)
+            vectors.extend(entry_vectors)
+        if self.exists() and length != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(length)
+        return records, errors, vectors
+
+    def done(self, key='file_name'):
+        # names of the items already committed, successful or failed
+        done = set()
+        for records, errors, _ in self.entries():
+            done.update(record[key] for record in records)
+            done.update(error[1] for error in errors)
+        return done
+
+    def append(self, records, vectors, errors=()):
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32))
+        if not records:
+            vectors = np.empty((0, 0), dtype=np.float32)
+        header = json.dumps({
+            'records': records,
+            'errors': [list(error) for error in errors],
+            'dtype': str(vectors.dtype),
+            'shape': list(vectors.shape),
+        }, separators=(',', ':')).encode('utf-8')
+        vector_bytes = vectors.tobytes()
+        checksum = zlib.crc32(vector_bytes, zlib.crc32(header))
+
+        with open(self.path, 'ab') as f:
+            f.write(ENTRY_HEADER.pack(MAGIC, len(header), len(vector_bytes), checksum))
+            f.write(header)
+            f.write(vector_bytes)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
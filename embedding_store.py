@@ -0,0 +1,246 @@
+import os
+import json
+import mmap
+import argparse
+import numpy as np
+from metrics import metrics
+
+# an embedding store is a pair of files per archive:
+#   <name>.npy         - contiguous (rows, dim) matrix of clip vectors
+#   <name>.meta.jsonl  - one JSON record per line, row i describes vector i
+#   <name>.offsets.npy - byte offset of every metadata line (rows + 1 entries)
+#   <name>.encoding.json - only in stores that hold codes instead of clip
+#                        vectors (int8 or PCA exports): how they were encoded
+VECTORS_SUFFIX = '.npy'
+METADATA_SUFFIX = '.meta.jsonl'
+OFFSETS_SUFFIX = '.offsets.npy'
+ENCODING_SUFFIX = '.encoding.json'
+DTYPES = ['float16', 'float32']
+OUTPUT_FORMATS = ['npy', 'json', 'both']
+JSON_INDENT = 4
+
+
+def store_paths(output_directory, name):
+    base = os.path.join(output_directory, name)
+    return base + VECTORS_SUFFIX, base + METADATA_SUFFIX
+
+
+def offsets_path(vectors_path):
+    return store_name(vectors_path) + OFFSETS_SUFFIX
+
+
+def json_path(output_directory, name):
+    return os.path.join(output_directory, f'{name}.json')
+
+
+def store_name(vectors_path):
+    # strip the .npy suffix to get the base path shared by both files
+    return vectors_path[:-len(VECTORS_SUFFIX)] if vectors_path.endswith(VECTORS_SUFFIX) else vectors_path
+
+
+def output_exists(output_directory, name, output_format):
+    vectors_path, metadata_path = store_paths(output_directory, name)
+    npy_done = os.path.exists(vectors_path) and os.path.exists(metadata_path)
+    json_done = os.path.exists(json_path(output_directory, name))
+    if output_format == 'npy':
+        return npy_done
+    if output_format == 'json':
+        return json_done
+    return npy_done and json_done
+
+
+def _replace(tmp_path, path):
+    # files are written next to their destination and renamed into place so a
+    # crash never leaves a half written store behind
+    os.replace(tmp_path, path)
+
+
+def write_embedding_store(output_directory, name, records, vectors, dtype='float16', encoding=None):
+    vectors_path, metadata_path = store_paths(output_directory, name)
+    if len(records) != len(vectors):
+        raise ValueError(f'{len(records)} metadata records but {len(vectors)} vectors')
+
+    if len(records) == 0:
+        matrix = np.empty((0, 0), dtype=dtype)
+    else:
+        matrix = np.ascontiguousarray(np.asarray(vectors, dtype=dtype)).reshape(len(records), -1)
+
+    with open(f'{vectors_path}.tmp', 'wb') as f:
+        np.save(f, matrix)
+    offsets = np.zeros(len(records) + 1, dtype=np.uint64)
+    with open(f'{metadata_path}.tmp', 'wb') as f:
+        for index, record in enumerate(records):
+            line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+            f.write(line)
+            offsets[index + 1] = offsets[index] + len(line)
+    index_path = offsets_path(vectors_path)
+    with open(f'{index_path}.tmp', 'wb') as f:
+        np.save(f, offsets)
+
+    encoding_path = store_name(vectors_path) + ENCODING_SUFFIX
+    if encoding is not None:
+        with open(f'{encoding_path}.tmp', 'w') as f:
+            json.dump(encoding, f, indent=1)
+        _replace(f'{encoding_path}.tmp', encoding_path)
+    elif os.path.exists(encoding_path):
+        os.remove(encoding_path)
+
+    _replace(f'{vectors_path}.tmp', vectors_path)
+    _replace(f'{metadata_path}.tmp', metadata_path)
+    _replace(f'{index_path}.tmp', index_path)
+    return vectors_path, metadata_path
+
+
+def read_encoding(vectors_path):
+    # how the vectors of an exported store were encoded, None for clip vectors
+    encoding_path = store_name(vectors_path) + ENCODING_SUFFIX
+    if not os.path.exists(encoding_path):
+        return None
+    with open(encoding_path, 'r') as f:
+        return json.load(f)
+
+
+def check_encoding(vectors_path):
+    # readers that compare clip vectors refuse the codes of an export
+    encoding = read_encoding(vectors_path)
+    if encoding is not None:
+        raise ValueError(f"{vectors_path} holds {encoding['quantize']} codes of {encoding['pca_dims'] or 'all'} dimensions instead of clip vectors, "
+                         f"the {encoding['codec']}.npz/.json codec next to it decodes them with embedding_export.Codec")
+
+
+def read_metadata(metadata_path):
+    with open(metadata_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def read_embedding_store(vectors_path, mmap=True):
+    base = store_name(vectors_path)
+    vectors = np.load(base + VECTORS_SUFFIX, mmap_mode='r' if mmap else None)
+    records = read_metadata(base + METADATA_SUFFIX)
+    return records, vectors
+
+
+def find_stores(path):
+    # a path is either a single store or a directory holding several of them
+    if os.path.isdir(path):
+        stores = []
+        for root, _, files in os.walk(path):
+            for file in files:
+                if file.endswith(VECTORS_SUFFIX) and not file.endswith(OFFSETS_SUFFIX):
+                    vectors_path = os.path.join(root, file)
+                    if os.path.exists(store_name(vectors_path) + METADATA_SUFFIX):
+                        stores.append(vectors_path)
+        return sorted(stores)
+    return [path]
+
+
+def metadata_offsets(metadata):
+    # line start offsets of a metadata buffer, used for stores written before
+    # the offsets file existed
+    newlines = np.flatnonzero(np.frombuffer(metadata, dtype=np.uint8) == ord('\n'))
+    offsets = np.zeros(len(newlines) + 1, dtype=np.uint64)
+    offsets[1:] = newlines + 1
+    return offsets
+
+
+class EmbeddingStore:
+    # lazily opened, memory mapped view of a single store. Nothing is read
+    # until the first access and the open maps are dropped when the object is
+    # pickled, so DataLoader workers map the same pages instead of copying them
+    def __init__(self, vectors_path):
+        self.base = store_name(vectors_path)
+        self._vectors = None
+        self._offsets = None
+        self._metadata = None
+
+    def _open(self):
+        if self._vectors is not None:
+            return
+        # copy-on-write mapping: pages stay shared with other processes and
+        # rows can be wrapped by torch.from_numpy without a copy
+        self._vectors = np.load(self.base + VECTORS_SUFFIX, mmap_mode='c')
+        with open(self.base + METADATA_SUFFIX, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self._metadata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._metadata = b''
+        if os.path.exists(self.base + OFFSETS_SUFFIX):
+            self._offsets = np.load(self.base + OFFSETS_SUFFIX, mmap_mode='r')
+        else:
+            self._offsets = metadata_offsets(self._metadata)
+
+    def __getstate__(self):
+        return {'base': self.base, '_vectors': None, '_offsets': None, '_metadata': None}
+
+    def __len__(self):
+        self._open()
+        return len(self._vectors)
+
+    @property
+    def vectors(self):
+        self._open()
+        return self._vectors
+
+    def vector(self, index):
+        self._open()
+        return self._vectors[index]
+
+    def record(self, index):
+        self._open()
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        return json.loads(self._metadata[start:end])
+
+
+def write_json(path, records, vectors):
+    image_data = []
+    for record, vector in zip(records, vectors):
+        item = dict(record)
+        item['clip_vector'] = np.asarray(vector, dtype=np.float32).tolist()
+        image_data.append(item)
+
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(image_data, f, indent=JSON_INDENT)
+    _replace(f'{path}.tmp', path)
+    return path
+
+
+def split_image_data(image_data):
+    # image_data is the list of records built by the generators, each one
+    # carrying its vector under 'clip_vector'
+    records = [{key: value for key, value in item.items() if key != 'clip_vector'} for item in image_data]
+    vectors = [item['clip_vector'] for item in image_data]
+    return records, vectors
+
+
+def save_records(output_directory, name, records, vectors, output_format='npy', dtype='float16'):
+    written = []
+    if output_format in ('npy', 'both'):
+        with metrics.timer('write_seconds', format='npy'):
+            written.extend(write_embedding_store(output_directory, name, records, vectors, dtype))
+    if output_format in ('json', 'both'):
+        with metrics.timer('write_seconds', format='json'):
+            written.append(write_json(json_path(output_directory, name), records, vectors))
+    metrics.count('written_records', len(records))
+    metrics.count('written_bytes', sum(os.path.getsize(path) for path in written))
+    return written
+
+
+def save_image_data(output_directory, name, image_data, output_format='npy', dtype='float16'):
+    records, vectors = split_image_data(image_data)
+    return save_records(output_directory, name, records, vectors, output_format, dtype)
+
+
+def export_json(vectors_path, output_json_file):
+    records, vectors = read_embedding_store(vectors_path)
+    return write_json(output_json_file, records, vectors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export an embedding store (.npy + .meta.jsonl) to the legacy JSON format.')
+    parser.add_argument('store', help='Path to the .npy vector file of the store')
+    parser.add_argument('output_json', nargs='?', help='Path of the JSON file to write (defaults to <store>.json)')
+    args = parser.parse_args()
+
+    output_json_file = args.output_json or f'{store_name(args.store)}.json'
+    export_json(args.store, output_json_file)
+    print(f'Wrote {output_json_file}')
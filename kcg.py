@@ -0,0 +1,109 @@
+import os
+import sys
+import argparse
+
+# one entry point for the dataset tools:
+#   sort       strip EXIF and sort images-extracted into directories (ava-tools/image_sorter.py)
+#   hash       hash an image tree into its manifest (ava-tools/manifest.py)
+#   zip        zip every sorted directory (ava-tools/zip_generator.py)
+#   ava-json   write the AVA JSON files of the sorted directories (ava-tools/ava_json_generator.py)
+#   ava-embed  add clip vectors to the AVA JSON files (ava-tools/ava_clip_generator.py)
+#   embed      clip vectors of a directory of zip files (image-clip-tool/clip_json_generator.py)
+#   export     smaller exports of the clip vectors (embedding_export.py)
+# The tools import torch, clip and pandas and load their model only when a
+# subcommand runs, so --help and the argument checks start right away.
+ROOT = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(ROOT, 'image-clip-tool'))
+sys.path.insert(0, os.path.join(ROOT, 'ava-tools'))
+import manifest
+import image_sorter
+import zip_generator
+import ava_json_generator
+import ava_clip_generator
+import clip_json_generator
+import embedding_export
+from shard_planner import LINK_METHODS
+from clip_backend import BACKENDS
+
+
+def run_sort(args):
+    image_sorter.main(args.image_dir, args.output_dir, args.action, args.directory_size, args.strip_workers,
+                      args.place_methods, args.place_workers, args.skip_duplicates, not args.full)
+
+
+def run_zip(args):
+    zip_generator.main(args.images_dir, args.output_dir, not args.full, args.workers)
+
+
+def run_ava_json(args):
+    ava_json_generator.main(args.images_dir, args.ava_txt, not args.full)
+
+
+def run_ava_embed(args):
+    ava_clip_generator.main(args.images_dir, args.backend, args.threads, args.interop_threads, args.parity_images,
+                            args.batch_size, args.workers, not args.no_cache, not args.restart, not args.full,
+                            args.skip_duplicates, args.metrics, args.profile)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='kcg', description='Build the image datasets: sort, hash, zip, embed and export.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sort_parser = subparsers.add_parser('sort', help='Strip EXIF data and sort the extracted images into directories')
+    sort_parser.add_argument('--image-dir', default=image_sorter.IMAGE_DIR, help='Directory of the extracted images')
+    sort_parser.add_argument('--output-dir', default=image_sorter.OUTPUT_DIR, help='Directory of the sorted directories')
+    sort_parser.add_argument('--action', choices=['copy', 'move'], default=image_sorter.ACTION, help='Copy or move the images')
+    sort_parser.add_argument('--directory-size', type=int, default=image_sorter.DIRECTORY_SIZE, help='Bytes of images after which a directory is closed')
+    sort_parser.add_argument('--strip-workers', type=int, default=image_sorter.STRIP_WORKERS, help='Processes that remove the EXIF data')
+    sort_parser.add_argument('--place-workers', type=int, default=image_sorter.PLACE_WORKERS, help='Threads that copy or move the files')
+    sort_parser.add_argument('--place-methods', nargs='*', choices=LINK_METHODS, default=image_sorter.PLACE_METHODS, help='Link methods tried before a byte copy')
+    sort_parser.add_argument('--skip-duplicates', default=None, help='Duplicate report written by dedup.py')
+    sort_parser.add_argument('--full', action='store_true', help='Sort everything again instead of only what changed')
+    sort_parser.set_defaults(func=run_sort)
+
+    hash_parser = subparsers.add_parser('hash', help='Hash every file of an image tree into its manifest')
+    manifest.add_arguments(hash_parser)
+    hash_parser.set_defaults(func=manifest.run)
+
+    zip_parser = subparsers.add_parser('zip', help='Zip every directory of the sorted images')
+    zip_parser.add_argument('--images-dir', default=zip_generator.IMAGES_DIR, help='Directory of the sorted directories')
+    zip_parser.add_argument('--output-dir', default=zip_generator.OUTPUT_DIR, help='Directory of the zip files')
+    zip_parser.add_argument('--workers', type=int, default=zip_generator.ZIP_WORKERS, help='Zip files built in parallel')
+    zip_parser.add_argument('--full', action='store_true', help='Rebuild every zip file instead of only the changed ones')
+    zip_parser.set_defaults(func=run_zip)
+
+    ava_json_parser = subparsers.add_parser('ava-json', help='Write the AVA JSON files of the sorted directories and AVA.json')
+    ava_json_parser.add_argument('--images-dir', default=ava_json_generator.IMAGES_DIR, help='Directory of the sorted directories')
+    ava_json_parser.add_argument('--ava-txt', default=ava_json_generator.AVA_TXT_PATH, help='Path of AVA.txt')
+    ava_json_parser.add_argument('--full', action='store_true', help='Rewrite every JSON file instead of only the changed ones')
+    ava_json_parser.set_defaults(func=run_ava_json)
+
+    ava_embed_parser = subparsers.add_parser('ava-embed', help='Add clip vectors to the AVA JSON files and write AVA-clip.json')
+    ava_embed_parser.add_argument('--images-dir', default=ava_clip_generator.IMAGES_DIR, help='Directory of the sorted directories')
+    ava_embed_parser.add_argument('--batch-size', type=int, default=ava_clip_generator.BATCH_SIZE, help='Images per encode_image call (tuned when omitted)')
+    ava_embed_parser.add_argument('--workers', type=int, default=ava_clip_generator.DECODE_WORKERS, help='Processes that decode and preprocess the images')
+    ava_embed_parser.add_argument('--backend', choices=BACKENDS, default=ava_clip_generator.BACKEND, help='CPU backend of the image encoder')
+    ava_embed_parser.add_argument('--threads', type=int, default=ava_clip_generator.THREADS, help='Intra-op threads of the encoder')
+    ava_embed_parser.add_argument('--interop-threads', type=int, default=ava_clip_generator.INTEROP_THREADS, help='Inter-op threads of the encoder')
+    ava_embed_parser.add_argument('--parity-images', type=int, default=ava_clip_generator.PARITY_IMAGES, help='Images a non-eager backend is compared with the eager model on, 0 skips the check')
+    ava_embed_parser.add_argument('--no-cache', action='store_true', help='Encode every image without the embedding cache')
+    ava_embed_parser.add_argument('--restart', action='store_true', help='Start over instead of resuming from the journals')
+    ava_embed_parser.add_argument('--full', action='store_true', help='Embed every directory instead of only the changed ones')
+    ava_embed_parser.add_argument('--skip-duplicates', default=None, help='Duplicate report written by dedup.py')
+    ava_embed_parser.add_argument('--metrics', default=None, help='Append metric snapshots to this file')
+    ava_embed_parser.add_argument('--profile', default=None, help='Run under cProfile and save the stats to this file')
+    ava_embed_parser.set_defaults(func=run_ava_embed)
+
+    embed_parser = subparsers.add_parser('embed', help='Generate clip vectors for the images of a directory of zip files')
+    clip_json_generator.add_arguments(embed_parser)
+    embed_parser.set_defaults(func=clip_json_generator.run)
+
+    export_parser = subparsers.add_parser('export', help='Export clip vectors in reduced precision and/or dimensions')
+    embedding_export.add_arguments(export_parser)
+    export_parser.set_defaults(func=embedding_export.run)
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,211 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+
+# process-wide counters, gauges and timers of the generators, exported as
+# JSON-lines snapshots and as a Prometheus text file:
+#   <path>       one JSON snapshot per line, appended every interval
+#   <path>.prom  the latest snapshot in the Prometheus text format, for the
+#                node exporter textfile collector or a plain scrape
+# Recording is a dict update under a lock, the stages record once per batch,
+# not per image. Work done in decode worker processes is recorded by the
+# main process from the timings the workers return.
+PROMETHEUS_SUFFIX = '.prom'
+PREFIX = 'kcg_'
+DEFAULT_INTERVAL = 10 # seconds between snapshots
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60) # upper bounds of the timer histograms in seconds
+PROFILE_LINES = 25 # functions printed after a profiled run
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+            self.start = time.time()
+
+    def count(self, name, value=1, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self._lock:
+            timer = self.timers.get(key)
+            if timer is None:
+                timer = self.timers[key] = {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(BUCKETS)}
+            timer['count'] += 1
+            timer['sum'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    timer['buckets'][index] += 1
+                    break
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        # decorator form of timer
+        def decorator(function):
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+            wrapper.__name__ = function.__name__
+            wrapper.__wrapped__ = function
+            return wrapper
+        return decorator
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'time': time.time(),
+                'uptime': time.time() - self.start,
+                'pid': os.getpid(),
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+                'gauges': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.gauges.items())],
+                'timers': [{'name': name, 'labels': dict(labels), 'count': timer['count'], 'sum': timer['sum'], 'max': timer['max'],
+                            'buckets': dict(zip(map(str, BUCKETS), timer['buckets']))} for (name, labels), timer in sorted(self.timers.items())],
+            }
+
+    def prometheus(self):
+        # the text exposition format; timers are histograms in seconds
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            timers = sorted((key, dict(timer, buckets=list(timer['buckets']))) for key, timer in self.timers.items())
+        lines = []
+        typed = set()
+        for kind, items in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in items:
+                metric = PREFIX + name + ('_total' if kind == 'counter' else '')
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f'# TYPE {metric} {kind}')
+                lines.append(f'{metric}{_labels(labels)} {value}')
+        for (name, labels), timer in timers:
+            metric = PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bound, count in zip(BUCKETS, timer['buckets']):
+                cumulative += count
+                lines.append(f'{metric}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{metric}_bucket{_labels(labels, [("le", "+Inf")])} {timer["count"]}')
+            lines.append(f'{metric}_sum{_labels(labels)} {timer["sum"]}')
+            lines.append(f'{metric}_count{_labels(labels)} {timer["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+# the registry every module records into
+metrics = Metrics()
+
+
+class MetricsWriter:
+    # writes a snapshot of a registry every interval seconds on a daemon
+    # thread, and a last one on close
+    def __init__(self, path, interval=DEFAULT_INTERVAL, registry=None):
+        self.path = path
+        self.interval = interval
+        self.registry = registry or metrics
+        self._stop = threading.Event()
+        self._thread = None
+
+    def write(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.registry.snapshot()) + '\n')
+        # the Prometheus file is replaced in one step so a scrape never sees
+        # half of it
+        prometheus_path = self.path + PROMETHEUS_SUFFIX
+        with open(prometheus_path + '.tmp', 'w') as f:
+            f.write(self.registry.prometheus())
+        os.replace(prometheus_path + '.tmp', prometheus_path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextlib.contextmanager
+def profile(path=None, lines=PROFILE_LINES):
+    # runs the block under cProfile and saves the stats to path (open them
+    # with snakeviz or pstats). Sampling profilers need no help:
+    #   py-spy record -o profile.svg -- python clip_json_generator.py ...
+    # Without a path the block runs unprofiled.
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f'Profile written to {path}, the functions with the most cumulative time:')
+        pstats.Stats(profiler, stream=sys.stdout).sort_stats('cumulative').print_stats(lines)
+
+
+@contextlib.contextmanager
+def recording(path=None, interval=DEFAULT_INTERVAL, profile_path=None):
+    # what the generators wrap their run in: metric snapshots when path is
+    # given, a cProfile run when profile_path is
+    writer = MetricsWriter(path, interval).start() if path else None
+    try:
+        with profile(profile_path):
+            yield metrics
+    finally:
+        if writer is not None:
+            writer.close()
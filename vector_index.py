@@ -0,0 +1,472 @@
+import os
+import json
+import mmap
+import argparse
+import numpy as np
+from embedding_store import find_stores, EmbeddingStore, store_name, store_paths, offsets_path, check_encoding, VECTORS_SUFFIX, METADATA_SUFFIX, OFFSETS_SUFFIX
+
+# an IVF index over clip vectors, stored as a directory:
+#   index.json                  - dimension, model, segments and indexed sources
+#   centroids.npy               - (lists, dim) unit length list centroids
+#   segment-NNNNN.npy/.meta.jsonl/.offsets.npy
+#                               - an embedding store per add(), rows sorted by list
+#   segment-NNNNN.lists.npy     - first row of every list in the segment (lists + 1)
+#   segment-NNNNN.sources.npy   - source id of every row
+# Vectors are normalized, so scores are cosine similarities. A query scans
+# the nprobe lists whose centroids are closest to it.
+INDEX_FILE_NAME = 'index.json'
+CENTROIDS_FILE_NAME = 'centroids.npy'
+LISTS_SUFFIX = '.lists.npy'
+SOURCES_SUFFIX = '.sources.npy'
+TRAIN_SAMPLE = 100000 # vectors k-means is trained on
+KMEANS_ITERATIONS = 20
+ASSIGN_CHUNK = 16384 # vectors assigned to lists at a time
+DEFAULT_NPROBE = 16
+DEFAULT_K = 10
+# fields that hold the vector in the JSON outputs of the generators
+VECTOR_FIELDS = ('clip_vector', 'ClipVector')
+# JSON outputs of the AVA scripts, <dir>-clip.json and AVA-clip.json
+CLIP_JSON_SUFFIX = '-clip.json'
+# rows of a segment being built are staged in these files next to it
+STAGING_SUFFIXES = ('.staging.vectors', '.staging.jsonl', '.staging.lengths', '.staging.sources')
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def assign_lists(vectors, centroids):
+    # list of every vector, the centroid with the highest dot product
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        chunk = normalize(vectors[start:start + ASSIGN_CHUNK])
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def train_centroids(vectors, lists, iterations=KMEANS_ITERATIONS, seed=0):
+    # spherical k-means on a sample of the vectors
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), TRAIN_SAMPLE)
+    sample = normalize(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+    lists = max(1, min(lists, sample_size))
+    centroids = sample[rng.choice(sample_size, lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_lists(sample, centroids)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=lists)
+        filled = np.flatnonzero(counts)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[filled]
+        centroids[filled] = np.add.reduceat(sample[order], starts, axis=0)
+        # an empty list takes a random vector of the sample
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+        centroids = normalize(centroids)
+    return centroids
+
+
+def default_lists(count):
+    return max(1, min(count, int(4 * np.sqrt(count))))
+
+
+def read_json_source(path):
+    # (records, vectors) of a JSON output, a list of records with a
+    # clip_vector / ClipVector field
+    with open(path, 'r') as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError(f'{path} is not a generator output, it holds a JSON {type(data).__name__} instead of a list of records')
+    records = []
+    vectors = []
+    for item in data:
+        field = next((field for field in VECTOR_FIELDS if isinstance(item, dict) and item.get(field) is not None), None)
+        if field is None:
+            continue
+        vectors.append(np.asarray(item[field], dtype=np.float32).reshape(-1))
+        records.append({key: value for key, value in item.items() if key not in VECTOR_FIELDS})
+    if not vectors:
+        return records, np.empty((0, 0), dtype=np.float32)
+    return records, np.stack(vectors)
+
+
+def iter_source(path, chunk_size=ASSIGN_CHUNK, with_records=True):
+    # (records, vectors) of a generator output chunk by chunk. A store is
+    # read through its memory map, its records only when with_records is
+    # set; a JSON file has to be parsed as a whole
+    if path.endswith(VECTORS_SUFFIX):
+        check_encoding(path)
+        store = EmbeddingStore(path)
+        for start in range(0, len(store), chunk_size):
+            end = min(start + chunk_size, len(store))
+            records = [store.record(i) for i in range(start, end)] if with_records else None
+            yield records, np.asarray(store.vectors[start:end], dtype=np.float32)
+        return
+    records, vectors = read_json_source(path)
+    for start in range(0, len(records), chunk_size):
+        yield records[start:start + chunk_size], vectors[start:start + chunk_size]
+
+
+def read_source(path):
+    # (records, vectors) of a generator output: an embedding store or a JSON
+    # file with a clip_vector / ClipVector field per record
+    if not path.endswith(VECTORS_SUFFIX):
+        return read_json_source(path)
+    records = []
+    vectors = []
+    for chunk_records, chunk_vectors in iter_source(path):
+        records.extend(chunk_records)
+        vectors.append(chunk_vectors)
+    if not vectors:
+        return records, np.empty((0, 0), dtype=np.float32)
+    return records, np.concatenate(vectors)
+
+
+def is_json_output(path):
+    # the JSON outputs of the generators: <dir>-clip.json and AVA-clip.json
+    # of the AVA scripts and the <archive>.json lists of image-clip-tool.
+    # The AVA tables without vectors have a -clip.json next to them, the other
+    # JSON files (zip indexes, index.json, reports, codecs) are objects
+    if path.endswith(CLIP_JSON_SUFFIX):
+        return True
+    if os.path.exists(path[:-len('.json')] + CLIP_JSON_SUFFIX):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(64).lstrip()[:1] == b'['
+
+
+def find_sources(paths):
+    # embedding stores and JSON outputs under the given paths
+    sources = []
+    for path in paths:
+        if os.path.isdir(path):
+            stores = find_stores(path)
+            sources.extend(stores)
+            # a JSON output written next to a store holds the same vectors
+            bases = {store_name(store) for store in stores}
+            sources.extend(sorted(os.path.join(root, file) for root, _, files in os.walk(path) for file in files
+                                  if file.endswith('.json') and os.path.join(root, file)[:-len('.json')] not in bases
+                                  and is_json_output(os.path.join(root, file))))
+        else:
+            sources.append(path)
+    return sources
+
+
+def source_model(record):
+    # (open_clip model name, pretrained tag) a record was embedded with
+    if 'ClipModel' in record:
+        return record['ClipModel'], record.get('ClipPretrained')
+    if 'clip_model' in record:
+        # the openai clip package names models ViT-L/14, open_clip ViT-L-14
+        return record['clip_model'].replace('/', '-'), 'openai'
+    return None, None
+
+
+class SegmentStaging:
+    # the rows of a segment being built, kept on disk instead of in memory:
+    # normalized float32 vectors, metadata lines, their lengths and source
+    # ids. Rows are appended a chunk at a time and read back memory mapped
+    # once appending is done. The staging files are removed on exit
+    def __init__(self, base, dim=None):
+        self.paths = [base + suffix for suffix in STAGING_SUFFIXES]
+        self.dim = dim
+        self.count = 0
+        self._files = [open(path, 'wb') for path in self.paths]
+        self._metadata = None
+
+    def append(self, records, vectors, source_ids):
+        vectors = normalize(vectors)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"vectors of dimension {vectors.shape[1]} can't be added to an index of dimension {self.dim}")
+        lines = [json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n' for record in records]
+        vectors_file, metadata_file, lengths_file, sources_file = self._files
+        vectors_file.write(vectors.tobytes())
+        metadata_file.write(b''.join(lines))
+        lengths_file.write(np.array([len(line) for line in lines], dtype=np.uint64).tobytes())
+        sources_file.write(np.broadcast_to(np.asarray(source_ids, dtype=np.int32), (len(lines),)).tobytes())
+        self.count += len(lines)
+
+    def _finish(self):
+        for f in self._files:
+            f.close()
+
+    def vectors(self):
+        self._finish()
+        return np.memmap(self.paths[0], dtype=np.float32, mode='r', shape=(self.count, self.dim))
+
+    def metadata(self):
+        self._finish()
+        if self._metadata is None:
+            with open(self.paths[1], 'rb') as f:
+                self._metadata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+        return self._metadata
+
+    def lengths(self):
+        self._finish()
+        return np.fromfile(self.paths[2], dtype=np.uint64)
+
+    def sources(self):
+        self._finish()
+        return np.fromfile(self.paths[3], dtype=np.int32)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._finish()
+        if self._metadata is not None and not isinstance(self._metadata, bytes):
+            self._metadata.close()
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class VectorIndex:
+    #   index = VectorIndex('ava-index')
+    #   index.add(['AVA-clip.json'])              # builds the lists on the first add
+    #   results = index.search(vectors, k=10)     # [[(score, record)]] per query
+    #   results = index.search_text(['a sunset over the sea'])
+    def __init__(self, path):
+        self.path = path
+        self.info = {'dim': None, 'model': None, 'pretrained': None, 'segments': [], 'sources': {}, 'next_segment': 0, 'next_source': 0}
+        self.centroids = None
+        self._segments = None
+        self._text_model = None
+        if os.path.exists(os.path.join(path, INDEX_FILE_NAME)):
+            with open(os.path.join(path, INDEX_FILE_NAME), 'r') as f:
+                self.info = json.load(f)
+            self.centroids = np.load(os.path.join(path, CENTROIDS_FILE_NAME))
+
+    def __len__(self):
+        removed = {source['id'] for source in self.info['sources'].values() if source.get('removed')}
+        return sum(int(np.sum(~np.isin(sources, list(removed)))) for _, _, sources in self._load_segments())
+
+    def _save_info(self):
+        path = os.path.join(self.path, INDEX_FILE_NAME)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.info, f, indent=1)
+        os.replace(f'{path}.tmp', path)
+
+    def _load_segments(self):
+        # [(store, list offsets, source ids)] of every segment, memory mapped
+        if self._segments is None:
+            self._segments = []
+            for name in self.info['segments']:
+                base = os.path.join(self.path, name)
+                self._segments.append((EmbeddingStore(base + VECTORS_SUFFIX),
+                                       np.load(base + LISTS_SUFFIX),
+                                       np.load(base + SOURCES_SUFFIX, mmap_mode='r')))
+        return self._segments
+
+    def add(self, paths, lists=None):
+        # indexes the sources that are new or changed since they were added;
+        # rows of a changed source are dropped from the older segments. The
+        # lists are trained on the first add and reused afterwards
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # the segments are stores too, a parent directory of the index must
+        # not add them to it again
+        index_path = os.path.abspath(self.path)
+        sources = [path for path in find_sources(paths) if os.path.commonpath([os.path.abspath(path), index_path]) != index_path]
+        name = f"segment-{self.info['next_segment']:05d}"
+        with SegmentStaging(os.path.join(self.path, name), self.info['dim']) as staging:
+            for path in sources:
+                key = os.path.abspath(path)
+                stat = os.stat(path)
+                known = self.info['sources'].get(key)
+                if known and not known.get('removed') and (known['size'], known['mtime']) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                if known:
+                    # the old rows stay in their segment until compact() but
+                    # are no longer returned
+                    known['removed'] = True
+                    self.info['sources'][f"{key}#{known['id']}"] = known
+                source_id = self.info['next_source']
+                self.info['next_source'] += 1
+                count = 0
+                for records, vectors in iter_source(path):
+                    if not records:
+                        continue
+                    if count == 0:
+                        self._check_model(path, source_model(records[0]))
+                    for record in records:
+                        record['source'] = os.path.basename(path)
+                    staging.append(records, vectors, source_id)
+                    count += len(records)
+                self.info['sources'][key] = {'id': source_id, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'count': count}
+
+            if staging.count:
+                if self.centroids is None:
+                    self.info['dim'] = staging.dim
+                    self.centroids = train_centroids(staging.vectors(), lists or default_lists(staging.count))
+                    np.save(os.path.join(self.path, CENTROIDS_FILE_NAME), self.centroids)
+                self._write_segment(name, staging)
+        self._save_info()
+        return staging.count
+
+    def _check_model(self, path, model):
+        # vectors of different clip models can't be searched together, even
+        # when they have the same dimension
+        if model == (None, None):
+            return
+        if self.info['model'] is None:
+            self.info['model'], self.info['pretrained'] = model
+        elif model != (self.info['model'], self.info['pretrained']):
+            raise ValueError(f"{path} was embedded with {model[0]} ({model[1]}) but the index holds vectors of {self.info['model']} ({self.info['pretrained']}), "
+                             "vectors of different clip models can't be compared")
+
+    def _write_segment(self, name, staging):
+        # writes the staged rows as an embedding store sorted by list, a chunk
+        # of vectors and one metadata line at a time
+        self.info['next_segment'] += 1
+        vectors = staging.vectors()
+        assignments = assign_lists(vectors, self.centroids)
+        order = np.argsort(assignments, kind='stable')
+        lists = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1)).astype(np.int64)
+        vectors_path, metadata_path = store_paths(self.path, name)
+        index_path = offsets_path(vectors_path)
+
+        matrix = np.lib.format.open_memmap(f'{vectors_path}.tmp', mode='w+', dtype=np.float16, shape=vectors.shape)
+        for start in range(0, len(order), ASSIGN_CHUNK):
+            rows = order[start:start + ASSIGN_CHUNK]
+            matrix[start:start + len(rows)] = vectors[rows]
+        matrix.flush()
+        del matrix, vectors
+        lengths = staging.lengths()
+        starts = np.zeros(len(lengths) + 1, dtype=np.uint64)
+        np.cumsum(lengths, out=starts[1:])
+        metadata = staging.metadata()
+        with open(f'{metadata_path}.tmp', 'wb') as f:
+            for row in order:
+                f.write(metadata[int(starts[row]):int(starts[row + 1])])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.uint64)
+        np.cumsum(lengths[order], out=offsets[1:])
+        with open(f'{index_path}.tmp', 'wb') as f:
+            np.save(f, offsets)
+
+        os.replace(f'{vectors_path}.tmp', vectors_path)
+        os.replace(f'{metadata_path}.tmp', metadata_path)
+        os.replace(f'{index_path}.tmp', index_path)
+        np.save(os.path.join(self.path, name + LISTS_SUFFIX), lists)
+        np.save(os.path.join(self.path, name + SOURCES_SUFFIX), staging.sources()[order])
+        self.info['segments'].append(name)
+        self._segments = None
+
+    def compact(self, retrain=False):
+        # rewrites all live rows into a single segment, optionally with
+        # freshly trained lists. The rows are staged on disk a chunk at a time
+        removed = [source['id'] for source in self.info['sources'].values() if source.get('removed')]
+        name = f"segment-{self.info['next_segment']:05d}"
+        with SegmentStaging(os.path.join(self.path, name), self.info['dim']) as staging:
+            for store, _, sources in self._load_segments():
+                keep = np.flatnonzero(~np.isin(sources, removed))
+                for start in range(0, len(keep), ASSIGN_CHUNK):
+                    rows = keep[start:start + ASSIGN_CHUNK]
+                    staging.append([store.record(int(i)) for i in rows], np.asarray(store.vectors[rows], dtype=np.float32), np.asarray(sources[rows]))
+            old_segments = self.info['segments']
+            self.info['segments'] = []
+            self.info['sources'] = {key: source for key, source in self.info['sources'].items() if not source.get('removed')}
+            self._segments = None
+            if staging.count:
+                if retrain:
+                    self.centroids = train_centroids(staging.vectors(), default_lists(staging.count))
+                    np.save(os.path.join(self.path, CENTROIDS_FILE_NAME), self.centroids)
+                self._write_segment(name, staging)
+        self._save_info()
+        for name in old_segments:
+            for suffix in (VECTORS_SUFFIX, METADATA_SUFFIX, OFFSETS_SUFFIX, LISTS_SUFFIX, SOURCES_SUFFIX):
+                path = os.path.join(self.path, name + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def search(self, queries, k=DEFAULT_K, nprobe=DEFAULT_NPROBE):
+        # top k (score, record) of every query vector, best first
+        queries = normalize(np.atleast_2d(queries))
+        if self.centroids is None:
+            return [[] for _ in queries]
+        if queries.shape[1] != self.info['dim']:
+            raise ValueError(f"queries of dimension {queries.shape[1]} for an index of dimension {self.info['dim']}")
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+        removed = [source['id'] for source in self.info['sources'].values() if source.get('removed')]
+
+        # candidates of every query as (scores, segment, rows)
+        candidates = [[] for _ in queries]
+        for segment, (store, lists, sources) in enumerate(self._load_segments()):
+            for list_id in np.unique(probes):
+                start, end = int(lists[list_id]), int(lists[list_id + 1])
+                if start == end:
+                    continue
+                rows = np.arange(start, end)
+                if removed:
+                    rows = rows[~np.isin(sources[start:end], removed)]
+                    if not len(rows):
+                        continue
+                query_ids = np.flatnonzero((probes == list_id).any(axis=1))
+                scores = queries[query_ids] @ np.asarray(store.vectors[rows], dtype=np.float32).T
+                for query_id, query_scores in zip(query_ids, scores):
+                    candidates[query_id].append((query_scores, segment, rows))
+
+        segments = self._load_segments()
+        results = []
+        for query_candidates in candidates:
+            if not query_candidates:
+                results.append([])
+                continue
+            scores = np.concatenate([scores for scores, _, _ in query_candidates])
+            where = np.concatenate([np.full(len(rows), segment) for _, segment, rows in query_candidates])
+            rows = np.concatenate([rows for _, _, rows in query_candidates])
+            top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k)[:k]
+            top = top[np.argsort(-scores[top])]
+            results.append([(float(scores[i]), segments[where[i]][0].record(int(rows[i]))) for i in top])
+        return results
+
+    def encode_text(self, prompts):
+        # text vectors from the clip model the index was built with; the
+        # model is only loaded on the first text query
+        if self._text_model is None:
+            import torch
+            import open_clip
+            model, _, _ = open_clip.create_model_and_transforms(self.info['model'], pretrained=self.info['pretrained'])
+            model.eval()
+            self._text_model = (model, open_clip.get_tokenizer(self.info['model']), torch)
+        model, tokenizer, torch = self._text_model
+        with torch.no_grad():
+            return model.encode_text(tokenizer(list(prompts))).float().cpu().numpy()
+
+    def search_text(self, prompts, k=DEFAULT_K, nprobe=DEFAULT_NPROBE):
+        return self.search(self.encode_text(prompts), k, nprobe)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build and query an IVF index over the generated clip vectors.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help='Add generator outputs (embedding stores or JSON files, or directories of them) to the index')
+    add_parser.add_argument('index', help='Index directory')
+    add_parser.add_argument('sources', nargs='+')
+    add_parser.add_argument('--lists', type=int, default=None, help='Number of lists when the index is created (defaults to 4 * sqrt(vectors))')
+    compact_parser = subparsers.add_parser('compact', help='Merge all segments and drop the rows of replaced sources')
+    compact_parser.add_argument('index', help='Index directory')
+    compact_parser.add_argument('--retrain', action='store_true', help='Train new lists on the current vectors')
+    query_parser = subparsers.add_parser('query', help='Search the index with text prompts')
+    query_parser.add_argument('index', help='Index directory')
+    query_parser.add_argument('prompts', nargs='+')
+    query_parser.add_argument('-k', type=int, default=DEFAULT_K)
+    query_parser.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE)
+    args = parser.parse_args()
+
+    index = VectorIndex(args.index)
+    if args.command == 'add':
+        added = index.add(args.sources, args.lists)
+        print(f'Added {added} vectors, {len(index)} in the index')
+    elif args.command == 'compact':
+        index.compact(args.retrain)
+        print(f'{len(index)} vectors in one segment')
+    else:
+        for prompt, results in zip(args.prompts, index.search_text(args.prompts, args.k, args.nprobe)):
+            print(prompt)
+            for score, record in results:
+                print(f'  {score:.4f}  {json.dumps(record)}')
@@ -0,0 +1,256 @@
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+
+# a queue of work items (archive paths) in a sqlite file on storage shared
+# by every worker. A worker leases one item at a time and renews the lease
+# with heartbeats while it works on it; an item whose lease ran out because
+# its worker died or hung is leased to the next worker that asks. Items
+# that fail MAX_ATTEMPTS times are set aside as failed.
+#
+# The file uses sqlite's rollback journal instead of WAL, because WAL needs
+# shared memory between the processes and does not work across hosts on a
+# network filesystem. The filesystem must support POSIX locks.
+QUEUE_FILE_NAME = 'work-queue.sqlite'
+DEFAULT_LEASE_SECONDS = 300 # a lease not renewed for this long is handed to another worker
+MAX_ATTEMPTS = 3 # leases of an item that ended without completing it before it is failed
+STATES = ['pending', 'leased', 'done', 'failed']
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class LeaseLost(Exception):
+    # the lease ran out and the item may now be worked on by another worker
+    pass
+
+
+class WorkQueue:
+    # like EmbeddingCache, the connection is opened lazily and reopened after
+    # a fork, so the queue object can be handed to other processes
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    def _connect(self):
+        if self._connection is not None and self._pid == os.getpid():
+            return self._connection
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # autocommit, every change is its own transaction or an explicit
+        # BEGIN IMMEDIATE block
+        self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self._pid = os.getpid()
+        self._connection.execute('PRAGMA journal_mode=DELETE')
+        self._connection.execute('''
+            CREATE TABLE IF NOT EXISTS items (
+                key TEXT PRIMARY KEY,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL
+            )''')
+        return self._connection
+
+    def _transaction(self, statements):
+        # runs (sql, parameters) pairs holding the write lock throughout;
+        # returns the cursor of the last one
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, parameters in statements:
+                cursor = connection.execute(sql, parameters)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return cursor
+
+    def add(self, keys):
+        # items already in the queue, in any state, are left as they are;
+        # returns the number of new items
+        keys = list(keys)
+        connection = self._connect()
+        before = connection.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT OR IGNORE INTO items (key, updated) VALUES (?, ?)', [(key, now) for key in keys])
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return connection.execute('SELECT COUNT(*) FROM items').fetchone()[0] - before
+
+    def lease(self, worker, seconds=DEFAULT_LEASE_SECONDS):
+        # the first pending item in key order, or an item whose lease ran out;
+        # None when there is nothing to lease right now
+        connection = self._connect()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # an expired lease counts as an attempt that ended without completing
+            connection.execute("UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                               "error = 'lease expired', worker = NULL, updated = ? WHERE state = 'leased' AND lease_expires < ?",
+                               (self.max_attempts, now, now))
+            row = connection.execute("SELECT key FROM items WHERE state = 'pending' ORDER BY key LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("UPDATE items SET state = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE key = ?",
+                                   (worker, now + seconds, now, row[0]))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return row[0] if row is not None else None
+
+    def heartbeat(self, key, worker, seconds=DEFAULT_LEASE_SECONDS):
+        # renews a lease; False when the worker no longer holds it. A late
+        # renewal still counts as long as no other worker took the item over
+        now = time.time()
+        cursor = self._transaction([("UPDATE items SET lease_expires = ?, updated = ? WHERE key = ? AND worker = ? AND state = 'leased'",
+                                     (now + seconds, now, key, worker))])
+        return cursor.rowcount == 1
+
+    def holds(self, key, worker):
+        row = self._connect().execute("SELECT 1 FROM items WHERE key = ? AND worker = ? AND state = 'leased' AND lease_expires >= ?",
+                                      (key, worker, time.time())).fetchone()
+        return row is not None
+
+    def complete(self, key, worker):
+        # False when the lease was lost first; the item is then done by the
+        # worker that holds it now
+        cursor = self._transaction([("UPDATE items SET state = 'done', worker = ?, lease_expires = NULL, error = NULL, updated = ? WHERE key = ? AND worker = ? AND state = 'leased'",
+                                     (worker, time.time(), key, worker))])
+        return cursor.rowcount == 1
+
+    def release(self, key, worker, error=None):
+        # gives up a lease after a failure, the item is leased again until it
+        # failed max_attempts times
+        cursor = self._transaction([("UPDATE items SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                                     "worker = NULL, lease_expires = NULL, error = ?, updated = ? WHERE key = ? AND worker = ? AND state = 'leased'",
+                                     (self.max_attempts, error, time.time(), key, worker))])
+        return cursor.rowcount == 1
+
+    def requeue(self, states=('failed',)):
+        # puts items back to pending with their attempts reset
+        placeholders = ','.join('?' * len(states))
+        cursor = self._transaction([(f"UPDATE items SET state = 'pending', worker = NULL, lease_expires = NULL, attempts = 0, updated = ? WHERE state IN ({placeholders})",
+                                     (time.time(), *states))])
+        return cursor.rowcount
+
+    def counts(self):
+        counts = dict.fromkeys(STATES, 0)
+        for state, count in self._connect().execute('SELECT state, COUNT(*) FROM items GROUP BY state'):
+            counts[state] = count
+        return counts
+
+    def items(self, states=STATES):
+        placeholders = ','.join('?' * len(states))
+        rows = self._connect().execute(f'SELECT key, state, worker, lease_expires, attempts, error FROM items WHERE state IN ({placeholders}) ORDER BY key', list(states))
+        return [dict(zip(('key', 'state', 'worker', 'lease_expires', 'attempts', 'error'), row)) for row in rows]
+
+    def leases(self, worker, seconds=DEFAULT_LEASE_SECONDS, poll=None):
+        # yields a running Lease for every item this worker gets, until no
+        # item is pending or leased. While other workers hold the last items
+        # it waits, so it can take over the ones whose worker dies
+        poll = poll or max(1, seconds / 3)
+        while True:
+            key = self.lease(worker, seconds)
+            if key is None:
+                if not self.counts()['leased']:
+                    return
+                time.sleep(poll)
+                continue
+            with Lease(self, key, worker, seconds) as lease:
+                yield lease
+
+    def close(self):
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+
+
+class Lease:
+    # renews the lease of one item on a daemon thread every third of the
+    # lease time. The worker calls check() before it commits anything for
+    # the item and complete() or release() when it is done with it.
+    def __init__(self, queue, key, worker, seconds=DEFAULT_LEASE_SECONDS):
+        self.queue = queue
+        self.key = key
+        self.worker = worker
+        self.seconds = seconds
+        self.lost = threading.Event()
+        self.finished = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        # the thread has its own connection, sqlite connections stay in the
+        # thread that opened them
+        queue = WorkQueue(self.queue.path, self.queue.max_attempts)
+        try:
+            while not self._stop.wait(self.seconds / 3):
+                if not queue.heartbeat(self.key, self.worker, self.seconds):
+                    self.lost.set()
+                    return
+        finally:
+            queue.close()
+
+    def check(self):
+        # raises LeaseLost when another worker may be working on the item
+        if self.lost.is_set() or not self.queue.holds(self.key, self.worker):
+            self.lost.set()
+            raise LeaseLost(f'{self.worker} lost the lease of {self.key}')
+
+    def complete(self):
+        self.finished = True
+        return self.queue.complete(self.key, self.worker)
+
+    def release(self, error=None):
+        self.finished = True
+        return self.queue.release(self.key, self.worker, error)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self._stop.set()
+        self._thread.join()
+        # a lease left without complete() (an error or the consumer stopped)
+        # is handed back right away instead of waiting for it to expire
+        if not self.finished and not self.lost.is_set():
+            self.release(f'{exc_type.__name__}: {exc}' if exc_type else 'abandoned')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show or reset a work queue shared by the generator workers.')
+    parser.add_argument('command', choices=['status', 'requeue'], help='status lists the items that are not done, requeue puts the failed items back to pending')
+    parser.add_argument('queue', help='Path of the queue file')
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue)
+    if args.command == 'requeue':
+        print(f'{queue.requeue()} failed items back to pending')
+    print(', '.join(f'{count} {state}' for state, count in queue.counts().items()))
+    for item in queue.items(('leased', 'failed')):
+        if item['state'] == 'leased':
+            print(f"  {item['key']}: leased by {item['worker']}, expires in {item['lease_expires'] - time.time():.0f} s, attempt {item['attempts']}")
+        else:
+            print(f"  {item['key']}: failed after {item['attempts']} attempts: {item['error']}")
@@ -0,0 +1,104 @@
+import os
+import json
+import struct
+import hashlib
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# compressed formats gain nothing from deflate and are stored as they are,
+# everything else is deflated
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.zip', '.gz', '.bz2', '.xz', '.7z', '.mp4')
+COMPRESSION = zipfile.ZIP_DEFLATED
+CHUNK_SIZE = 1024 * 1024 # bytes copied into the archive at a time
+INDEX_SUFFIX = '.index.json'
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+# signature, version, flags, method, time, date, crc32, compressed size,
+# size, name length, extra length
+LOCAL_HEADER = struct.Struct('<4s5H3I2H')
+
+
+def index_path(zip_path):
+    # <name>.index.json next to <name>.zip
+    return f'{os.path.splitext(zip_path)[0]}{INDEX_SUFFIX}'
+
+
+def add_file(zip_file, path, arcname, chunk_size=CHUNK_SIZE):
+    # streams one file into the archive and returns its sha256
+    zinfo = zipfile.ZipInfo.from_file(path, arcname, strict_timestamps=False)
+    zinfo.compress_type = zipfile.ZIP_STORED if arcname.lower().endswith(STORED_EXTENSIONS) else COMPRESSION
+    sha = hashlib.sha256()
+    with open(path, 'rb') as src, zip_file.open(zinfo, 'w') as dst:
+        while True:
+            chunk = src.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+            dst.write(chunk)
+    return sha.hexdigest()
+
+
+def member_index(zip_path, hashes):
+    # offset of the data of every member, read from its local header, so a
+    # reader can seek to it without parsing the archive
+    members = []
+    with open(zip_path, 'rb') as f, zipfile.ZipFile(f) as zip_file:
+        for info in zip_file.infolist():
+            f.seek(info.header_offset)
+            header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+            name_length, extra_length = header[-2], header[-1]
+            members.append({
+                'name': info.filename,
+                'offset': info.header_offset + LOCAL_HEADER.size + name_length + extra_length,
+                'header_offset': info.header_offset,
+                'compress_type': info.compress_type,
+                'compressed_size': info.compress_size,
+                'size': info.file_size,
+                'crc32': info.CRC,
+                'sha256': hashes.get(info.filename),
+            })
+    return members
+
+
+def write_index(zip_path, members):
+    index = {
+        'archive': os.path.basename(zip_path),
+        'archive_size': os.path.getsize(zip_path),
+        'members': members,
+    }
+    path = index_path(zip_path)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(f'{path}.tmp', path)
+
+
+def read_index(zip_path):
+    with open(index_path(zip_path), 'r') as f:
+        return json.load(f)
+
+
+def build_archive(zip_path, members, chunk_size=CHUNK_SIZE):
+    # members is a list of (path, name in the archive). The archive is built
+    # under a temporary name and renamed once complete, then its index is
+    # written next to it. Returns (zip_path, number of members, bytes added)
+    hashes = {}
+    total_bytes = 0
+    with zipfile.ZipFile(f'{zip_path}.tmp', 'w') as zip_file:
+        for path, arcname in members:
+            hashes[arcname] = add_file(zip_file, path, arcname, chunk_size)
+            total_bytes += os.path.getsize(path)
+    os.replace(f'{zip_path}.tmp', zip_path)
+    write_index(zip_path, member_index(zip_path, hashes))
+    return zip_path, len(members), total_bytes
+
+
+def build_archives(jobs, workers=DEFAULT_WORKERS, chunk_size=CHUNK_SIZE):
+    # jobs is a list of (zip_path, members); every archive is built by its
+    # own worker process. Yields the result of build_archive as archives finish
+    if workers <= 1 or len(jobs) <= 1:
+        for zip_path, members in jobs:
+            yield build_archive(zip_path, members, chunk_size)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+        futures = [executor.submit(build_archive, zip_path, members, chunk_size) for zip_path, members in jobs]
+        for future in as_completed(futures):
+            yield future.result()
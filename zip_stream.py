@@ -0,0 +1,125 @@
+import time
+import queue
+import zipfile
+import threading
+from metrics import metrics
+
+IMAGE_EXTENSIONS = ('.gif', '.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.tif', '.tiff', '.webp')
+DEFAULT_READ_AHEAD = 4
+
+# marks the end of an archive in the read-ahead queue
+_END = object()
+
+
+def iter_zip_members(zip_path, extensions=IMAGE_EXTENSIONS, skip=()):
+    # members are read one at a time, only the current one is held in memory.
+    # Members named in skip are not read at all
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for file_info in zip_ref.infolist():
+            if file_info.is_dir() or not file_info.filename.lower().endswith(extensions):
+                continue
+            if file_info.filename in skip:
+                continue
+            yield file_info.filename, zip_ref.read(file_info)
+
+
+def iter_zip_batches(zip_path, batch_size, extensions=IMAGE_EXTENSIONS, skip=()):
+    batch_file_names = []
+    batch_data = []
+    for file_name, binary_data in iter_zip_members(zip_path, extensions, skip):
+        batch_file_names.append(file_name)
+        batch_data.append(binary_data)
+        if len(batch_data) == batch_size:
+            yield batch_file_names, batch_data
+            batch_file_names = []
+            batch_data = []
+    if batch_data:
+        yield batch_file_names, batch_data
+
+
+class ZipStream:
+    # reads the members of a list of zip files on a background thread into a
+    # queue of at most read_ahead batches, so at any time memory holds the
+    # batch being processed plus read_ahead batches, whatever the archive size.
+    # Reading carries on into the next archive while the current one is
+    # still being processed.
+    #
+    #   for zip_path, batches in ZipStream(zip_files, batch_size):
+    #       for file_names, batch_data in batches:
+    #           ...
+    #
+    # skip maps a zip path to the member names that must not be read again
+    def __init__(self, zip_paths, batch_size, read_ahead=DEFAULT_READ_AHEAD, extensions=IMAGE_EXTENSIONS, skip=None):
+        self.zip_paths = list(zip_paths)
+        self.batch_size = batch_size
+        self.extensions = extensions
+        self.skip = skip or {}
+        self.queue = queue.Queue(maxsize=max(1, read_ahead))
+        self.errors = {}
+        self._closed = threading.Event()
+        self._thread = None
+
+    def _read(self):
+        # zip_read_seconds is the time spent reading a batch from disk,
+        # zip_blocked_seconds the time the full queue made the reader wait
+        for zip_path in self.zip_paths:
+            if self._closed.is_set():
+                return
+            try:
+                batches = iter_zip_batches(zip_path, self.batch_size, self.extensions, self.skip.get(zip_path, ()))
+                while True:
+                    start = time.perf_counter()
+                    batch = next(batches, None)
+                    if batch is None:
+                        break
+                    metrics.observe('zip_read_seconds', time.perf_counter() - start)
+                    metrics.count('zip_read_bytes', sum(len(data) for data in batch[1]))
+                    metrics.count('zip_read_images', len(batch[1]))
+                    start = time.perf_counter()
+                    self.queue.put(batch)
+                    metrics.observe('zip_blocked_seconds', time.perf_counter() - start)
+                    if self._closed.is_set():
+                        return
+            except Exception as e:
+                self.errors[zip_path] = str(e)
+                metrics.count('zip_read_errors')
+                print(f"Error: {e}")
+            metrics.count('zip_archives_read')
+            self.queue.put(_END)
+
+    def _batches(self):
+        while True:
+            batch = self.queue.get()
+            if batch is _END:
+                return
+            yield batch
+
+    def __iter__(self):
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+        for zip_path in self.zip_paths:
+            batches = self._batches()
+            yield zip_path, batches
+            # drain whatever the consumer left so the next archive starts at
+            # its own first batch
+            for _ in batches:
+                pass
+        self._thread.join()
+
+    def batches(self):
+        # every batch of every archive in one sequence, as
+        # ((zip_path, file_names), batch_data), for consumers that batch across
+        # archive boundaries
+        for zip_path, batches in self:
+            for file_names, batch_data in batches:
+                yield (zip_path, file_names), batch_data
+
+    def close(self):
+        # stops the reader when the consumer gives up before the end, it
+        # would otherwise wait on the full queue for good
+        self._closed.set()
+        while self._thread is not None and self._thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass